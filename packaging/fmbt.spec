@@ -237,6 +237,7 @@ rm -f $RPM_BUILD_ROOT/%{_libdir}/python*/site-packages/eye4graphics.la
 %{_bindir}/%{name}-log
 %{_bindir}/%{name}-stats
 %{_bindir}/%{name}-view
+%{_bindir}/%{name}-vlog
 %{_bindir}/lsts2dot
 %{_bindir}/%{name}-ucheck
 
@@ -266,6 +267,7 @@ rm -f $RPM_BUILD_ROOT/%{_libdir}/python*/site-packages/eye4graphics.la
 %{python_sitearch}/fmbtgti.py*
 %{python_sitearch}/fmbtlogger.py*
 %{python_sitearch}/fmbtuinput.py*
+%{python_sitearch}/fmbtvlog.py*
 %{python_sitearch}/lsts.py*
 %{python_sitearch}/aalmodel.py*
 %{python_sitearch}/%{name}_config.py*
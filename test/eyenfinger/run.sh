@@ -76,3 +76,70 @@ ti.refreshScreenshot("screenshot2-icon.png")
 print ti.verifyBitmap("screenshot2.png")' 2>&1 | grep -q False && {
     testpassed
 } ) || testpassed
+
+teststep "eyenfinger: find unicode text"
+( python -c '
+import eyenfinger
+words = {"Settings": [("word_1_1_1_1", (15, 5), (10, 0, 20, 10))],
+         "Cancel": [("word_1_1_1_2", (45, 5), (40, 0, 50, 10))]}
+print eyenfinger.findText(u"Settings", words, match=0.8)' 2>&1 | tee -a $LOGFILE | grep -q "\[(1.0, .Settings., (10, 0, 20, 10))\]" && {
+    testpassed
+} ) || testfailed
+
+teststep "eyenfinger: maxResults larger than hit count"
+( python -c '
+import eyenfinger
+words = {"Settings": [("word_1_1_1_1", (15, 5), (10, 0, 20, 10)),
+                      ("word_1_1_1_2", (45, 5), (40, 0, 50, 10)),
+                      ("word_1_1_1_3", (75, 5), (70, 0, 80, 10))]}
+print "hits", len(eyenfinger.findText("Settings", words, match=0.8, maxResults=5)), len(eyenfinger.findText("Settings", words, match=0.8, maxResults=0))' 2>&1 | tee -a $LOGFILE | grep -q "hits 3 0" && {
+    testpassed
+} ) || testfailed
+
+teststep "screenshot store: keep file if hard linking fails"
+( python -c '
+import os, shutil, tempfile
+import fmbtgti
+d = tempfile.mkdtemp()
+first, second = os.path.join(d, "first.png"), os.path.join(d, "second.png")
+file(first, "wb").write("screenshot")
+file(second, "wb").write("screenshot")
+def failingLink(src, dst):
+    raise OSError("link not supported")
+os.link = failingLink
+store = fmbtgti._ScreenshotStore()
+store.addFile(first)
+store.addFile(second)
+print "kept:", file(second, "rb").read() == "screenshot", sorted(os.listdir(d))
+shutil.rmtree(d)' 2>&1 | tee -a $LOGFILE | grep -q "kept: True \[.first.png., .second.png.\]" && {
+    testpassed
+} ) || testfailed
+
+teststep "visual log: raw image deltas and keyframes"
+( python -c '
+import os, shutil, tempfile
+import fmbtvlog
+d = tempfile.mkdtemp()
+logFilename = os.path.join(d, "test.vlog")
+writer = fmbtvlog.Writer(logFilename)
+frames = []
+recordNos = []
+for i in xrange(53):
+    # 4x8 RGB images, every frame changes one row
+    rows = [chr(j) * 12 for j in xrange(8)]
+    rows[i % 8] = chr(i + 8) * 12
+    frames.append("".join(rows))
+    recordNos.append(writer.addRawImage(4, 8, "RGB", frames[-1]))
+eventNo = writer.addEvent("M", {"message": "done"})
+duplicateNo = writer.addRawImage(4, 8, "RGB", frames[10])
+writer.close()
+reader = fmbtvlog.Reader(logFilename)
+types = "".join([t for _, t in reader.index(0, reader.recordCount())])
+print "types:", types[:3], types[50:], reader.recordCount(),
+print "dedup:", duplicateNo == recordNos[10], reader.event(eventNo)["message"],
+print "frames:", ([reader.rawImage(r) for r in reversed(recordNos)] ==
+                  [(4, 8, "RGB", f) for f in reversed(frames)])
+reader.close()
+shutil.rmtree(d)' 2>&1 | tee -a $LOGFILE | grep -q "types: XDD DXDM 54 dedup: True done frames: True" && {
+    testpassed
+} ) || testfailed
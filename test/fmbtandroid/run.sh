@@ -0,0 +1,111 @@
+#!/bin/bash
+
+# fMBT, free Model Based Testing tool
+# Copyright (c) 2014, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU Lesser General Public License,
+# version 2.1, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for
+# more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin St - Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+# Tests for fmbtandroid that do not need a device
+
+##########################################
+# Setup test environment
+
+cd "$(dirname "$0")"
+LOGFILE=/tmp/fmbt.test.fmbtandroid.log
+rm -f $LOGFILE
+
+if [ "$1" != "installed" ]; then
+    export PATH=../../src:../../utils:$PATH
+    export LD_LIBRARY_PATH=$(dirname $(find ../.. -name eye4graphics.so | head -n 1)):$LD_LIBRARY_PATH
+    export PYTHONPATH=../../utils:$PYTHONPATH
+fi
+
+source ../functions.sh
+
+##########################################
+# Run the test
+
+teststep "fmbtandroid: parse view dump in parts"
+( python -c '
+import shutil, tempfile
+import fmbtandroid
+d = tempfile.mkdtemp()
+dump = file("view.dump").read()
+def summary(view):
+    return [(i.className(), i.code(), i.indent(), sorted(i.properties().items()),
+             i.bbox(), i.parent() and i.parent().code(), len(i.children()))
+            for i in view.viewItems()]
+whole = fmbtandroid.View(d, "serial", dump)
+parts = fmbtandroid.View(d, "serial", None)
+for i in xrange(0, len(dump), 7):
+    parts._feedDump(dump[i:i+7])
+parts._finishDump(dump)
+print "same:", summary(whole) == summary(parts), len(whole.viewItems()), whole.errors(), parts.errors()
+shutil.rmtree(d)' 2>&1 | tee -a $LOGFILE | grep -q "same: True 9 \[\] \[\]" && {
+    testpassed
+} ) || testfailed
+
+teststep "fmbtandroid: find view items with and without index"
+( python -c '
+import shutil, tempfile
+import fmbtandroid
+d = tempfile.mkdtemp()
+view = fmbtandroid.View(d, "serial", file("view.dump").read())
+allItems = view.viewItems()
+searches = [
+    ("findItemsByText", ("Hello",), {}),
+    ("findItemsByText", ("Hello",), {"partial": True}),
+    ("findItemsByText", ("Hello",), {"partial": True, "count": 1}),
+    ("findItemsByText", ("",), {"partial": True}),
+    ("findItemsByText", ("missing",), {}),
+    ("findItemsById", ("id/ok",), {}),
+    ("findItemsById", ("id/missing",), {}),
+    ("findItemsByClass", ("Button",), {}),
+    ("findItemsByClass", ("android.widget.TextView",), {"partial": False}),
+    ("findItemsByClass", ("LinearLayout",), {"onScreen": True}),
+    ("findItemsByPos", ((50, 175),), {}),
+    ("findItemsByPos", ((479, 799),), {}),
+    ("findItemsByPos", ((1000, 1000),), {}),
+    ("findItemsInRegion", ((0, 100, 480, 300),), {}),
+    ("findItemsInRegion", ((0, 400, 480, 600),), {}),
+    ("findItemsInRegion", ((300, 300, 0, 0),), {}),
+    ]
+failed = []
+for method, args, kwargs in searches:
+    indexed = getattr(view, method)(*args, **kwargs)
+    kwargs["searchItems"] = allItems
+    unindexed = getattr(view, method)(*args, **kwargs)
+    if indexed != unindexed:
+        failed.append((method, args, [i.id() for i in indexed], [i.id() for i in unindexed]))
+print "failed:", failed, [i.id() for i in view.findItemsByText("Hello", partial=True)]
+shutil.rmtree(d)' 2>&1 | tee -a $LOGFILE | grep -q "failed: \[\] \[u.id/title., u.id/status.\]" && {
+    testpassed
+} ) || testfailed
+
+teststep "fmbtandroid: changed and removed view items"
+( python -c '
+import shutil, tempfile
+import fmbtandroid
+d = tempfile.mkdtemp()
+dump = file("view.dump").read()
+first = fmbtandroid.View(d, "serial", dump, incremental=True)
+second = fmbtandroid.View(d, "serial", dump.replace("text:mText=2,OK", "text:mText=3,OK!"), previousView=first)
+third = fmbtandroid.View(d, "serial", dump.replace("text:mText=2,OK", "text:mText=3,OK!"), previousView=second)
+print "changed:", [(i.id(), i.text()) for i in second.changedItems()],
+print "removed:", [(i.id(), i.text()) for i in second.removedItems()],
+print "unchanged:", third.changedItems(), third.removedItems(), first.changedItems()
+shutil.rmtree(d)' 2>&1 | tee -a $LOGFILE | grep -q "changed: \[(u.id/ok., u.OK!.)\] removed: \[(u.id/ok., u.OK.)\] unchanged: \[\] \[\] None" && {
+    testpassed
+} ) || testfailed
@@ -21,6 +21,7 @@
 #include <climits>
 #include <map>
 #include <math.h>
+#include <pthread.h>
 #include <string.h>
 #include <vector>
 
@@ -36,6 +37,54 @@
 
 void initeye4graphics() {}
 
+int drawOnImage(void* image, const char* stroke, const char* fill,
+                const char* primitive)
+{
+    Image* im = static_cast<Image*>(image);
+    MagickBooleanType status;
+    ExceptionInfo *exception;
+    DrawInfo *draw_info;
+    exception = AcquireExceptionInfo();
+    draw_info = CloneDrawInfo((ImageInfo *) NULL, (DrawInfo *) NULL);
+    status = QueryColorDatabase((stroke && *stroke) ? stroke : "none",
+                                &draw_info->stroke, exception);
+    if (status != MagickFalse)
+        status = QueryColorDatabase((fill && *fill) ? fill : "none",
+                                    &draw_info->fill, exception);
+    if (status != MagickFalse) {
+        CloneString(&draw_info->primitive, primitive);
+        status = DrawImage(im, draw_info);
+    }
+    if (status == MagickFalse) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL) {
+            CatchException(exception);
+            CatchException(&im->exception);
+        }
+    }
+    DestroyDrawInfo(draw_info);
+    DestroyExceptionInfo(exception);
+    return status == MagickFalse ? -1 : 0;
+}
+
+int writeImage(void* image, const char* imagefile)
+{
+    Image* im = static_cast<Image*>(image);
+    MagickBooleanType status;
+    ImageInfo *image_info;
+    image_info = CloneImageInfo((ImageInfo *) NULL);
+    CopyMagickString(im->filename, imagefile, MaxTextExtent);
+    CopyMagickString(image_info->filename, imagefile, MaxTextExtent);
+    status = WriteImage(image_info, im);
+    if (status == MagickFalse) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL)
+            CatchException(&im->exception);
+    }
+    DestroyImageInfo(image_info);
+    return status == MagickFalse ? -1 : 0;
+}
+
 PixelPacket* getPixels(Image* image, size_t x1, size_t y1, size_t x2, size_t y2);
 
 static int _ceil(float f) {
@@ -79,6 +128,12 @@ public:
 
 static std::map<Search_id, bool, Search_id_less_comparator> imagePixels;
 typedef std::map<Search_id, bool, Search_id_less_comparator>::iterator ImagePixelsIterator;
+
+/* imagePixelsLock protects imagePixels and pixel cache access so that
+ * findNextIcon can be called from several threads at the same
+ * time. Initialized statically: MagickCore semaphore API differs
+ * between MagickCore 6 versions. */
+static pthread_mutex_t imagePixelsLock = PTHREAD_MUTEX_INITIALIZER;
 typedef std::vector<BoundingBox>::const_iterator BoundingBoxConstIterator;
 
 inline bool same_color(const PixelPacket *p1, const PixelPacket *p2,
@@ -354,6 +409,9 @@ static int iconsearch(std::vector<BoundingBox>& retval,
     if (startX < searchArea.left) startX = searchArea.left;
     if (startY < searchArea.top) startY = searchArea.top;
 
+    /* hay_pixel points to the top-left corner of the search area,
+     * rows are hayStride pixels apart. */
+    const int hayStride = haystack->columns;
     int hayx = haystack->columns;
     int hayy = haystack->rows;
     int neex = needle->columns;
@@ -369,17 +427,24 @@ static int iconsearch(std::vector<BoundingBox>& retval,
                         threshold, colorMatch, opacityLimit, searchArea);
 
     ImagePixelsIterator it;
+    pthread_mutex_lock(&imagePixelsLock);
     if ((it = imagePixels.find(search_id)) != imagePixels.end()) {
         hay_pixel = it->first.hay_pixel;
         nee_pixel = it->first.nee_pixel;
     } else {
-        hay_pixel = getPixels(haystack, searchArea.left, searchArea.top, hayx, hayy);
+        /* Always request the whole image: pixels of a whole image
+         * can be returned without copying them to a buffer that is
+         * shared by all requests to the image. */
+        hay_pixel = getPixels(haystack, 0, 0, haystack->columns, haystack->rows);
+        if (hay_pixel != NULL)
+            hay_pixel += searchArea.top * hayStride + searchArea.left;
         nee_pixel = getPixels(needle, 0, 0, neex, neey);
 
         search_id.hay_pixel = hay_pixel;
         search_id.nee_pixel = nee_pixel;
         imagePixels[search_id] = true;
     }
+    pthread_mutex_unlock(&imagePixelsLock);
 
     if (threshold == 0) {
         /* Pixel-perfect match */
@@ -397,7 +462,7 @@ static int iconsearch(std::vector<BoundingBox>& retval,
                     }
                     if (skipCoordinates) continue;
                 }
-                if (pixelperfect_match(hayx, neex, neey, x, y,
+                if (pixelperfect_match(hayStride, neex, neey, x, y,
                                        hay_pixel, nee_pixel,
                                        colorDiff,
                                        skipTransparency,
@@ -425,7 +490,7 @@ static int iconsearch(std::vector<BoundingBox>& retval,
     int stepy = neey >= samples ? neey/samples : 1;
     for (int y=0;y<hayy-neey;y++) {
         for (int x=0;x<hayx-neex;x++) {
-            long thisdelta = normdiag_error(hayx, neex, neey, x, y,
+            long thisdelta = normdiag_error(hayStride, neex, neey, x, y,
                                             hay_pixel, nee_pixel,
                                             0, 0, stepx, stepy);
             if (thisdelta != INCOMPARABLE && thisdelta <= color_threshold) {
@@ -442,20 +507,20 @@ static int iconsearch(std::vector<BoundingBox>& retval,
         int x = candidates[ci].second.first;
         int y = candidates[ci].second.second;
 
-        thisdelta = normdiag_error(hayx, neex, neey, x, y, hay_pixel, nee_pixel,
+        thisdelta = normdiag_error(hayStride, neex, neey, x, y, hay_pixel, nee_pixel,
                                    0, neey/2, 1, 0);
         if (thisdelta == INCOMPARABLE) {
             candidates[ci].first = LONG_MAX; continue;
         }
         candidates[ci].first += thisdelta;
 
-        thisdelta = normdiag_error(hayx, neex, neey, x, y, hay_pixel, nee_pixel,
+        thisdelta = normdiag_error(hayStride, neex, neey, x, y, hay_pixel, nee_pixel,
                                   neex/2, 0, 0, 1);
         if (thisdelta == INCOMPARABLE) {
             candidates[ci].first = LONG_MAX; continue;
         }
         candidates[ci].first += thisdelta;
-        thisdelta = normdiag_error(hayx, neex, neey, x, y, hay_pixel, nee_pixel,
+        thisdelta = normdiag_error(hayStride, neex, neey, x, y, hay_pixel, nee_pixel,
                                     neex-1, 0, -1, 1);
         if (thisdelta == INCOMPARABLE) {
             candidates[ci].first = LONG_MAX; continue;
@@ -717,6 +782,11 @@ int openedImageDimensions(BoundingBox* bbox, void* image)
     return 0;
 }
 
+int quantumDepth()
+{
+    return MAGICKCORE_QUANTUM_DEPTH;
+}
+
 int openedImageIsBlank(void* image)
 {
     Image* im = static_cast<Image*>(image);
@@ -736,12 +806,68 @@ int openedImageIsBlank(void* image)
 
 void* openBlob(const void* blob, const char* pixelorder, int x, int y)
 {
-    // Image* image = new Image(x,y,pixelorder,CharPixel,blob);
-    Image* image = NULL;
+    Image* image;
+    ExceptionInfo *exception;
+    exception = AcquireExceptionInfo();
+    image = ConstituteImage(x, y, pixelorder, CharPixel, blob, exception);
+    if (image == NULL) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL)
+            CatchException(exception);
+    }
+    DestroyExceptionInfo(exception);
     return static_cast<void*>(image);
 }
 
 
+int openedImageTileHashes(void* image, const int tileSize,
+                          unsigned int* hashes, const int hashCount)
+{
+    Image* im = static_cast<Image*>(image);
+    const int xsize = im->columns;
+    const int ysize = im->rows;
+    const int tileColumns = (xsize + tileSize - 1) / tileSize;
+    const int tileRows = (ysize + tileSize - 1) / tileSize;
+    if (tileColumns * tileRows > hashCount) return -1;
+
+    /* FNV-1a hash of pixels of each tile */
+    for (int i = 0; i < tileColumns * tileRows; ++i)
+        hashes[i] = 2166136261u;
+
+    pthread_mutex_lock(&imagePixelsLock);
+    const PixelPacket* pp = getPixels(im, 0, 0, xsize, ysize);
+    if (pp == NULL) {
+        pthread_mutex_unlock(&imagePixelsLock);
+        return -1;
+    }
+    for (int y = 0; y < ysize; ++y) {
+        unsigned int* rowHashes = hashes + (y / tileSize) * tileColumns;
+        for (int x = 0; x < xsize; ++x, ++pp) {
+            unsigned int* h = rowHashes + x / tileSize;
+            *h = (*h ^ pp->red) * 16777619u;
+            *h = (*h ^ pp->green) * 16777619u;
+            *h = (*h ^ pp->blue) * 16777619u;
+        }
+    }
+    pthread_mutex_unlock(&imagePixelsLock);
+    return tileColumns * tileRows;
+}
+
+void* scaleImage(void* image, int columns, int rows)
+{
+    Image* scaled;
+    ExceptionInfo *exception;
+    exception = AcquireExceptionInfo();
+    scaled = ScaleImage(static_cast<Image*>(image), columns, rows, exception);
+    if (scaled == NULL) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL)
+            CatchException(exception);
+    }
+    DestroyExceptionInfo(exception);
+    return static_cast<void*>(scaled);
+}
+
 void* openImage(const char* imagefile)
 {
     Image* image;
@@ -773,6 +899,7 @@ PixelPacket* getPixels(Image* image, size_t x1, size_t y1, size_t x2, size_t y2)
 
 void closeImage(void* image)
 {
+    pthread_mutex_lock(&imagePixelsLock);
     ImagePixelsIterator it = imagePixels.begin();
     while (it != imagePixels.end()) {
         if (it->first.haystack == image ||
@@ -783,6 +910,7 @@ void closeImage(void* image)
             ++it;
         }
     }
+    pthread_mutex_unlock(&imagePixelsLock);
     if (image != NULL)
         DestroyImage(static_cast<Image*>(image));
 }
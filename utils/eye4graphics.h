@@ -143,6 +143,8 @@ extern "C" {
      *
      * Return value:
      *     see findSingleIcon
+     *
+     * findNextIcon can be called from many threads simultaneously.
      */
 
     EXPORT
@@ -191,12 +193,98 @@ extern "C" {
     EXPORT
     int openedImageIsBlank(void* image);
 
+    /*
+     * quantumDepth - number of bits per color channel in opened images
+     *
+     * Return value:
+     *    quantum depth of MagickCore, for instance 8 or 16.
+     */
+    EXPORT
+    int quantumDepth();
+
     EXPORT
     void* openImage(const char* imagefile);
 
+    /*
+     * openBlob - open raw pixel data as an image
+     *
+     * Parameters:
+     *   - blob         - pixel data, 8 bits per channel
+     *   - pixelorder   - order of channels in a pixel, for instance
+     *                    "RGB", "RGBA" or "BGRP" (P is an ignored byte)
+     *   - x, y         - width and height of the image
+     *
+     * Return value:
+     *    opened image that can be used like one returned by openImage,
+     *    or NULL on error. Pixel data is copied, blob can be freed
+     *    after the call.
+     */
     EXPORT
     void* openBlob(const void* blob, const char* pixelorder, int x, int y);
 
+    /*
+     * openedImageTileHashes - hash pixels of image in tiles
+     *
+     * Parameters:
+     *   - image        - opened image
+     *   - tileSize     - width and height of a tile in pixels
+     *   - hashes (out) - hashes of tiles, row by row
+     *   - hashCount    - number of elements in hashes
+     *
+     * Return value:
+     *    number of tiles, or -1 if hashes is too small or pixels
+     *    cannot be read.
+     */
+    EXPORT
+    int openedImageTileHashes(void* image, const int tileSize,
+                              unsigned int* hashes, const int hashCount);
+
+    /*
+     * scaleImage - create scaled copy of an opened image
+     *
+     * Parameters:
+     *   - image        - opened image
+     *   - columns, rows - size of the scaled image
+     *
+     * Return value:
+     *    new opened image (to be closed with closeImage), or NULL on
+     *    error.
+     */
+    EXPORT
+    void* scaleImage(void* image, int columns, int rows);
+
+    /*
+     * drawOnImage - draw on an opened image in memory
+     *
+     * Parameters:
+     *   - image        - opened image
+     *   - stroke       - stroke color, for instance "red". "none" or
+     *                    empty string disables stroke.
+     *   - fill         - fill color, "none" or empty string disables fill.
+     *   - primitive    - ImageMagick draw primitive (MVG), for instance
+     *                    "fill-opacity 0.2 rectangle 10,10 20,20".
+     *
+     * Return value:
+     *    0 on success, -1 on error.
+     */
+    EXPORT
+    int drawOnImage(void* image, const char* stroke, const char* fill,
+                    const char* primitive);
+
+    /*
+     * writeImage - write an opened image to a file
+     *
+     * Parameters:
+     *   - image        - opened image
+     *   - imagefile    - name of the file. Image format is chosen by
+     *                    the filename extension.
+     *
+     * Return value:
+     *    0 on success, -1 on error.
+     */
+    EXPORT
+    int writeImage(void* image, const char* imagefile);
+
     EXPORT
     void closeImage(void* image);
 
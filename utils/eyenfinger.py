@@ -68,12 +68,14 @@ iClickWord("[initial", clickPos=(-2,3), capture="highlight.png", dryRun=True)
 '
 """
 
+import distutils.spawn
 import distutils.sysconfig
 import time
 import subprocess
 import re
 import math
 import htmlentitydefs
+import string
 import sys
 import os
 import tempfile
@@ -83,6 +85,7 @@ import shutil
 import ctypes
 import platform
 import struct
+import threading
 import warnings
 
 import fmbt_config
@@ -101,6 +104,22 @@ _g_hocr = ""
 
 _g_words = None
 
+# Characters that often look similar in OCR results, and edit
+# distance of substituting one with another.
+_g_closeMatch = {
+    '1l': 0.1,
+    '1I': 0.2,
+    'Il': 0.2
+    }
+# Maps characters in _g_closeMatch to the same character.
+_g_closeMatchChars = string.maketrans("lI", "11")
+_g_closeMatchUnicodeChars = dict((ord(c), u"1") for c in u"lI")
+
+# Recently built text indexes, list of (detected_words, snapshot of
+# detected_words contents, word_count, index).
+_g_textIndexes = []
+_g_textIndexesMax = 8
+
 _g_lastWindow = None
 
 _g_defaultClickDryRun = False
@@ -110,6 +129,26 @@ _g_defaultIconColorMatch = 1.0
 _g_defaultIconOpacityLimit = 0.0
 _g_defaultInputKeyDevice = None
 _g_defaultReadWithOCR = True
+_g_defaultOcrWithLibTesseract = True
+
+# libtesseract is loaded on first OCR. None: not tried yet,
+# False: not available, tesseract executable will be used.
+_g_libTesseract = None
+# Initialized Tesseract API instances that are not in use,
+# (lang, configfiles) -> list of TessBaseAPI pointers.
+_g_tesseractApis = {}
+_g_tesseractApisLock = threading.Lock()
+
+# Directories searched for trained data of OCR languages, after
+# $TESSDATA_PREFIX.
+_g_tessdataDirs = ["/usr/share/tesseract-ocr/4.00/tessdata",
+                   "/usr/share/tesseract-ocr/tessdata",
+                   "/usr/share/tessdata",
+                   "/usr/local/share/tessdata"]
+
+# ocrIdentities maps (libtesseract used, lang) to identity string
+# of the OCR engine, see _ocrIdentity.
+_g_ocrIdentities = {}
 
 # windowsOffsets maps window-id to (x, y) pair.
 _g_windowOffsets = {None: (0,0)}
@@ -236,6 +275,199 @@ except Exception, e:
     eye4graphics = None
     _log('Loading icon recognition library failed: "%s".' % (e,))
 
+def _libTesseract():
+    """
+    Returns libtesseract with C API function prototypes set, or
+    None if the library cannot be loaded.
+    """
+    global _g_libTesseract
+    if _g_libTesseract == None:
+        _g_libTesseract = False
+        if os.name == "nt":
+            libnames = ["libtesseract-4.dll", "libtesseract-3.dll",
+                        "tesseract.dll"]
+        else:
+            libnames = ["libtesseract.so.4", "libtesseract.so.3",
+                        "libtesseract.so"]
+        for libname in libnames:
+            try:
+                lib = ctypes.CDLL(libname)
+                break
+            except OSError:
+                pass
+        else:
+            _log("libtesseract not found, using tesseract executable")
+            return None
+        try:
+            lib.TessBaseAPICreate.restype = ctypes.c_void_p
+            lib.TessBaseAPICreate.argtypes = []
+            lib.TessBaseAPIDelete.argtypes = [ctypes.c_void_p]
+            lib.TessBaseAPIInit3.argtypes = [
+                ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+            lib.TessBaseAPIReadConfigFile.argtypes = [
+                ctypes.c_void_p, ctypes.c_char_p]
+            lib.TessBaseAPISetPageSegMode.argtypes = [
+                ctypes.c_void_p, ctypes.c_int]
+            lib.TessBaseAPISetImage.argtypes = [
+                ctypes.c_void_p, ctypes.c_char_p,
+                ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+            lib.TessBaseAPIRecognize.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p]
+            # Returned text must be freed with TessDeleteText,
+            # therefore c_void_p instead of c_char_p.
+            lib.TessBaseAPIGetHOCRText.restype = ctypes.c_void_p
+            lib.TessBaseAPIGetHOCRText.argtypes = [
+                ctypes.c_void_p, ctypes.c_int]
+            lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+            lib.TessVersion.restype = ctypes.c_char_p
+            lib.TessVersion.argtypes = []
+        except AttributeError, e:
+            _log('libtesseract C API not available: "%s"' % (e,))
+            return None
+        _g_libTesseract = lib
+    return _g_libTesseract or None
+
+def _ocrIdentity(lang):
+    """
+    Returns string that identifies the OCR engine used for reading
+    lang: Tesseract library or executable, its version and trained
+    data files. Results of different engines may differ.
+    """
+    useLib = bool(_g_defaultOcrWithLibTesseract and _libTesseract())
+    key = (useLib, lang)
+    if not key in _g_ocrIdentities:
+        if useLib:
+            engine = "lib %s %s" % (_g_libTesseract._name,
+                                    _g_libTesseract.TessVersion())
+        else:
+            try:
+                exit_status, output = _runcmd(["tesseract", "--version"])
+                # Tesseract 3 prints version to stderr.
+                version = output.strip() + " " + _g_last_runcmd_error.strip()
+            except OSError:
+                version = "not found"
+            engine = "exe %s %s" % (
+                distutils.spawn.find_executable("tesseract"), version)
+        tessdataDirs = _g_tessdataDirs[:]
+        if "TESSDATA_PREFIX" in os.environ:
+            prefix = os.environ["TESSDATA_PREFIX"]
+            tessdataDirs[:0] = [prefix, os.path.join(prefix, "tessdata")]
+        traineddata = []
+        for l in lang.split("+"):
+            for tessdataDir in tessdataDirs:
+                filename = os.path.join(tessdataDir, l + ".traineddata")
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                traineddata.append("%s %s %s" % (filename, st.st_size, st.st_mtime))
+                break
+            else:
+                traineddata.append("%s not found" % (l,))
+        _g_ocrIdentities[key] = "%s; %s" % (engine, "; ".join(traineddata))
+    return _g_ocrIdentities[key]
+
+def _acquireTesseractApi(lib, lang, configfiles):
+    key = (lang, configfiles)
+    _g_tesseractApisLock.acquire()
+    try:
+        if _g_tesseractApis.get(key, []):
+            return _g_tesseractApis[key].pop()
+    finally:
+        _g_tesseractApisLock.release()
+    api = lib.TessBaseAPICreate()
+    if lib.TessBaseAPIInit3(api, None, lang) != 0:
+        lib.TessBaseAPIDelete(api)
+        raise NoOCRResults('Initializing Tesseract with language "%s" failed'
+                           % (lang,))
+    for configfile in configfiles:
+        lib.TessBaseAPIReadConfigFile(api, configfile)
+    return api
+
+def _releaseTesseractApi(lang, configfiles, api):
+    _g_tesseractApisLock.acquire()
+    try:
+        _g_tesseractApis.setdefault((lang, configfiles), []).append(api)
+    finally:
+        _g_tesseractApisLock.release()
+
+def _deleteTesseractApis():
+    if not _g_libTesseract:
+        return
+    _g_tesseractApisLock.acquire()
+    try:
+        for apis in _g_tesseractApis.itervalues():
+            for api in apis:
+                _g_libTesseract.TessBaseAPIDelete(api)
+        _g_tesseractApis.clear()
+    finally:
+        _g_tesseractApisLock.release()
+atexit.register(_deleteTesseractApis)
+
+def _readPpm(data):
+    """
+    Returns (width, height, rgbData) of binary PPM image data with
+    8-bit channels.
+    """
+    header = re.match(r"P6\s+([0-9]+)\s+([0-9]+)\s+([0-9]+)\s", data)
+    if not header or header.group(3) != "255":
+        raise NoOCRResults("Unexpected preprocessed image format")
+    width, height = int(header.group(1)), int(header.group(2))
+    return width, height, data[header.end():header.end() + width * height * 3]
+
+def _tesseractApiHocr(lang, configfiles, psm, image):
+    """
+    Returns hOCR of image (width, height, rgbData) read with page
+    segmentation mode psm.
+    """
+    lib = _libTesseract()
+    width, height, rgbData = image
+    api = _acquireTesseractApi(lib, lang, configfiles)
+    try:
+        lib.TessBaseAPISetPageSegMode(api, psm)
+        lib.TessBaseAPISetImage(api, rgbData, width, height, 3, width * 3)
+        if lib.TessBaseAPIRecognize(api, None) != 0:
+            raise NoOCRResults("Tesseract failed to recognize image")
+        hocrPtr = lib.TessBaseAPIGetHOCRText(api, 0)
+        if not hocrPtr:
+            raise NoOCRResults("Tesseract returned no hOCR output")
+        try:
+            return ctypes.string_at(hocrPtr)
+        finally:
+            lib.TessDeleteText(hocrPtr)
+    finally:
+        _releaseTesseractApi(lang, configfiles, api)
+
+def _tesseractApiWords(lang, configfiles, ocrPageSegModes, image):
+    """
+    Read image with every page segmentation mode in parallel. Returns
+    words found with all modes, later modes override earlier ones
+    like with the tesseract executable.
+    """
+    results = [None] * len(ocrPageSegModes)
+    def _read(index, psm):
+        try:
+            results[index] = _hocr2words(
+                _tesseractApiHocr(lang, configfiles, psm, image))
+        except Exception, e:
+            results[index] = e
+    threads = []
+    for index, psm in enumerate(ocrPageSegModes[1:]):
+        t = threading.Thread(target=_read, args=(index + 1, psm))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    if ocrPageSegModes:
+        _read(0, ocrPageSegModes[0])
+    for t in threads:
+        t.join()
+    words = {}
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+        words.update(result)
+    return words
+
 # See struct input_event in /usr/include/linux/input.h
 if platform.architecture()[0] == "32bit":
     _InputEventStructSpec = 'IIHHi'
@@ -436,6 +668,20 @@ def iSetDefaultReadWithOCR(ocr):
     global _g_defaultReadWithOCR
     _g_defaultReadWithOCR = ocr
 
+def iSetDefaultOcrWithLibTesseract(useLib):
+    """
+    Set the default for running OCR with the Tesseract library
+    instead of launching the tesseract executable for every read.
+
+    If useLib == True (the default), Tesseract API instances are
+    initialized once per language and configuration and reused by
+    later iRead calls. Page segmentation modes are read in parallel,
+    and images are passed in memory. If libtesseract cannot be
+    loaded, the tesseract executable is used.
+    """
+    global _g_defaultOcrWithLibTesseract
+    _g_defaultOcrWithLibTesseract = useLib
+
 def screenSize():
     """
     Returns the size of the screen as a pair (width, height).
@@ -582,17 +828,63 @@ def iRead(windowId = None, source = None, preprocess = None, ocr=None, capture=N
                           ("-resize %sx" % (newXResize,)) +
                           preprocess[resize_m.end():])
     _g_words = {}
+    if isinstance(configfile, basestring):
+        configfiles = (configfile,)
+    elif isinstance(configfile, list) or isinstance(configfile, tuple):
+        configfiles = tuple(configfile)
+    else:
+        configfiles = ()
+    if _g_defaultOcrWithLibTesseract and _libTesseract():
+        # Preprocess once, pass the image to Tesseract in memory.
+        convert_cmd = ([fmbt_config.imagemagick_convert, _g_origImage] +
+                       croparea +
+                       shlex.split(preprocess) +
+                       ["-depth", "8", "ppm:-"])
+        exit_status, output = _runcmd(convert_cmd)
+        if exit_status != 0:
+            raise NoOCRResults("Convert returned exit status (%s): %s"
+                               % (exit_status, _g_last_runcmd_error))
+        image = _readPpm(output)
+        _g_words = _tesseractApiWords(lang, configfiles,
+                                      tuple(ocrPageSegModes), image)
+        scaled_width, scaled_height = image[0], image[1]
+        _g_readImage = None
+    else:
+        _g_words, (scaled_width, scaled_height) = _tesseractCmdWords(
+            croparea, preprocess, ocrPageSegModes, lang, configfiles)
+
+    # convert word coordinates to the unscaled pixmap
+    scaled_width, scaled_height = float(scaled_width) / (float(x2-x1)/orig_width), float(scaled_height) / (float(y2-y1)/orig_height)
+
+    for word in sorted(_g_words.keys()):
+        for appearance, (wordid, middle, bbox) in enumerate(_g_words[word]):
+            _g_words[word][appearance] = \
+                (wordid,
+                 (int(middle[0]/scaled_width * orig_width) + wordXOffset,
+                  int(middle[1]/scaled_height * orig_height) + wordYOffset),
+                 (int(bbox[0]/scaled_width * orig_width) + wordXOffset,
+                  int(bbox[1]/scaled_height * orig_height) + wordYOffset,
+                  int(bbox[2]/scaled_width * orig_width) + wordXOffset,
+                  int(bbox[3]/scaled_height * orig_height) + wordYOffset))
+            _log('found "' + word + '": (' + str(bbox[0]) + ', ' + str(bbox[1]) + ')')
+    if capture:
+        drawWords(_g_origImage, capture, _g_words, _g_words)
+    return sorted(_g_words.keys())
+
+def _tesseractCmdWords(croparea, preprocess, ocrPageSegModes, lang, configfiles):
+    """
+    Read words from _g_origImage with the tesseract executable.
+    Returns pair (words, (width, height)), where width and height are
+    dimensions of the preprocessed image.
+    """
+    words = {}
     for psm in ocrPageSegModes:
         convert_cmd = ([fmbt_config.imagemagick_convert, _g_origImage] +
                        croparea +
                        shlex.split(preprocess) +
                        [_g_readImage])
         tesseract_cmd = ["tesseract", _g_readImage, SCREENSHOT_FILENAME,
-                         "-l", lang, "-psm", str(psm), "hocr"]
-        if isinstance(configfile, basestring):
-            tesseract_cmd += [configfile]
-        elif isinstance(configfile, list) or isinstance(configfile, tuple):
-            tesseract_cmd += configfile
+                         "-l", lang, "-psm", str(psm), "hocr"] + list(configfiles)
         exit_status, output = _runcmd(convert_cmd)
         if exit_status != 0:
             raise NoOCRResults("Convert returned exit status (%s): %s"
@@ -611,31 +903,15 @@ def iRead(windowId = None, source = None, preprocess = None, ocr=None, capture=N
                 raise NoOCRResults("HOCR output missing. Tesseract OCR 3.02 or greater required.\n")
 
         # store every word and its coordinates
-        _g_words.update(_hocr2words(file(hocr_filename).read()))
+        words.update(_hocr2words(file(hocr_filename).read()))
 
-    # convert word coordinates to the unscaled pixmap
     try:
         ocr_page_line = [line for line in file(hocr_filename).readlines() if "class='ocr_page'" in line][0]
     except IndexError:
         raise NoOCRResults("Could not read ocr_page class information from %s" % (hocr_filename,))
 
     scaled_width, scaled_height = re.findall('bbox 0 0 ([0-9]+)\s*([0-9]+)', ocr_page_line)[0]
-    scaled_width, scaled_height = float(scaled_width) / (float(x2-x1)/orig_width), float(scaled_height) / (float(y2-y1)/orig_height)
-
-    for word in sorted(_g_words.keys()):
-        for appearance, (wordid, middle, bbox) in enumerate(_g_words[word]):
-            _g_words[word][appearance] = \
-                (wordid,
-                 (int(middle[0]/scaled_width * orig_width) + wordXOffset,
-                  int(middle[1]/scaled_height * orig_height) + wordYOffset),
-                 (int(bbox[0]/scaled_width * orig_width) + wordXOffset,
-                  int(bbox[1]/scaled_height * orig_height) + wordYOffset,
-                  int(bbox[2]/scaled_width * orig_width) + wordXOffset,
-                  int(bbox[3]/scaled_height * orig_height) + wordYOffset))
-            _log('found "' + word + '": (' + str(bbox[0]) + ', ' + str(bbox[1]) + ')')
-    if capture:
-        drawWords(_g_origImage, capture, _g_words, _g_words)
-    return sorted(_g_words.keys())
+    return words, (int(scaled_width), int(scaled_height))
 
 
 def iVerifyWord(word, match=0.33, appearance=1, capture=None):
@@ -1440,35 +1716,27 @@ def findWord(word, detected_words = None, appearance=1):
         if _g_words == None:
             raise NoOCRResults()
 
-    scored_words = []
-    for w in detected_words:
-        scored_words.append((_score(w, word), w))
-    scored_words.sort()
-
-    if len(scored_words) == 0:
+    if len(detected_words) == 0:
         raise BadMatch("No words found.")
 
-    return scored_words[-1]
-
-def findText(text, detected_words = None, match=-1):
-    def biggerBox(bbox_list):
-        left, top, right, bottom = bbox_list[0]
-        for l, t, r, b in bbox_list[1:]:
-            left = min(left, l)
-            top = min(top, t)
-            right = max(right, r)
-            bottom = max(bottom, b)
-        return (left, top, right, bottom)
-    words = text.split()
-    word_count = len(words)
-    detected_texts = [] # strings of <word_count> words
+    # Score words with the closest lengths first. Skip the rest if
+    # their length difference alone makes their scores worse than
+    # the best found so far.
+    best = None
+    for w in sorted(detected_words, key=lambda w: abs(len(w) - len(word))):
+        maxLen = max(len(w), len(word))
+        if (best != None and maxLen > 0 and
+            1 - abs(len(w) - len(word)) / float(maxLen) < best[0] - 1e-9):
+            continue
+        scored_word = (_score(w, word), w)
+        if best == None or scored_word > best:
+            best = scored_word
+    return best
 
-    if detected_words == None:
-        detected_words = _g_words
-        if _g_words == None:
-            raise NoOCRResults()
-
-    # sort by numeric word id
+def _wordsById(detected_words):
+    """
+    Returns list of (word id, word, bbox) sorted by numeric word id.
+    """
     words_by_id = []
     for word in detected_words:
         for wid, middle, bbox in detected_words[word]:
@@ -1477,63 +1745,158 @@ def findText(text, detected_words = None, match=-1):
             words_by_id.append(
                 (int_wid, word, bbox))
     words_by_id.sort()
-
-    scored_texts = []
-    if word_count > 0:
+    return words_by_id
+
+class _TextIndex(object):
+    """
+    Bigram index of texts of word_count consecutive detected words.
+
+    Texts are filtered with length difference and number of common
+    bigrams before computing their scores, see q-gram lemma:
+    strings with edit distance d share at least
+    max(len) - 1 - 2 * d bigrams. Characters in _g_closeMatch are
+    indexed as one character, because substituting them does not
+    cost a full edit.
+    """
+    def __init__(self, detected_words, word_count):
+        def biggerBox(bbox_list):
+            left, top, right, bottom = bbox_list[0]
+            for l, t, r, b in bbox_list[1:]:
+                left = min(left, l)
+                top = min(top, t)
+                right = max(right, r)
+                bottom = max(bottom, b)
+            return (left, top, right, bottom)
+        words_by_id = _wordsById(detected_words)
+        self.texts = [] # list of (text, bbox)
+        self.bigrams = {} # bigram -> list of (text index, count)
         for i in xrange(len(words_by_id)-word_count+1):
-            detected_texts.append(
-                (" ".join([w[1] for w in words_by_id[i:i+word_count]]),
-                 biggerBox([w[2] for w in words_by_id[i:i+word_count]])))
+            text = " ".join([w[1] for w in words_by_id[i:i+word_count]])
+            self.texts.append(
+                (text, biggerBox([w[2] for w in words_by_id[i:i+word_count]])))
+            for bigram, count in _bigrams(text).iteritems():
+                self.bigrams.setdefault(bigram, []).append(
+                    (len(self.texts) - 1, count))
+
+    def scoredTexts(self, text, match):
+        """
+        Returns list of (score, detected text, bbox) of detected texts
+        that match to text with at least given score.
+        """
+        if match <= 0:
+            return [(_score(t, text), t, bbox) for t, bbox in self.texts]
+        common = [0] * len(self.texts)
+        for bigram, count in _bigrams(text).iteritems():
+            for textIndex, textCount in self.bigrams.get(bigram, ()):
+                common[textIndex] += min(count, textCount)
+        scored_texts = []
+        for textIndex, (t, bbox) in enumerate(self.texts):
+            maxLen = max(len(t), len(text))
+            maxDistance = (1 - match) * maxLen + 1e-9
+            if abs(len(t) - len(text)) > maxDistance:
+                continue
+            if common[textIndex] < maxLen - 1 - 2 * maxDistance:
+                continue
+            score = _score(t, text)
+            if score >= match:
+                scored_texts.append((score, t, bbox))
+        return scored_texts
+
+def _bigrams(text):
+    bigrams = {}
+    if isinstance(text, unicode):
+        text = text.translate(_g_closeMatchUnicodeChars)
+    else:
+        text = text.translate(_g_closeMatchChars)
+    for i in xrange(len(text) - 1):
+        bigrams[text[i:i+2]] = bigrams.get(text[i:i+2], 0) + 1
+    return bigrams
 
+def _textIndex(detected_words, word_count):
+    """
+    Returns _TextIndex of detected_words, reuses recently built
+    indexes. An index is reused only if detected_words has not been
+    modified after building it.
+    """
+    snapshot = [(word, tuple(appearances))
+                for word, appearances in detected_words.iteritems()]
+    for i, (dw, dwSnapshot, wc, index) in enumerate(_g_textIndexes):
+        if dw is detected_words and wc == word_count and dwSnapshot == snapshot:
+            return index
+    index = _TextIndex(detected_words, word_count)
+    _g_textIndexes.insert(0, (detected_words, snapshot, word_count, index))
+    del _g_textIndexes[_g_textIndexesMax:]
+    return index
+
+def findText(text, detected_words = None, match=-1, maxResults=None):
+    """
+    Returns list of (score, detected text, bbox) of texts that match
+    to text with at least given score, sorted by score. If maxResults
+    is given, returns only that many best matches.
+    """
+    words = text.split()
+    word_count = len(words)
+
+    if detected_words == None:
+        detected_words = _g_words
+        if _g_words == None:
+            raise NoOCRResults()
+
+    if word_count > 0:
         norm_text = " ".join(words) # normalize whitespace
-        for t in detected_texts:
-            scored_texts.append((_score(t[0], norm_text), t[0], t[1]))
+        scored_texts = _textIndex(detected_words, word_count).scoredTexts(
+            norm_text, match)
         scored_texts.sort()
     elif match == 0.0:
         # text == "", match == 0 => every word is a match
-        for w in words_by_id:
-            detected_texts.append((w[1], w[2]))
-        scored_texts = [(0.0, t[0], t[1]) for t in detected_texts]
+        scored_texts = [(0.0, w[1], w[2]) for w in _wordsById(detected_words)]
     else:
         # text == "", match != 0 => no hits
-        detected_texts = []
         scored_texts = []
 
-    return [st for st in scored_texts if st[0] >= match]
+    scored_texts = [st for st in scored_texts if st[0] >= match]
+    if maxResults == 0:
+        scored_texts = []
+    elif maxResults != None:
+        scored_texts = scored_texts[max(0, len(scored_texts) - maxResults):]
+    return scored_texts
+
+def _levenshteinDistance(w1, w2):
+    """
+    Returns Levenshtein distance of w1 and w2, where substituting
+    similar looking characters (see _g_closeMatch) costs less than
+    full edit.
+    """
+    previous = range(len(w1)+1)
+    for j in xrange(1, len(w2)+1):
+        c2 = w2[j-1]
+        current = [j]
+        for i in xrange(1, len(w1)+1):
+            c1 = w1[i-1]
+            if c1 == c2:
+                current.append(previous[i-1])
+            else:
+                # This is not part of Levenshtein:
+                # if characters often look similar,
+                # don't add full edit distance (1.0),
+                # use the value in closeMatch instead.
+                close = _g_closeMatch.get(c1 + c2 if c1 < c2 else c2 + c1, None)
+                if close != None:
+                    current.append(previous[i-1] + close)
+                else:
+                    # Standard Levenshtein continues...
+                    current.append(min(
+                            previous[i] + 1,  # delete
+                            current[i-1] + 1, # insert
+                            previous[i-1] + 1 # substitute
+                            ))
+        previous = current
+    return previous[-1]
 
 def _score(w1, w2):
-    closeMatch = {
-        '1l': 0.1,
-        '1I': 0.2,
-        'Il': 0.2
-        }
-    def levenshteinDistance(w1, w2):
-        m = [range(len(w1)+1)]
-        for j in xrange(len(w2)+1):
-            m.append([])
-            m[-1].append(j+1)
-        i, j = 0, 0
-        for j in xrange(1, len(w2)+1):
-            for i in xrange(1, len(w1)+1):
-                if w1[i-1] == w2[j-1]:
-                    m[j].append(m[j-1][i-1])
-                else:
-                    # This is not part of Levenshtein:
-                    # if characters often look similar,
-                    # don't add full edit distance (1.0),
-                    # use the value in closeMatch instead.
-                    chars = ''.join(sorted(w1[i-1] + w2[j-1]))
-                    if chars in closeMatch:
-                        m[j].append(m[j-1][i-1]+closeMatch[chars])
-                    else:
-                        # Standard Levenshtein continues...
-                        m[j].append(min(
-                                m[j-1][i] + 1,  # delete
-                                m[j][i-1] + 1,  # insert
-                                m[j-1][i-1] + 1 # substitute
-                                ))
-        return m[j][i]
-    return 1 - (levenshteinDistance(w1, w2) / float(max(len(w1),len(w2))))
+    if w1 == w2 or not w2:
+        return 1.0
+    return 1 - (_levenshteinDistance(w1, w2) / float(max(len(w1),len(w2))))
 
 def _hocr2words(hocr):
     rv = {}
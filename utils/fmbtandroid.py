@@ -169,8 +169,10 @@ window = Launcher
 
 import commands
 import gzip
+import hashlib
 import math
 import os
+import Queue
 import random
 import re
 import shutil
@@ -179,8 +181,11 @@ import StringIO
 import struct
 import subprocess
 import tempfile
+import threading
 import time
+import traceback
 import uu
+import zlib
 
 import fmbt
 import fmbtgti
@@ -245,6 +250,11 @@ def _run(command, expectedExitStatus = None, timeout=None):
 
     exitStatus = p.returncode
 
+    _checkExitStatus(command, exitStatus, out, err, expectedExitStatus)
+
+    return (exitStatus, out, err)
+
+def _checkExitStatus(command, exitStatus, out, err, expectedExitStatus):
     if expectedExitStatus != None:
         if ((type(expectedExitStatus) in [list, tuple] and
              not exitStatus in expectedExitStatus) or
@@ -253,12 +263,182 @@ def _run(command, expectedExitStatus = None, timeout=None):
             msg = 'Unexpected exit status %s from command "%s".\n    Output: %s\n    Error: %s' % (
                 exitStatus, command, out, err)
             _adapterLog(msg)
-            if "error: device not found" in err:
+            if "error: device not found" in str(err):
                 raise AndroidDeviceNotFound(msg)
             else:
                 raise FMBTAndroidRunError(msg)
 
-    return (exitStatus, out, err)
+_g_adbServerPort = int(os.getenv("ANDROID_ADB_SERVER_PORT", 5037))
+
+def _recvAll(sock, length):
+    data = []
+    while length > 0:
+        newData = sock.recv(length)
+        if not newData:
+            raise AndroidConnectionLost("adb server closed the connection")
+        data.append(newData)
+        length -= len(newData)
+    return "".join(data)
+
+def _adbRequest(sock, request):
+    """
+    Send request to the adb server using adb host protocol.
+    """
+    sock.sendall("%04x%s" % (len(request), request))
+    status = _recvAll(sock, 4)
+    if status == "OKAY":
+        return
+    elif status == "FAIL":
+        msg = _recvAll(sock, int(_recvAll(sock, 4), 16))
+    else:
+        msg = "unexpected response %s" % (repr(status),)
+    msg = 'adb server request "%s" failed: %s' % (request, msg)
+    if "not found" in msg:
+        raise AndroidDeviceNotFound(msg)
+    raise FMBTAndroidRunError(msg)
+
+def _adbServiceSocket(serialNumber, adbPort, service, timeout):
+    """
+    Returns socket connected to a service on the device through the
+    adb server, for instance "shell:ls".
+    """
+    sock = socket.create_connection(
+        ("127.0.0.1", adbPort or _g_adbServerPort), timeout)
+    try:
+        _adbRequest(sock, "host:transport:" + serialNumber)
+        _adbRequest(sock, service)
+    except:
+        sock.close()
+        raise
+    return sock
+
+class _AdbShellSession(object):
+    """
+    Long-lived shell on the device, connected through the adb server
+    without launching adb. Commands are run one at a time. Output of
+    each command is followed by a sentinel line with exit status,
+    after which standard error of the command is read from a
+    temporary file.
+    """
+    def __init__(self, serialNumber, adbPort):
+        self._sentinel = "fmbtandroid-%08x" % (random.getrandbits(32),)
+        self._errFilename = "/data/local/tmp/%s.err" % (self._sentinel,)
+        self._buf = ""
+        # "exec:" runs the command without a terminal, so that input
+        # is not echoed and binary output is not modified.
+        self._sock = _adbServiceSocket(serialNumber, adbPort, "exec:sh",
+                                       _SHORT_TIMEOUT)
+        try:
+            status, out, _ = self.run("echo ok", timeout=5)
+        except (socket.error, FMBTAndroidError):
+            status, out = None, None
+        if status != 0 or out != "ok\n":
+            self.close()
+            raise FMBTAndroidRunError("adb shell session not supported by %s"
+                                      % (serialNumber,))
+
+    def run(self, command, timeout=None):
+        """
+        Returns (exitStatus, stdout, stderr) of command. Raises
+        socket.timeout if the command does not finish in timeout
+        seconds, the session cannot be used after that.
+        """
+        self._sock.settimeout(timeout)
+        self._sock.sendall(
+            "( %s\n) </dev/null 2>%s; __s=$?; echo; echo %s-status $__s; "
+            "cat %s; echo; echo %s-end\n" % (
+                command, self._errFilename, self._sentinel,
+                self._errFilename, self._sentinel))
+        out = self._readUntil("\n%s-status " % (self._sentinel,))
+        status = int(self._readUntil("\n"))
+        err = self._readUntil("\n%s-end\n" % (self._sentinel,))
+        return status, out, err
+
+    def _readUntil(self, delimiter):
+        i = self._buf.find(delimiter)
+        if i >= 0:
+            data = self._buf[:i]
+            self._buf = self._buf[i + len(delimiter):]
+            return data
+        # Received data is collected to a list and joined only once
+        # the delimiter is found, large outputs are not copied on
+        # every recv. Only the end of the data that may contain the
+        # beginning of the delimiter is searched again.
+        chunks = [self._buf]
+        length = len(self._buf)
+        tailLength = len(delimiter) - 1
+        tail = self._buf[max(0, len(self._buf) - tailLength):]
+        while True:
+            newData = self._sock.recv(65536)
+            if not newData:
+                self._buf = "".join(chunks)
+                raise AndroidConnectionLost("adb shell session closed")
+            chunks.append(newData)
+            searchData = tail + newData
+            i = searchData.find(delimiter)
+            if i >= 0:
+                i += length - len(tail)
+                data = "".join(chunks)
+                self._buf = data[i + len(delimiter):]
+                return data[:i]
+            length += len(newData)
+            tail = searchData[max(0, len(searchData) - tailLength):]
+
+    def close(self):
+        try:
+            self._sock.settimeout(1)
+            self._sock.sendall("rm -f %s; exit\n" % (self._errFilename,))
+        except socket.error:
+            pass
+        try: self._sock.close()
+        except: pass
+
+class _ScreencapLoop(_AdbShellSession):
+    """
+    Resident screencap loop on the device. Every request captures a
+    new frame, which is compressed and written to the session
+    socket followed by a sentinel line. Frames are captured only
+    when requested, so a frame is never older than the request.
+    """
+    def __init__(self, serialNumber, adbPort, screencapArgs):
+        _AdbShellSession.__init__(self, serialNumber, adbPort)
+        # The loop runs without a terminal, so standard error of
+        # screencap is discarded to keep it out of the frame data.
+        self.screencapArgs = list(screencapArgs)
+        self._sock.settimeout(_SHORT_TIMEOUT)
+        self._sock.sendall(
+            "while read r; do screencap %s 2>/dev/null | gzip -1; echo; echo %s-frame; done\n" % (
+                " ".join(self.screencapArgs), self._sentinel))
+
+    def recvFrame(self, timeout):
+        """
+        Returns uncompressed screencap raw output of a new frame.
+        """
+        self._sock.settimeout(timeout)
+        self._sock.sendall("\n")
+        data = self._readUntil("\n%s-frame\n" % (self._sentinel,))
+        try:
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        except zlib.error, e:
+            raise FMBTAndroidError("invalid screencap loop frame: %s" % (e,))
+
+    def close(self):
+        # End of input ends the loop and the shell.
+        try: self._sock.close()
+        except: pass
+
+# View items are indexed by location in cells of this size.
+_g_viewGridCellSize = 64
+
+def _viewGridCell(coord):
+    return int(math.floor(coord)) / _g_viewGridCellSize
+
+def _viewItemArea(item):
+    left, top, right, bottom = item.bbox()
+    return (right - left) * (bottom - top)
+
+# Bytes per pixel of screencap raw formats.
+_g_screencapBytesPerPixel = {1: 4, 2: 4, 3: 3, 4: 2, 5: 4}
 
 _g_keyNames = set((
     "0", "1", "2", "3", "3D_MODE", "4", "5", "6", "7",
@@ -420,6 +600,7 @@ class Device(fmbtgti.GUITestInterface):
         self._fmbtAndroidHomeDir = os.getenv("FMBTANDROIDHOME", os.getcwd())
 
         self._lastView = None
+        self._incrementalView = False
         self._supportsView = None
         self._monkeyOptions = monkeyOptions
         self._lastConnectionSettings = {}
@@ -642,6 +823,7 @@ class Device(fmbtgti.GUITestInterface):
             self.platformVersion() > "4.2"):
             x1, y1 = self.intCoords((x1, y1))
             x2, y2 = self.intCoords((x2, y2))
+            self._lastInputTime = time.time()
             return self.existingConnection().sendSwipe(x1, y1, x2, y2)
         else:
             kwArgs = {}
@@ -806,6 +988,7 @@ class Device(fmbtgti.GUITestInterface):
         finger2endX = int(x + math.cos(math.radians(finger2Dir)) * endDistanceInPixels)
         finger2endY = int(y - math.sin(math.radians(finger2Dir)) * endDistanceInPixels)
 
+        self._lastInputTime = time.time()
         self.existingConnection().sendMonkeyPinchZoom(
             finger1startX, finger1startY, finger1endX, finger1endY,
             finger2startX, finger2startY, finger2endX, finger2endY,
@@ -1029,11 +1212,15 @@ class Device(fmbtgti.GUITestInterface):
             displayToScreen = self._conn._displayToScreen
         else:
             displayToScreen = None
+        if self._incrementalView:
+            previousView = self._lastView
+        else:
+            previousView = None
         if forcedView != None:
             if isinstance(forcedView, View):
                 self._lastView = forcedView
             elif type(forcedView) == str:
-                self._lastView = View(self.screenshotDir(), self.serialNumber, file(forcedView).read(), displayToScreen, self.itemOnScreen, self.intCoords)
+                self._lastView = View(self.screenshotDir(), self.serialNumber, file(forcedView).read(), displayToScreen, self.itemOnScreen, self.intCoords, self._incrementalView, previousView)
                 _adapterLog(formatErrors(self._lastView.errors(), self._lastView.filename()))
             else:
                 raise ValueError("forcedView must be a View object or a filename")
@@ -1041,10 +1228,12 @@ class Device(fmbtgti.GUITestInterface):
 
         retryCount = 0
         while True:
-            dump = self.existingConnection().recvViewData()
+            # Parse the dump while it is being received.
+            viewDir = os.path.dirname(self._newScreenshotFilepath())
+            view = View(viewDir, self.serialNumber, None, displayToScreen, self.itemOnScreen, self.intCoords, self._incrementalView, previousView)
+            dump = self.existingConnection().recvViewData(dataHandler=view._feedDump)
             if dump != None:
-                viewDir = os.path.dirname(self._newScreenshotFilepath())
-                view = View(viewDir, self.serialNumber, dump, displayToScreen, self.itemOnScreen, self.intCoords)
+                view._finishDump(dump)
             else:
                 _adapterLog("refreshView window dump reading failed")
                 view = None
@@ -1441,6 +1630,35 @@ class Device(fmbtgti.GUITestInterface):
         """
         return self._lastView
 
+    def incrementalView(self):
+        """
+        Returns True if refreshView updates views incrementally,
+        otherwise False. See setIncrementalView.
+        """
+        return self._incrementalView
+
+    def setIncrementalView(self, incremental):
+        """
+        Enable or disable incremental view refresh.
+
+        Parameters:
+
+          incremental (boolean):
+                  if True, refreshView reuses parsed lines of the
+                  previous view for unchanged parts of the window
+                  dump, and changedItems() and removedItems() of the
+                  new view list differences to the previous view.
+                  The default is False.
+
+        Example:
+            d.setIncrementalView(True)
+            d.refreshView()
+            d.tapText("Next")
+            for item in d.refreshView().changedItems():
+                print item
+        """
+        self._incrementalView = incremental
+
     def waitText(self, text, partial=False, **waitKwArgs):
         """
         Wait until text appears in any view item.
@@ -1478,6 +1696,181 @@ class Device(fmbtgti.GUITestInterface):
         if iniFile:
             self.loadConfig(iniFile, override=True, level="test")
 
+class DevicePool(object):
+    """
+    DevicePool connects to many Android devices and runs the same
+    operations on all of them in parallel threads.
+
+    Example: tap "OK" on every device in "adb devices", save
+    screenshots to per-device directories under "screenshots".
+
+    import fmbtandroid
+    pool = fmbtandroid.DevicePool(screenshotDir="screenshots")
+    pool.call("refreshScreenshot")
+    print pool.call("tapOcrText", "OK")
+    print pool.map(lambda d: d.shellSOE("getprop ro.build.id")[1])
+    """
+    def __init__(self, serialNumbers=None, adbPort=None, screenshotDir=None,
+                 maxThreads=None, **deviceArgs):
+        """
+        Connect to devices in parallel.
+
+        Parameters:
+
+          serialNumbers (list of strings, optional):
+                  serial numbers of devices in the pool. The default
+                  is all devices listed by listSerialNumbers.
+
+          adbPort (integer, optional):
+                  port of the ADB server, see Device.
+
+          screenshotDir (string, optional):
+                  screenshots of each device are saved to a
+                  subdirectory named by its serial number in
+                  screenshotDir. The default is the subdirectory of
+                  device's own screenshotDir.
+
+          maxThreads (integer, optional):
+                  maximum number of devices that run operations at the
+                  same time. The default is the number of devices.
+
+          other keyword arguments are passed to Device
+                  constructor. Do not give adbForwardPort, each device
+                  needs ports of its own.
+
+        Devices that cannot be connected are left out of the pool,
+        see failedDevices().
+        """
+        if serialNumbers == None:
+            serialNumbers = listSerialNumbers(adbPort=adbPort)
+        if adbPort != None:
+            deviceArgs["adbPort"] = adbPort
+        self._maxThreads = maxThreads
+        self._devices = {}
+        self._failedDevices = {}
+        def connect(serialNumber):
+            device = Device(serialNumber, **deviceArgs)
+            if screenshotDir != None:
+                baseDir = screenshotDir
+            else:
+                baseDir = device.screenshotDir()
+            device.setScreenshotDir(
+                baseDir + os.sep + serialNumber.replace(os.sep, "_"))
+            return device
+        results, errors = self._run(connect, serialNumbers)
+        self._serialNumbers = [sn for sn in serialNumbers if sn in results]
+        self._devices = results
+        for serialNumber, (exception, tb) in errors.iteritems():
+            _adapterLog("DevicePool: connecting to %s failed: %s" % (
+                serialNumber, exception))
+            self._failedDevices[serialNumber] = exception
+
+    def _run(self, function, serialNumbers):
+        """
+        Run function(serialNumber) for each serial number in parallel.
+        Returns pair of dictionaries (results, errors).
+        """
+        results, errors = {}, {}
+        taskQueue = Queue.Queue()
+        for serialNumber in serialNumbers:
+            taskQueue.put(serialNumber)
+        def worker():
+            while True:
+                try:
+                    serialNumber = taskQueue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[serialNumber] = function(serialNumber)
+                except Exception, e:
+                    errors[serialNumber] = (e, traceback.format_exc())
+        threadCount = min(self._maxThreads or len(serialNumbers),
+                          len(serialNumbers))
+        threads = [threading.Thread(target=worker) for _ in xrange(threadCount)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        return results, errors
+
+    def call(self, methodName, *args, **kwargs):
+        """
+        Call Device method on every device in parallel.
+
+        Parameters:
+
+          methodName (string):
+                  name of a Device method, for instance "tapText".
+
+          other parameters are passed to the method.
+
+        Returns dictionary {serialNumber: return value}. See map()
+        for handling exceptions.
+
+        Example:
+
+          pool.call("swipe", (0.5, 0.5), "east")
+        """
+        return self.map(lambda device, *a, **k: getattr(device, methodName)(*a, **k),
+                        *args, **kwargs)
+
+    def device(self, serialNumber):
+        """
+        Returns Device with the serial number.
+        """
+        return self._devices[serialNumber]
+
+    def devices(self):
+        """
+        Returns list of Devices in the pool.
+        """
+        return [self._devices[sn] for sn in self._serialNumbers]
+
+    def failedDevices(self):
+        """
+        Returns dictionary {serialNumber: exception} of devices that
+        could not be connected.
+        """
+        return dict(self._failedDevices)
+
+    def map(self, function, *args, **kwargs):
+        """
+        Call function(device, *args, **kwargs) for every device in
+        parallel.
+
+        Returns dictionary {serialNumber: return value}. If function
+        raises an exception on any device, DevicePoolError is raised
+        after all calls have finished. Its results() and errors()
+        contain return values and exceptions of all devices.
+        """
+        results, errors = self._run(
+            lambda sn: function(self._devices[sn], *args, **kwargs),
+            self._serialNumbers)
+        if errors:
+            raise DevicePoolError(results, errors)
+        return results
+
+    def serialNumbers(self):
+        """
+        Returns serial numbers of devices in the pool.
+        """
+        return list(self._serialNumbers)
+
+    def setMaxThreads(self, maxThreads):
+        """
+        Set maximum number of devices that run operations at the same
+        time. None means no limit.
+        """
+        self._maxThreads = maxThreads
+
+    def maxThreads(self):
+        """
+        Returns maximum number of devices that run operations at the
+        same time, see setMaxThreads().
+        """
+        return self._maxThreads
+
 class Ini:
     """
     Container for device configuration loaded from INI files.
@@ -1605,6 +1998,8 @@ class ViewItem(fmbtgti.GUIItem):
     """
     ViewItem holds the information of a single GUI element.
     """
+    __slots__ = ("_p", "_parent", "_className", "_code", "_indent",
+                 "_children", "_parentsVisible", "_rawProps", "_childOffset")
     def __init__(self, className, code, indent, properties, parent, rawProps, dumpFilename, displayToScreen):
         self._p = properties
         self._parent = parent
@@ -1614,6 +2009,7 @@ class ViewItem(fmbtgti.GUIItem):
         self._children = []
         self._parentsVisible = True
         self._rawProps = ""
+        self._childOffset = None
         if not "scrolling:mScrollX" in self._p:
             self._p["scrolling:mScrollX"] = 0
             self._p["scrolling:mScrollY"] = 0
@@ -1628,12 +2024,10 @@ class ViewItem(fmbtgti.GUIItem):
         elif "layout:mLeft" in self._p:
             left = int(self._p["layout:mLeft"])
             top = int(self._p["layout:mTop"])
-            parent = self._parent
-            while parent:
-                pp = parent._p
-                left += int(pp["layout:mLeft"]) - int(pp["scrolling:mScrollX"])
-                top += int(pp["layout:mTop"]) - int(pp["scrolling:mScrollY"])
-                parent = parent._parent
+            if self._parent:
+                offsetX, offsetY = self._parent._offsetOfChildren()
+                left += offsetX
+                top += offsetY
         else:
             raise ValueError("bounding box not found, layout fields missing")
         height = int(self._p["layout:getHeight()"])
@@ -1641,6 +2035,20 @@ class ViewItem(fmbtgti.GUIItem):
         screenLeft, screenTop = displayToScreen(left, top)
         screenRight, screenBottom = displayToScreen(left + width, top + height)
         return (screenLeft, screenTop, screenRight, screenBottom)
+    def _offsetOfChildren(self):
+        """
+        Returns position of children's layout origin on display.
+        """
+        if self._childOffset == None:
+            pp = self._p
+            x = int(pp["layout:mLeft"]) - int(pp["scrolling:mScrollX"])
+            y = int(pp["layout:mTop"]) - int(pp["scrolling:mScrollY"])
+            if self._parent:
+                parentX, parentY = self._parent._offsetOfChildren()
+                x += parentX
+                y += parentY
+            self._childOffset = (x, y)
+        return self._childOffset
     def children(self):   return self._children
     def className(self):  return self._className
     def code(self):       return self._code
@@ -1676,9 +2084,15 @@ class View(object):
     View provides interface to screen dumps from Android. It parses
     the dump to a hierarchy of ViewItems. find* methods enable searching
     for ViewItems based on their properties.
+
+    An incremental View remembers its parsed dump lines. A View that
+    is given a previousView parses only lines that differ from the
+    previous dump, and tells which items have been changed and
+    removed since the previous view.
     """
     def __init__(self, screenshotDir, serialNumber, dump, displayToScreen=None,
-                 itemOnScreen=None, intCoords=None):
+                 itemOnScreen=None, intCoords=None, incremental=False,
+                 previousView=None):
         self.screenshotDir = screenshotDir
         self.serialNumber = serialNumber
         self._viewItems = []
@@ -1686,24 +2100,96 @@ class View(object):
         self._lineRegEx = re.compile("(?P<indent>\s*)(?P<class>[\w.$]+)@(?P<id>[0-9A-Fa-f]{4,8} )(?P<properties>.*)")
         self._olderAndroidLineRegEx = re.compile("(?P<indent>\s*)(?P<class>[\w.$]+)@(?P<id>\w)(?P<properties>.*)")
         self._propRegEx = re.compile("(?P<prop>(?P<name>[^=]+)=(?P<len>\d+),)(?P<data>[^\s]* ?)")
-        self._dump = dump
+        self._dump = None
         self._rawDumpFilename = self.screenshotDir + os.sep + fmbtgti._filenameTimestamp() + "-" + self.serialNumber + ".view"
-        file(self._rawDumpFilename, "w").write(self._dump)
         if displayToScreen == None:
             displayToScreen = lambda x, y: (x, y)
+        self._displayToScreen = displayToScreen
         if itemOnScreen == None:
             itemOnScreen = lambda item: True
         self._itemOnScreen = itemOnScreen
         if intCoords == None:
-            intCoords = lambda x, y: (int(x), int(y))
+            intCoords = lambda pos: (int(pos[0]), int(pos[1]))
         self._intCoords = intCoords
+        self._incremental = incremental or previousView != None
+        self._previousView = previousView
+        if previousView != None:
+            self._previousLines = previousView._parsedLines
+        else:
+            self._previousLines = {}
+        self._changedItems = None
+        self._removedItems = None
+        self._digests = None
+        self._resetParser()
+        if dump != None:
+            # If dump is None, it will be given with _feedDump() and
+            # _finishDump() while it is being received.
+            self._feedDump(dump)
+            self._finishDump(dump)
+
+    def _resetParser(self):
+        self._viewItems = []
+        self._errors = []
+        self._parseParent = None
+        self._parseIndent = 0
+        self._parseLineIndex = 0
+        self._parsePending = ""
+        self._parseDone = False
+        self._parseFailed = False
+        self.TOP_PAGED_VIEW = ""
+        self._indexes = None
+        self._parsedLines = {}
+
+    def _feedDump(self, data):
+        """
+        Parse next part of the dump. data == None restarts parsing.
+        """
+        if data == None:
+            self._resetParser()
+            return
+        if self._parseDone or self._parseFailed:
+            return
+        lines = (self._parsePending + data).split("\n")
+        self._parsePending = lines.pop()
         try:
-            self._parseDump(dump, self._rawDumpFilename, displayToScreen)
+            for line in lines:
+                self._parseDumpLine(line)
+                if self._parseDone:
+                    break
         except Exception, e:
+            self._parseFailed = True
             self._errors.append((-1, "", "Parser error"))
 
+    def _finishDump(self, dump):
+        """
+        Parse the rest of the dump and save the whole dump.
+        """
+        if self._parsePending and not self._parseDone:
+            line, self._parsePending = self._parsePending, ""
+            self._feedDump(line + "\n")
+        self._dump = dump
+        file(self._rawDumpFilename, "w").write(self._dump)
+        if self._previousView != None:
+            self._changedItems = self._itemsNotIn(self._previousView)
+            self._removedItems = self._previousView._itemsNotIn(self)
+            # Do not keep a chain of all earlier views in memory.
+            self._previousView = None
+            self._previousLines = {}
+
     def viewItems(self): return self._viewItems
     def errors(self): return self._errors
+    def changedItems(self):
+        """
+        Returns list of items that are new or have changed since the
+        previous view, or None if the view has no previous view.
+        """
+        return self._changedItems
+    def removedItems(self):
+        """
+        Returns list of items in the previous view that are not in
+        this view, or None if the view has no previous view.
+        """
+        return self._removedItems
     def dumpRaw(self): return self._dump
     def dumpItems(self, itemList = None):
         if itemList == None: itemList = self._viewItems
@@ -1736,6 +2222,105 @@ class View(object):
     def filename(self):
         return self._rawDumpFilename
 
+    def _buildIndexes(self):
+        """
+        Index view items by id, text, class and location. Lists of
+        indexed items are in the same order as viewItems().
+        """
+        ids, texts, classes, cells, largeItems = {}, {}, {}, {}, []
+        positions = {}
+        for position, item in enumerate(self._viewItems):
+            positions[id(item)] = position
+            ids.setdefault(item._p.get("mID", ""), []).append(item)
+            if "text:mText" in item._p:
+                texts.setdefault(item._p["text:mText"], []).append(item)
+            classes.setdefault(item._className, []).append(item)
+            left, top, right, bottom = [_viewGridCell(c) for c in item.bbox()]
+            if right < left or bottom < top:
+                continue
+            if (right - left + 1) * (bottom - top + 1) > 1024:
+                largeItems.append(item)
+                continue
+            for cellX in xrange(left, right + 1):
+                for cellY in xrange(top, bottom + 1):
+                    cells.setdefault((cellX, cellY), []).append(item)
+        self._indexes = {"id": ids, "text": texts, "class": classes,
+                         "cells": cells, "large": largeItems,
+                         "positions": positions}
+
+    def _itemDigests(self):
+        """
+        Returns item and subtree content digests (SHA-1), lists are
+        in the order of viewItems().
+        """
+        if self._digests == None:
+            positions = dict([(id(item), position) for position, item
+                              in enumerate(self._viewItems)])
+            itemDigests = [None] * len(self._viewItems)
+            subtreeDigests = [None] * len(self._viewItems)
+            # Children are always listed after their parent.
+            for position in xrange(len(self._viewItems) - 1, -1, -1):
+                item = self._viewItems[position]
+                itemDigests[position] = hashlib.sha1(repr((
+                    item._className, item._code, item.bbox(),
+                    tuple(sorted(item._p.iteritems()))))).digest()
+                subtreeDigests[position] = hashlib.sha1(repr((
+                    itemDigests[position],
+                    tuple([subtreeDigests[positions[id(child)]]
+                           for child in item._children])))).digest()
+            self._digests = (itemDigests, subtreeDigests, positions)
+        return self._digests
+
+    def _itemsNotIn(self, otherView):
+        """
+        Returns items that have no equal item in otherView. Subtrees
+        found in otherView as such are skipped.
+        """
+        otherItemDigests, otherSubtreeDigests = [
+            set(digests) for digests in otherView._itemDigests()[:2]]
+        itemDigests, subtreeDigests, positions = self._itemDigests()
+        items = []
+        stack = [item for item in reversed(self._viewItems)
+                 if item._parent == None]
+        while stack:
+            item = stack.pop()
+            position = positions[id(item)]
+            if subtreeDigests[position] in otherSubtreeDigests:
+                continue
+            if not itemDigests[position] in otherItemDigests:
+                items.append(item)
+            stack.extend(reversed(item._children))
+        return items
+
+    def _index(self, name):
+        if self._indexes == None:
+            self._buildIndexes()
+        return self._indexes[name]
+
+    def _indexedItems(self, itemLists):
+        """
+        Returns items in itemLists in the order of viewItems(),
+        without duplicates.
+        """
+        if len(itemLists) == 1:
+            return itemLists[0]
+        positions = self._index("positions")
+        items = {}
+        for itemList in itemLists:
+            for item in itemList:
+                items[positions[id(item)]] = item
+        return [items[position] for position in sorted(items)]
+
+    def _itemsInCells(self, left, top, right, bottom):
+        cells = self._index("cells")
+        itemLists = [self._index("large")]
+        left, top, right, bottom = [_viewGridCell(c) for c in (left, top, right, bottom)]
+        for cellX in xrange(left, right + 1):
+            for cellY in xrange(top, bottom + 1):
+                if (cellX, cellY) in cells:
+                    itemLists.append(cells[(cellX, cellY)])
+        return self._indexedItems(itemLists)
+
     def findItems(self, comparator, count=-1, searchRootItem=None, searchItems=None, onScreen=False):
         """
         Returns list of ViewItems to which comparator returns True.
@@ -1764,12 +2349,16 @@ class View(object):
         if count == 0: return foundItems
         if searchRootItem != None:
             # find from searchRootItem and its children
-            if comparator(searchRootItem) and (
-                    not onScreen or
-                    searchRootItem.visibleBranch() and self._itemOnScreen(searchRootItem)):
-                foundItems.append(searchRootItem)
-            for c in searchRootItem.children():
-                foundItems.extend(self.findItems(comparator, count=count-len(foundItems), searchRootItem=c, onScreen=onScreen))
+            stack = [searchRootItem]
+            while stack:
+                i = stack.pop()
+                if comparator(i) and (
+                        not onScreen or
+                        i.visibleBranch() and self._itemOnScreen(i)):
+                    foundItems.append(i)
+                    if count > 0 and len(foundItems) >= count:
+                        break
+                stack.extend(reversed(i.children()))
         else:
             if searchItems != None:
                 # find from listed items only
@@ -1796,6 +2385,13 @@ class View(object):
         else:
             c = lambda item: (
                 item.properties().get("text:mText", None) == text )
+        if searchRootItem == None and searchItems == None:
+            texts = self._index("text")
+            if not partial:
+                searchItems = texts.get(text, [])
+            elif text != "":
+                searchItems = self._indexedItems(
+                    [texts[t] for t in texts if t.find(text) != -1] or [[]])
         return self.findItems(c, count=count, searchRootItem=searchRootItem, searchItems=searchItems, onScreen=onScreen)
 
     def findItemsById(self, id, count=-1, searchRootItem=None, searchItems=None, onScreen=False):
@@ -1803,6 +2399,8 @@ class View(object):
         Returns list of ViewItems with given id.
         """
         c = lambda item: item.properties().get("mID", "") == id
+        if searchRootItem == None and searchItems == None:
+            searchItems = self._index("id").get(id, [])
         return self.findItems(c, count=count, searchRootItem=searchRootItem, searchItems=searchItems, onScreen=onScreen)
 
     def findItemsByClass(self, className, partial=True, count=-1, searchRootItem=None, searchItems=None, onScreen=False):
@@ -1811,6 +2409,13 @@ class View(object):
         """
         if partial: c = lambda item: item.className().find(className) != -1
         else: c = lambda item: item.className() == className
+        if searchRootItem == None and searchItems == None:
+            classes = self._index("class")
+            if partial:
+                searchItems = self._indexedItems(
+                    [classes[cn] for cn in classes if cn.find(className) != -1] or [[]])
+            else:
+                searchItems = classes.get(className, [])
         return self.findItems(c, count=count, searchRootItem=searchRootItem, searchItems=searchItems, onScreen=onScreen)
 
     def findItemsByIdAndClass(self, id, className, partial=True, count=-1, searchRootItem=None, searchItems=None, onScreen=False):
@@ -1842,10 +2447,11 @@ class View(object):
         """
         x, y = self._intCoords(pos)
         c = lambda item: (item.bbox()[0] <= x <= item.bbox()[2] and item.bbox()[1] <= y <= item.bbox()[3])
+        if searchRootItem == None and searchItems == None:
+            searchItems = self._itemsInCells(x, y, x, y)
         items = self.findItems(c, count=count, searchRootItem=searchRootItem, searchItems=searchItems, onScreen=onScreen)
         # sort from smallest to greatest area
-        area_items = [((i.bbox()[2] - i.bbox()[0]) * (i.bbox()[3] - i.bbox()[1]), i) for i in items]
-        return [i for _, i in sorted(area_items)]
+        return sorted(items, key=_viewItemArea)
 
     def findItemsInRegion(self, bbox, count=-1, searchRootItem=None, searchItems=None, onScreen=False):
         """
@@ -1865,10 +2471,11 @@ class View(object):
         right, bottom = self._intCoords((bbox[2], bbox[3]))
         c = lambda item: (left <= item.bbox()[0] <= item.bbox()[2] <= right and
                           top <= item.bbox()[1] <= item.bbox()[3] <= bottom)
+        if searchRootItem == None and searchItems == None and left <= right and top <= bottom:
+            searchItems = self._itemsInCells(left, top, right, bottom)
         items = self.findItems(c, count=count, searchRootItem=searchRootItem,
                                searchItems=searchItems, onScreen=onScreen)
-        area_items = [((i.bbox()[2] - i.bbox()[0]) * (i.bbox()[3] - i.bbox()[1]), i) for i in items]
-        return [i for _, i in sorted(area_items)]
+        return sorted(items, key=_viewItemArea)
 
     def save(self, fileOrDirName):
         """
@@ -1880,109 +2487,131 @@ class View(object):
         """
         Process the raw dump data and create a tree of ViewItems
         """
-        if not isinstance(dump, unicode):
-            try:
-                dump = unicode(dump, "utf-8")
-            except UnicodeDecodeError, e:
-                self._errors.append((0, 0, "converting to unicode failed: %s" % (e,)))
+        self._rawDumpFilename = rawDumpFilename
+        self._displayToScreen = displayToScreen
+        self._resetParser()
+        self._feedDump(dump)
+        if self._parsePending and not self._parseDone:
+            self._feedDump("\n")
+        return self._viewItems
+
+    def _parseDumpLine(self, line):
+        """
+        Process a line of the raw dump and add its ViewItem to the tree
+        """
         # This code originates from tema-android-adapter-3.2,
         # AndroidAdapter/guireader.py.
-        self._viewItems = []
-        cellLayout = ""
+        lineIndex = self._parseLineIndex
+        self._parseLineIndex += 1
+        if line.endswith("\r"):
+            line = line[:-1]
+        parsedLine = self._previousLines.get(line, None)
+        if parsedLine != None:
+            # Unchanged line from the previous view, skip parsing.
+            className, code, indent, properties = parsedLine
+            self._addViewItem(lineIndex, line, className, code, indent,
+                              dict(properties))
+            if self._incremental:
+                self._parsedLines[line] = parsedLine
+            return
+        rawLine = line
+        errorCount = len(self._errors)
+        if not isinstance(line, unicode):
+            try:
+                line = unicode(line, "utf-8")
+            except UnicodeDecodeError, e:
+                self._errors.append((lineIndex + 1, 0, "converting to unicode failed: %s" % (e,)))
 
-        parent = None
-        previousItem = None
-        currentIndent = 0
-        visible = True
-        self.TOP_PAGED_VIEW = ""
-        last_line = set(["DONE", "DONE."])
+        if line == "DONE" or line == "DONE.":
+            self._parseDone = True
+            return
+
+        # separate indent, class and properties for each GUI object
+        # TODO: branch here according to self._androidVersion
+        matcher = self._lineRegEx.match(line)
 
-        for lineIndex, line in enumerate(dump.splitlines()):
-            if line in last_line:
+        if not matcher:
+            # FIXME: this hack falls back to old format,
+            # should branch according to self._androidVersion!
+            matcher = self._olderAndroidLineRegEx.match(line)
+            if not matcher:
+                self._errors.append((lineIndex + 1, line, "illegal line"))
+                return # skip this line
+
+        # Indent specifies the hierarchy level of the object
+        indent = len(matcher.group("indent"))
+
+        propertiesData = matcher.group("properties")
+        propertiesEnd = len(propertiesData) - 1
+        properties = {}
+        index = 0
+
+        # Process the properties of each GUI object. Properties are
+        # matched in place, slicing the rest of the line for every
+        # property would be quadratic.
+        while index < len(propertiesData):
+            # Separate name and value for each property [^=]*=
+            propMatch = self._propRegEx.match(propertiesData, index, max(index, propertiesEnd))
+            if not propMatch:
+                self._errors.append((lineIndex, line,
+                                     "property parse error"))
                 break
 
-            # separate indent, class and properties for each GUI object
-            # TODO: branch here according to self._androidVersion
-            matcher = self._lineRegEx.match(line)
+            name = propMatch.group("name")
+            if not name:
+                self._errors.append(
+                    (lineIndex, line,
+                     'illegal property name "%s"' % (name,)))
+                break
 
-            if not matcher:
-                # FIXME: this hack falls back to old format,
-                # should branch according to self._androidVersion!
-                matcher = self._olderAndroidLineRegEx.match(line)
-                if not matcher:
-                    self._errors.append((lineIndex + 1, line, "illegal line"))
-                    continue # skip this line
-
-            className = matcher.group("class")
-
-            # Indent specifies the hierarchy level of the object
-            indent = len(matcher.group("indent"))
-
-            # If the indent is bigger that previous, this object is a
-            # child for the previous object
-            if indent > currentIndent:
-                parent = self._viewItems[-1]
-
-            elif indent < currentIndent:
-                for tmp in range(0, currentIndent - indent):
-                    parent = parent.parent()
-
-            currentIndent = indent
-
-            propertiesData = matcher.group("properties")
-            properties = {}
-            index = 0
-
-            x = 0
-            y = 0
-
-            # Process the properties of each GUI object
-            while index < len(propertiesData):
-                # Separate name and value for each property [^=]*=
-                propMatch = self._propRegEx.match(propertiesData[index:-1])
-                if not propMatch:
-                    self._errors.append((lineIndex, line,
-                                         "property parse error"))
-                    break
+            try:
+                dataLength = int(propMatch.group("len"))
+            except ValueError:
+                self._errors.append(
+                    (lineIndex, line,
+                     'illegal length (int) "%s"' % (propMatch.group("len"),)))
+                break
 
-                name = propMatch.group("name")
-                if not name:
-                    self._errors.append(
-                        (lineIndex, line,
-                         'illegal property name "%s"' % (name,)))
-                    break
+            data = propMatch.group("data")
+            dataStart = propMatch.start("data")
 
-                try:
-                    dataLength = int(propMatch.group("len"))
-                except ValueError:
+            if len(data) < dataLength:
+                if not data:
                     self._errors.append(
                         (lineIndex, line,
-                         'illegal length (int) "%s"' % (propMatch.group("len"),)))
+                         'property "%s": data missing, expected %s, got %s' % (name, dataLength, len(data))))
                     break
 
-                data = propMatch.group("data")
-                dataStart = index + propMatch.start("data")
+            properties[name] = propertiesData[dataStart:dataStart + dataLength]
+            index = dataStart + dataLength + 1
 
-                if len(data) < dataLength:
-                    if not data:
-                        self._errors.append(
-                            (lineIndex, line,
-                             'property "%s": data missing, expected %s' % (name, dataLength, len(data))))
-                        break
+        className, code = matcher.group("class"), matcher.group("id")
+        if self._incremental and len(self._errors) == errorCount:
+            self._parsedLines[rawLine] = (className, code, indent, dict(properties))
+        self._addViewItem(lineIndex, line, className, code, indent, properties)
 
-                properties[name] = propertiesData[dataStart:dataStart + dataLength]
-                index = dataStart + dataLength + 1
+    def _addViewItem(self, lineIndex, line, className, code, indent, properties):
+        # If the indent is bigger that previous, this object is a
+        # child for the previous object
+        if indent > self._parseIndent:
+            self._parseParent = self._viewItems[-1]
 
-            try:
-                vi = ViewItem(matcher.group("class"), matcher.group("id"), indent, properties, parent, matcher.group("properties"), self._rawDumpFilename, displayToScreen)
-                self._viewItems.append(vi)
-                if parent:
-                    parent.addChild(self._viewItems[-1])
-            except Exception, e:
-                self._errors.append(
-                    (lineIndex, line,
-                     "creating view item failed (%s: %s)" % (type(e), e)))
-        return self._viewItems
+        elif indent < self._parseIndent:
+            for tmp in xrange(0, self._parseIndent - indent):
+                self._parseParent = self._parseParent.parent()
+
+        self._parseIndent = indent
+        parent = self._parseParent
+
+        try:
+            vi = ViewItem(className, code, indent, properties, parent, "", self._rawDumpFilename, self._displayToScreen)
+            self._viewItems.append(vi)
+            if parent:
+                parent.addChild(vi)
+        except Exception, e:
+            self._errors.append(
+                (lineIndex, line,
+                 "creating view item failed (%s: %s)" % (type(e), e)))
 
     def __str__(self):
         return 'View(items=%s, dump="%s")' % (
@@ -1995,20 +2624,33 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
     """
     _m_host = os.getenv("FMBTANDROID_ADB_FORWARD_HOST", 'localhost')
     _m_port = int(os.getenv("FMBTANDROID_ADB_FORWARD_PORT", random.randint(20000, 29999)))
+    _m_portLock = threading.Lock()
     _w_host = _m_host
 
     def __init__(self, serialNumber, **kwArgs):
         fmbtgti.GUITestConnection.__init__(self)
         self._serialNumber = serialNumber
         self._adbPort = kwArgs.pop("adbPort", None)
-        self._monkeyPortForward = kwArgs.pop(
-            "adbForwardPort", _AndroidDeviceConnection._m_port)
+        _AndroidDeviceConnection._m_portLock.acquire()
+        try:
+            defaultPort = _AndroidDeviceConnection._m_port
+            # Next _AndroidDeviceConnection instance will use different ports
+            _AndroidDeviceConnection._m_port += 100
+        finally:
+            _AndroidDeviceConnection._m_portLock.release()
+        self._monkeyPortForward = kwArgs.pop("adbForwardPort", defaultPort)
         self._windowPortForward = kwArgs.pop(
             "windowPortForward", self._monkeyPortForward + 1)
         self._stopOnError = kwArgs.pop("stopOnError", True)
         self._monkeyOptions = kwArgs.pop("monkeyOptions", [])
         self._screencapArgs = kwArgs.pop("screencapArgs", [])
         self._screencapFormat = kwArgs.pop("screencapFormat", "raw")
+        self._useShellSessions = kwArgs.pop("useShellSessions", True)
+        self._screencapLoop = None
+        self._useScreencapLoop = kwArgs.pop("useScreencapLoop", True)
+        self._screencapLoopLock = threading.Lock()
+        self._shellSessions = [] # idle _AdbShellSessions
+        self._shellSessionsLock = threading.Lock()
         self.setScreenToDisplayCoords(
             kwArgs.pop("screenToDisplay", lambda x, y: (x, y)))
         self.setDisplayToScreenCoords(
@@ -2020,19 +2662,18 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
         self._detectFeatures()
         self._emulatorSocket = None
-        try:
-            self._resetMonkey()
-            self._resetWindow()
-
-        finally:
-            # Next _AndroidDeviceConnection instance will use different ports
-            _AndroidDeviceConnection._m_port += 100
+        self._resetMonkey()
+        self._resetWindow()
 
     def __del__(self):
         try: self._monkeySocket.close()
         except: pass
         try: self._emulatorSocket.close()
         except: pass
+        try: self._closeShellSessions()
+        except: pass
+        try: self._screencapLoop.close()
+        except: pass
 
     def settings(self):
         """Returns restorable property values"""
@@ -2043,6 +2684,8 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
             "monkeyOptions": self._monkeyOptions,
             "screencapArgs": self._screencapArgs,
             "screencapFormat": self._screencapFormat,
+            "useShellSessions": self._useShellSessions,
+            "useScreencapLoop": self._useScreencapLoop,
             "screenToDisplay": self._screenToDisplay,
             "displayToScreen": self._displayToScreen,
         }
@@ -2051,7 +2694,98 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
     def target(self):
         return self._serialNumber
 
+    def useShellSessions(self):
+        """
+        Returns True if shell commands are run in long-lived shell
+        sessions.
+        """
+        return self._useShellSessions
+
+    def setUseShellSessions(self, useShellSessions):
+        """
+        Run shell commands in long-lived shell sessions connected
+        through the adb server, instead of launching "adb shell" for
+        every command.
+
+        Parameters:
+
+          useShellSessions (boolean):
+                  if True, shell sessions are used when the device
+                  supports them (Android 5.0 and later). Otherwise
+                  adb is launched for every command. The default is
+                  True.
+
+        Sessions are used by shellSOE and internal queries such as
+        dumpsys. Device.shell and commands that change the device
+        state launch "adb shell" as before, because "adb shell"
+        merges standard error to standard output and does not report
+        exit status on all devices.
+        """
+        self._useShellSessions = useShellSessions
+        if not useShellSessions:
+            self._closeShellSessions()
+
+    def _closeShellSessions(self):
+        self._shellSessionsLock.acquire()
+        try:
+            sessions = self._shellSessions
+            self._shellSessions = []
+        finally:
+            self._shellSessionsLock.release()
+        for session in sessions:
+            session.close()
+
+    def _acquireShellSession(self):
+        self._shellSessionsLock.acquire()
+        try:
+            if self._shellSessions:
+                return self._shellSessions.pop()
+        finally:
+            self._shellSessionsLock.release()
+        if not self._useShellSessions:
+            return None
+        try:
+            return _AdbShellSession(self._serialNumber, self._adbPort)
+        except (socket.error, FMBTAndroidError), e:
+            _adapterLog("adb shell sessions disabled: %s" % (e,))
+            self._useShellSessions = False
+            return None
+
+    def _releaseShellSession(self, session):
+        self._shellSessionsLock.acquire()
+        try:
+            self._shellSessions.append(session)
+        finally:
+            self._shellSessionsLock.release()
+
+    def _runShellSession(self, shellCommand, timeout=None):
+        """
+        Run shellCommand in a shell session. Returns (exitStatus,
+        stdout, stderr), exit status is 124 on timeout. Returns None
+        if shell sessions are not available.
+        """
+        if not self._useShellSessions:
+            return None
+        session = self._acquireShellSession()
+        if session == None:
+            return None
+        try:
+            result = session.run(shellCommand, timeout)
+        except socket.timeout:
+            session.close()
+            return (124, "", "") # like timeout(1)
+        except (socket.error, FMBTAndroidError), e:
+            session.close()
+            _adapterLog('adb shell session failed on "%s": %s' % (shellCommand, e))
+            return None
+        self._releaseShellSession(session)
+        return result
+
     def _cat(self, remoteFilename):
+        result = self._runShellSession("cat '%s'" % (remoteFilename,),
+                                       timeout=_LONG_TIMEOUT)
+        if result != None and result[0] == 0:
+            return result[1]
         fd, filename = tempfile.mkstemp("fmbtandroid-cat-")
         os.close(fd)
         self._runAdb(["pull", remoteFilename, filename], 0, timeout=_LONG_TIMEOUT)
@@ -2059,7 +2793,17 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         os.remove(filename)
         return contents
 
-    def _runAdb(self, adbCommand, expectedExitStatus=0, timeout=None):
+    def _runAdb(self, adbCommand, expectedExitStatus=0, timeout=None,
+                useSession=False):
+        """
+        Run adb command, returns (exitStatus, stdout, stderr).
+
+        If useSession is True, a waited shell command is run in a
+        shell session when available. Unlike "adb shell" on older
+        devices, shell sessions report the real exit status of the
+        command and keep standard error separate from standard
+        output. Use it only for commands whose callers handle that.
+        """
         if not self._stopOnError:
             expect = None
         else:
@@ -2073,6 +2817,16 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
             command.extend(adbCommand)
         else:
             command.append(adbCommand)
+        if (useSession and
+            type(adbCommand) in [list, tuple] and len(adbCommand) > 1 and
+            adbCommand[0] == "shell" and
+            (expect != None or timeout != None)):
+            # Commands that are waited for can be run in a shell
+            # session without launching adb.
+            result = self._runShellSession(" ".join(adbCommand[1:]), timeout)
+            if result != None:
+                _checkExitStatus(command, result[0], result[1], result[2], expect)
+                return result
         return _run(command, expectedExitStatus=expect, timeout=timeout)
 
     def _emulatorCommand(self, command):
@@ -2112,28 +2866,31 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
     def _detectFeatures(self):
         # check supported features
         outputLines = self._runAdb(["shell", "getprop", "ro.build.version.release"],
-                                   timeout=_SHORT_TIMEOUT)[1].splitlines()
+                                   timeout=_SHORT_TIMEOUT, useSession=True)[1].splitlines()
         if len(outputLines) >= 1:
             self._platformVersion = outputLines[0].strip().split("=")[-1]
         else:
             self._platformVersion = "N/A"
 
         outputLines = self._runAdb(["shell", "id"],
-                                   timeout=_SHORT_TIMEOUT)[1].splitlines()
+                                   timeout=_SHORT_TIMEOUT, useSession=True)[1].splitlines()
         if len(outputLines) == 1 and "uid=0" in outputLines[0]:
             self._shellUid0 = True
         else:
             self._shellUid0 = False
 
-        outputLines = self._runAdb(["shell", "su", "root", "id"],
-                                   timeout=_SHORT_TIMEOUT)[1].splitlines()
+        outputLines = self._runAdb(["shell", "su", "root", "id"], None,
+                                   timeout=_SHORT_TIMEOUT, useSession=True)[1].splitlines()
         if len(outputLines) == 1 and "uid=0" in outputLines[0]:
             self._shellSupportsSu = True
         else:
             self._shellSupportsSu = False
 
-        outputLines = self._runAdb(["shell", "tar"],
-                                   timeout=_SHORT_TIMEOUT)[1].splitlines()
+        # Error messages are in stdout with "adb shell", but in
+        # stderr in shell sessions.
+        _, out, err = self._runAdb(["shell", "tar"], None,
+                                   timeout=_SHORT_TIMEOUT, useSession=True)
+        outputLines = (out + (err or "")).splitlines()
         if len(outputLines) == 1 and "bin" in outputLines[0]:
             self._shellSupportsTar = False
         else:
@@ -2174,6 +2931,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
                 self._monkeySocket.connect((self._m_host, self._monkeyPortForward))
                 self._monkeySocket.setblocking(0)
                 self._monkeySocket.settimeout(5.0)
+                self._monkeyData = ""
                 _ping = self._monkeyCommand("getvar build.version.release", retry=0)[1]
                 if len(_ping) > 0:
                     return True
@@ -2209,26 +2967,53 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
             return False
 
     def _monkeyCommand(self, command, retry=3):
+        return self._monkeyCommands([command], retry)[0]
+
+    def _monkeyCommands(self, monkeyCommands, retry=3):
+        """
+        Sends all commands to monkey before reading responses to
+        them. "sleep MILLISECONDS" commands keep timing between
+        events on the device.
+
+        Returns list of (success, value) pairs, one for each command.
+        """
+        if not monkeyCommands:
+            return []
+        results = []
+        sleepTimes = [int(c[6:]) / 1000.0 for c in monkeyCommands if c.startswith("sleep ")]
         try:
-            self._monkeySocket.sendall(command + "\n")
-            data = self._monkeySocket.recv(4096).strip()
-            if len(data) == 0 and retry > 0:
-                return self._monkeyCommand(command, retry-1)
-            if data == "OK":
-                return True, None
-            elif data.startswith("OK:"):
-                return True, data.split("OK:")[1]
-            _adapterLog("monkeyCommand failing... command: '%s' response: '%s'" % (command, data))
-            return False, None
+            if sleepTimes:
+                self._monkeySocket.settimeout(5.0 + max(sleepTimes))
+            self._monkeySocket.sendall("".join([c + "\n" for c in monkeyCommands]))
+            while len(results) < len(monkeyCommands):
+                while not "\n" in self._monkeyData:
+                    data = self._monkeySocket.recv(4096)
+                    if not data:
+                        raise socket.error("monkey closed the connection")
+                    self._monkeyData += data
+                data, self._monkeyData = self._monkeyData.split("\n", 1)
+                data = data.strip()
+                if data == "":
+                    continue
+                elif data == "OK":
+                    results.append((True, None))
+                elif data.startswith("OK:"):
+                    results.append((True, data.split("OK:")[1]))
+                else:
+                    _adapterLog("monkeyCommand failing... command: '%s' response: '%s'" % (monkeyCommands[len(results)], data))
+                    results.append((False, None))
+            if sleepTimes:
+                self._monkeySocket.settimeout(5.0)
+            return results
         except socket.error:
             try: self._monkeySocket.close()
             except: pass
 
             if retry > 0:
                 self._resetMonkey()
-                return self._monkeyCommand(command, retry=retry-1)
+                return results + self._monkeyCommands(monkeyCommands[len(results):], retry=retry-1)
             else:
-                raise AndroidConnectionError('Android monkey socket connection lost while sending command "%s"' % (command,))
+                raise AndroidConnectionError('Android monkey socket connection lost while sending command "%s"' % (monkeyCommands[len(results)],))
 
     def install(self, filename, lock, reinstall, downgrade,
                 sdcard, algo, key, iv):
@@ -2267,7 +3052,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def pkill(self, pattern, signal=15, exact=False):
         """send signal to all processes where process name contains pattern"""
-        _, ps, _ = self._runAdb(["shell", "ps"], timeout=_SHORT_TIMEOUT)
+        _, ps, _ = self._runAdb(["shell", "ps"], timeout=_SHORT_TIMEOUT, useSession=True)
         if self._shellSupportsSu:
             shell_kill = ["shell", "su", "root", "kill"]
         else:
@@ -2334,7 +3119,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvScreenSize(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "display"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         try:
             # parse default display properties
             ddName, ddWidth, ddHeight, ddWdpi, ddHdpi = re.findall(
@@ -2348,7 +3133,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvDefaultViewportSize(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "display"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         try:
             w, h = re.findall("mDefaultViewport=DisplayViewport\{.*deviceWidth=([0-9]*), deviceHeight=([0-9]*)\}", output)[0]
             width = int(w)
@@ -2361,7 +3146,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvCurrentDisplayOrientation(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "display"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         s = re.findall("mCurrentOrientation=([0-9])", output)
         if s:
             return int(s[0])
@@ -2370,7 +3155,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvDisplayPowered(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "power"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         s = re.findall("Display Power: state=(OFF|ON)", output)
         if s:
             return s[0] == "ON"
@@ -2379,7 +3164,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvShowingLockscreen(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "window"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         s = re.findall("mShowingLockscreen=(true|false)", output)
         if s:
             if s[0] == "true":
@@ -2391,7 +3176,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvLastAccelerometer(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "sensorservice"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         s = re.findall("3-axis Accelerometer.*last=<([- .0-9]*),([- .0-9]*),([- .0-9]*)>", output)
         try:
             rv = tuple([float(d) for d in s[0]])
@@ -2429,7 +3214,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
             _, output, _ = self._runAdb(
                 ["shell", "content", "query",
                  "--uri", "content://settings/system/accelerometer_rotation"],
-                timeout=_SHORT_TIMEOUT)
+                timeout=_SHORT_TIMEOUT, useSession=True)
             s = re.findall("value=(.*)", output)[0]
             return int(s) == 1 # True if accelerometer_rotation is enabled
         except Exception:
@@ -2465,7 +3250,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
             _, output, _ = self._runAdb(
                 ["shell", "content", "query",
                  "--uri", "content://settings/system/user_rotation"],
-                timeout=_SHORT_TIMEOUT)
+                timeout=_SHORT_TIMEOUT, useSession=True)
             s = re.findall("value=(.*)", output)[0]
             return int(s)
         except Exception:
@@ -2473,7 +3258,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvStatusBarVisible(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "window"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         s = re.findall("BarController.StatusBar\r\n\s*mState=(.*)\r", output)
         if "WINDOW_STATE_SHOWING" in s:
             return True
@@ -2482,7 +3267,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvNavigationBarVisible(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "window"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         s = re.findall("BarController.NavigationBar\r\n\s*mState=(.*)\r", output)
         if "WINDOW_STATE_SHOWING" in s:
             return True
@@ -2491,7 +3276,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
     def recvTopAppWindow(self):
         _, output, _ = self._runAdb(["shell", "dumpsys", "window"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         if self._platformVersion >= "4.2":
             s = re.findall("mCurrentFocus=Window\{(#?[0-9A-Fa-f]{4,16})( [^ ]*)? (?P<winName>[^}]*)\}", output)
         else:
@@ -2516,7 +3301,7 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
     def recvTopWindowStack(self):
         rv = None
         _, output, _ = self._runAdb(["shell", "dumpsys", "window"], 0,
-                                    timeout=_SHORT_TIMEOUT)
+                                    timeout=_SHORT_TIMEOUT, useSession=True)
         # Find out top window id.
         s = re.findall("mTopFullscreenOpaqueWindowState=Window\{(?P<winId>[0-9A-Fa-f]*) ", output)
         if s:
@@ -2562,17 +3347,15 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         return self._monkeyCommand("tap " + str(xCoord) + " " + str(yCoord))[0]
 
     def sendKeyUp(self, key, modifiers=[]):
-        rv = self._monkeyCommand("key up " + key)[0]
-        for m in reversed(modifiers):
-            rv &= self._monkeyCommand("key up " + m)[0]
-        return rv
+        return self._monkeyCommandsSucceed(
+            ["key up " + key] + ["key up " + m for m in reversed(modifiers)])
 
     def sendKeyDown(self, key, modifiers=[]):
-        rv = True
-        for m in modifiers:
-            rv &= self._monkeyCommand("key down " + m)[0]
-        rv &= self._monkeyCommand("key down " + key)[0]
-        return rv
+        return self._monkeyCommandsSucceed(
+            ["key down " + m for m in modifiers] + ["key down " + key])
+
+    def _monkeyCommandsSucceed(self, monkeyCommands):
+        return all([ok for ok, _ in self._monkeyCommands(monkeyCommands)])
 
     def sendTouchUp(self, xCoord, yCoord):
         xCoord, yCoord = self._screenToDisplay(xCoord, yCoord)
@@ -2586,6 +3369,20 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         xCoord, yCoord = self._screenToDisplay(xCoord, yCoord)
         return self._monkeyCommand("touch move " + str(xCoord) + " " + str(yCoord))[0]
 
+    def sendTouchEvents(self, events):
+        """
+        Sends all events to monkey before reading responses. Unlike
+        the default implementation, events after a failed event are
+        sent, too. Returns False if any of the events failed.
+        """
+        monkeyCommands = []
+        for eventType, xCoord, yCoord, delay in events:
+            if delay > 0:
+                monkeyCommands.append("sleep " + str(int(round(delay * 1000))))
+            xCoord, yCoord = self._screenToDisplay(xCoord, yCoord)
+            monkeyCommands.append("touch " + eventType + " " + str(xCoord) + " " + str(yCoord))
+        return self._monkeyCommandsSucceed(monkeyCommands)
+
     def sendTrackBallMove(self, dx, dy):
         dx, dy = self._screenToDisplay(dx, dy)
         return self._monkeyCommand("trackball " + str(dx) + " " + str(dy))[0]
@@ -2594,26 +3391,25 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         if not modifiers:
             return self._monkeyCommand("press " + key)[0]
         else:
-            rv = True
-            for m in modifiers:
-                rv &= self.sendKeyDown(m)
             # A press with modifiers must be sent using "key down" and "key up"
             # primitives, not with "press".
-            rv &= self.sendKeyDown(key)
-            rv &= self.sendKeyUp(key)
-            for m in reversed(modifiers):
-                rv &= self.sendKeyUp(m)
-            return rv
+            return self._monkeyCommandsSucceed(
+                ["key down " + m for m in modifiers] +
+                ["key down " + key, "key up " + key] +
+                ["key up " + m for m in reversed(modifiers)])
 
     def sendType(self, text):
+        monkeyCommands = []
         for lineIndex, line in enumerate(text.split('\n')):
-            if lineIndex > 0: self.sendPress("KEYCODE_ENTER")
+            if lineIndex > 0: monkeyCommands.append("press KEYCODE_ENTER")
             for wordIndex, word in enumerate(line.split(' ')):
-                if wordIndex > 0: self.sendPress("KEYCODE_SPACE")
-                if len(word) > 0 and not self._monkeyCommand("type " + word)[0]:
-                    _adapterLog('sendType("%s") failed when sending word "%s"' %
-                                (text, word))
-                    return False
+                if wordIndex > 0: monkeyCommands.append("press KEYCODE_SPACE")
+                if len(word) > 0: monkeyCommands.append("type " + word)
+        for command, (ok, _) in zip(monkeyCommands, self._monkeyCommands(monkeyCommands)):
+            if not ok and command.startswith("type "):
+                _adapterLog('sendType("%s") failed when sending word "%s"' %
+                            (text, command[5:]))
+                return False
         return True
 
     def sendWake(self):
@@ -2682,6 +3478,174 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         """
         return self._screencapArgs[:] # return a copy
 
+    def useScreencapLoop(self):
+        """
+        Returns True if raw screenshots are captured with a resident
+        screencap loop on the device.
+        """
+        return self._useScreencapLoop
+
+    def setUseScreencapLoop(self, useScreencapLoop):
+        """
+        Capture raw screenshots with a screencap loop that keeps
+        running on the device, instead of saving every screenshot to
+        a file on the device and pulling it with adb.
+
+        Parameters:
+
+          useScreencapLoop (boolean):
+                  if True, frames are passed in memory through the
+                  adb server when the device supports it (Android 5.0
+                  and later). The default is True.
+
+        If the loop cannot be started, or a restarted loop fails
+        to deliver a frame, the loop is disabled and screenshots
+        are pulled as files. Call setUseScreencapLoop(True) to try
+        the loop again.
+        """
+        self._useScreencapLoop = useScreencapLoop
+        if not useScreencapLoop:
+            self._closeScreencapLoop()
+
+    def _closeScreencapLoop(self):
+        self._screencapLoopLock.acquire()
+        try:
+            if self._screencapLoop:
+                self._screencapLoop.close()
+                self._screencapLoop = None
+        finally:
+            self._screencapLoopLock.release()
+
+    def _recvScreencapLoopFrame(self, timeout):
+        """
+        Returns screencap raw output from the screencap loop, or None
+        if the loop is not available.
+        """
+        self._screencapLoopLock.acquire()
+        try:
+            if (self._screencapLoop != None and
+                self._screencapLoop.screencapArgs != self._screencapArgs):
+                self._screencapLoop.close()
+                self._screencapLoop = None
+            for retry in (True, False):
+                if self._screencapLoop == None:
+                    try:
+                        self._screencapLoop = _ScreencapLoop(
+                            self._serialNumber, self._adbPort,
+                            self._screencapArgs)
+                    except (socket.error, FMBTAndroidError), e:
+                        _adapterLog("screencap loop disabled: %s" % (e,))
+                        self._useScreencapLoop = False
+                        return None
+                try:
+                    return self._screencapLoop.recvFrame(timeout)
+                except (socket.error, FMBTAndroidError), e:
+                    self._screencapLoop.close()
+                    self._screencapLoop = None
+                    if retry:
+                        _adapterLog("screencap loop failed, restarting: %s"
+                                    % (e,))
+                    else:
+                        # Fall back to pulling files instead of
+                        # restarting a loop that keeps failing.
+                        _adapterLog("screencap loop failed again, disabled"
+                                    " (enable with setUseScreencapLoop):"
+                                    " %s" % (e,))
+                        self._useScreencapLoop = False
+            return None
+        finally:
+            self._screencapLoopLock.release()
+
+    def _parseScreencapRaw(self, data):
+        """
+        Returns (width, height, depth, colorspace, pixel data) of
+        screencap raw output, or None if the format is not supported.
+        """
+        width, height, fmt = struct.unpack("<LLL", data[:12])
+        if isinstance(self._screencapFormat, tuple):
+            depth, colorspace = self._screencapFormat
+        elif fmt == 1:
+            depth, colorspace = 8, "RGBA"
+        elif fmt == 2:
+            depth, colorspace = 8, "RGB_"
+        elif fmt == 3:
+            depth, colorspace = 8, "RGB"
+        elif fmt == 5:
+            depth, colorspace = 8, "BGR_" # ignore alpha
+        else:
+            _adapterLog("unsupported screencap raw format %s" % (fmt,))
+            return None
+        # Header is longer than 12 bytes on newer Android versions.
+        headerLength = 12
+        if fmt in _g_screencapBytesPerPixel:
+            pixelBytes = width * height * _g_screencapBytesPerPixel[fmt]
+            if 12 <= len(data) - pixelBytes <= 32:
+                headerLength = len(data) - pixelBytes
+        return width, height, depth, colorspace, data[headerLength:]
+
+    def _recvScreencapRaw(self, localFilename):
+        """
+        Capture a raw screenshot using localFilename as a temporary
+        file.
+
+        Returns (width, height, depth, colorspace, data), or None if
+        the raw format of the device is not supported.
+        """
+        _screenshotTimeout = 60
+        if self._useScreencapLoop:
+            data = self._recvScreencapLoopFrame(_screenshotTimeout)
+            if data != None:
+                return self._parseScreencapRaw(data)
+        remotefile = '/sdcard/fmbtandroid-s.raw'
+        cmd = ['shell', 'screencap %s | gzip -3 > %s' % (
+            ' '.join(self._screencapArgs), remotefile)]
+        status, out, err = self._runAdb(cmd, [0, 124], timeout=_screenshotTimeout)
+        if status != 0:
+            errmsg = "screenshot timeout: command='adb %s' status=%s, stdout=%s, stderr=%s" % (
+                " ".join(cmd), status, out, err)
+        else:
+            cmd = ['pull', remotefile, localFilename]
+            status, out, err = self._runAdb(cmd, [0, 1, 124], timeout=_screenshotTimeout)
+            if status == 124:
+                errmsg = "screenshot timeout: command='adb %s' status=%s, stdout=%s, stderr=%s" % (
+                    " ".join(cmd), status, out, err)
+            else:
+                errmsg = "screenshot 'adb %s' failed, exit status %s" % (" ".join(cmd), status)
+        if status != 0:
+            _adapterLog(errmsg)
+            raise FMBTAndroidError(errmsg)
+        try:
+            data = gzip.open(localFilename).read()
+        except Exception, e:
+            msg = 'reading screenshot from "%s" failed: %s' % (
+                localFilename, e)
+            _adapterLog(msg)
+            raise FMBTAndroidError(msg)
+        os.unlink(localFilename)
+
+        return self._parseScreencapRaw(data)
+
+    def recvRawScreenshot(self):
+        """
+        Capture a screenshot without encoding it.
+
+        Returns (width, height, colorspace, data), or None if raw
+        screenshots are not available.
+        """
+        if self._screencapFormat == "png":
+            return None
+        fd, localFilename = tempfile.mkstemp(prefix="fmbtandroid-s-", suffix=".raw")
+        os.close(fd)
+        try:
+            raw = self._recvScreencapRaw(localFilename)
+        finally:
+            if os.access(localFilename, os.F_OK):
+                os.unlink(localFilename)
+        if raw == None or raw[2] != 8:
+            return None
+        width, height, depth, colorspace, data = raw
+        return width, height, colorspace, data
+
     def recvScreenshot(self, filename, retry=2, retryDelay=1.0):
         """
         Capture a screenshot and copy the image file to given path or
@@ -2692,51 +3656,11 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         _screenshotTimeout = 60
         if self._screencapFormat != "png" and fmbtpng != None:
             # EXPERIMENTAL: PNG encoding moved from device to host
-            remotefile = '/sdcard/fmbtandroid-s.raw'
-            cmd = ['shell', 'screencap %s | gzip -3 > %s' % (
-                ' '.join(self._screencapArgs), remotefile)]
-            status, out, err = self._runAdb(cmd, [0, 124], timeout=_screenshotTimeout)
-            if status != 0:
-                errmsg = "screenshot timeout: command='adb %s' status=%s, stdout=%s, stderr=%s" % (
-                    " ".join(cmd), status, out, err)
-            else:
-                cmd = ['pull', remotefile, filename + ".raw"]
-                status, out, err = self._runAdb(cmd, [0, 1, 124], timeout=_screenshotTimeout)
-                if status == 124:
-                    errmsg = "screenshot timeout: command='adb %s' status=%s, stdout=%s, stderr=%s" % (
-                        " ".join(cmd), status, out, err)
-                else:
-                    errmsg = "screenshot 'adb %s' failed, exit status %s" % (" ".join(cmd), status)
-            if status != 0:
-                _adapterLog(errmsg)
-                raise FMBTAndroidError(errmsg)
-            try:
-                data = gzip.open(filename + ".raw").read()
-            except Exception, e:
-                msg = 'reading screenshot from "%s" failed: %s' % (
-                    filename + ".raw", e)
-                _adapterLog(msg)
-                raise FMBTAndroidError(msg)
-            os.unlink(filename + ".raw")
-
-            width, height, fmt = struct.unpack("<LLL", data[:12])
-            if isinstance(self._screencapFormat, tuple):
-                depth, colorspace = self._screencapFormat
-            elif fmt == 1:
-                depth, colorspace = 8, "RGBA"
-            elif fmt == 2:
-                depth, colorspace = 8, "RGB_"
-            elif fmt == 3:
-                depth, colorspace = 8, "RGB"
-            elif fmt == 5:
-                depth, colorspace = 8, "BGR_" # ignore alpha
-            else:
-                _adapterLog("unsupported screencap raw format %s" % (fmt,))
-                depth, colorspace = None, None
-
-            if depth != None:
+            raw = self._recvScreencapRaw(filename + ".raw")
+            if raw != None:
+                width, height, depth, colorspace, data = raw
                 file(filename, "w").write(fmbtpng.raw2png(
-                    data[12:], width, height, depth, colorspace))
+                    data, width, height, depth, colorspace))
                 return True
             else:
                 # fallback to slower screenshot method
@@ -2782,6 +3706,11 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         self._displayToScreen = displayToScreenFunction
 
     def shellSOE(self, shellCommand, timeout=None):
+        result = self._runShellSession(shellCommand, timeout)
+        if result != None:
+            if result[0] == 124 and timeout != None:
+                return None, None, None
+            return result
         fd, filename = tempfile.mkstemp(prefix="fmbtandroid-shellcmd-")
         remotename = '/sdcard/' + os.path.basename(filename)
         os.write(fd, shellCommand + "\n")
@@ -2831,7 +3760,17 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
                 exitstatus, stdout, stderr = None, None, None
         return exitstatus, stdout, stderr
 
-    def recvViewData(self, retry=3):
+    def recvViewData(self, retry=3, dataHandler=None):
+        """
+        Returns window dump of the foreground window, or None on
+        timeout.
+
+        Parameters:
+
+          dataHandler (function, optional):
+                  called with every received piece of the dump. It is
+                  called with None if reading is restarted.
+        """
         _dataBufferLen = 4096 * 16
         try:
             self._windowSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -2843,19 +3782,30 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
                 # LOG: readGUI cannot write to window socket
                 raise AndroidConnectionError("writing socket failed")
 
-            # Read until a "DONE" line or timeout
-            data = ""
+            # Read until a "DONE" line or timeout. Only the end of
+            # received data is checked for the "DONE" line.
+            chunks = []
+            tail = ""
             while True:
                 newData = ''
                 try:
                     newData = self._windowSocket.recv(_dataBufferLen)
                 except socket.timeout:
-                    data = None
+                    return None
+                if newData == '':
+                    if not chunks:
+                        raise AndroidConnectionError("no window dump data")
                     break
-                data += newData
-                if data.splitlines()[-1] == "DONE" or newData == '':
+                chunks.append(newData)
+                if dataHandler:
+                    dataHandler(newData)
+                tail = (tail + newData)[-16:]
+                lastLines = tail.splitlines()
+                if lastLines[-1] == "DONE" and (
+                        len(lastLines) > 1 or len(chunks) == 1 and
+                        len(newData) == len(tail)):
                     break
-            return data
+            return "".join(chunks)
         except Exception, msg:
             _adapterLog("recvViewData: window socket error: %s" % (msg,))
             if retry > 0:
@@ -2863,7 +3813,9 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
                 except: pass
                 self._resetWindow()
                 time.sleep(0.5)
-                return self.recvViewData(retry=retry-1)
+                if dataHandler:
+                    dataHandler(None)
+                return self.recvViewData(retry=retry-1, dataHandler=dataHandler)
             else:
                 msg = "recvViewData: cannot read window socket"
                 _adapterLog(msg)
@@ -2877,3 +3829,23 @@ class FMBTAndroidRunError(FMBTAndroidError): pass
 class AndroidConnectionError(FMBTAndroidError, fmbtgti.ConnectionError): pass
 class AndroidConnectionLost(AndroidConnectionError): pass
 class AndroidDeviceNotFound(AndroidConnectionError): pass
+
+class DevicePoolError(FMBTAndroidError):
+    """
+    Raised when an operation fails on one or more devices in a
+    DevicePool.
+    """
+    def __init__(self, results, errors):
+        FMBTAndroidError.__init__(
+            self, "failed on %s of %s devices:\n%s" % (
+                len(errors), len(errors) + len(results),
+                "\n".join(["%s: %s" % (sn, tb.rstrip())
+                           for sn, (_, tb) in sorted(errors.iteritems())])))
+        self._results = results
+        self._errors = errors
+    def results(self):
+        """Returns dictionary {serialNumber: return value}"""
+        return self._results
+    def errors(self):
+        """Returns dictionary {serialNumber: exception}"""
+        return dict([(sn, e) for sn, (e, _) in self._errors.iteritems()])
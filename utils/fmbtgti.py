@@ -96,27 +96,35 @@ verifyBitmap("bitmap.png") returns True. Visual log shows the
 information about which of the alternatives actually matched.
 """
 
+import atexit
 import cgi
+import collections
 import ctypes
 import datetime
 import distutils.sysconfig
-import gc
 import glob
+import hashlib
 import inspect
+import json
 import math
+import multiprocessing
 import os
+import Queue
 import re
 import shlex
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import types
+import weakref
 
 import fmbt
 import fmbt_config
 import eyenfinger
+import fmbtvlog
 
 # See imagemagick convert parameters.
 _OCRPREPROCESS = [
@@ -133,12 +141,81 @@ _g_oirEngines = []
 
 _g_forcedLocExt = ".fmbtoir.loc"
 
+# Pyramid search levels are used only if the bitmap is at least this
+# many pixels wide and high on the level.
+_g_pyramidMinBitmapSize = 8
+
+# Screenshots are compared in tiles of this size when looking for
+# changes.
+_g_changeTileSize = 32
+
+# OCR results are cached on disk in this directory by default, None
+# disables the cache. See _EyenfingerOcrEngine.setCacheDir.
+_g_ocrCacheDir = None
+
+# Bands of tiled OCR overlap by this many pixels so that text lines
+# on band edges are read completely in at least one band.
+_g_ocrTileOverlap = 64
+
+# Number of recently read OCR areas whose results are kept in memory
+# for reusing them on later screenshots.
+_g_ocrRecentAreas = 32
+
+# Adaptive wait polls at least this often (seconds) right after
+# input events and when the screen is changing. Otherwise the delay
+# between polls grows by _g_waitPollBackoff up to pollDelay.
+_g_waitMinPollDelay = 0.05
+_g_waitInputWindow = 2.0
+_g_waitPollBackoff = 1.5
+
+# Serializes reading words with eyenfinger.
+_g_ocrLock = threading.Lock()
+
+# Protects queues of GUITestConnection background calls.
+_g_connectionCallsLock = threading.Lock()
+
+# Raw screenshot formats (see fmbtpng.raw2png) mapped to eye4graphics
+# pixel orders. "_" and "P" are ignored bytes.
+_g_rawPixelOrder = {
+    "RGB": "RGB",
+    "RGBA": "RGBA",
+    "RGB_": "RGBP",
+    "BGR": "BGR",
+    "BGR_": "BGRP"
+}
+
 class _USE_DEFAULTS:
     pass
 
 def _fmbtLog(msg):
     fmbt.fmbtlog("fmbtgti: %s" % (msg,))
 
+def _flushVisualLog(visualLogRef):
+    visualLog = visualLogRef()
+    if visualLog != None:
+        visualLog.flush()
+
+def _waitArchived(screenshotStoreRef):
+    screenshotStore = screenshotStoreRef()
+    if screenshotStore != None:
+        screenshotStore.waitArchived()
+
+def _removeScreenshotFile(filepath):
+    try:
+        os.remove(filepath)
+    except OSError:
+        pass
+
+def _resizeScreenshotFile(filepath, convertArgs):
+    # The file may be hard-linked to a screenshot still in use. Write
+    # resized image to a new file and replace the link with it.
+    resizedFilepath = filepath + ".resized.png"
+    if subprocess.call([fmbt_config.imagemagick_convert, filepath] +
+                       convertArgs + [resizedFilepath]) == 0:
+        if os.name == "nt":
+            os.remove(filepath) # rename does not replace files
+        os.rename(resizedFilepath, filepath)
+
 def _filenameTimestamp(t=None):
     return fmbt.formatTime("%Y%m%d-%H%M%S-%f", t)
 
@@ -237,6 +314,34 @@ class _Bbox(ctypes.Structure):
                 ("bottom", ctypes.c_int32),
                 ("error", ctypes.c_int32)]
 
+class _BboxIndex(object):
+    """
+    Grid of bounding boxes for finding possibly overlapping boxes
+    without comparing to every box.
+    """
+    def __init__(self, cellSize=64):
+        self._cellSize = cellSize
+        self._cells = {}
+
+    def _cellKeys(self, (left, top, right, bottom)):
+        cellSize = self._cellSize
+        for cellX in xrange(left / cellSize, right / cellSize + 1):
+            for cellY in xrange(top / cellSize, bottom / cellSize + 1):
+                yield (cellX, cellY)
+
+    def add(self, bbox):
+        for cellKey in self._cellKeys(bbox):
+            self._cells.setdefault(cellKey, []).append(bbox)
+
+    def near(self, bbox):
+        """
+        Returns set of added boxes that touch the cells of bbox.
+        """
+        nearBboxes = set()
+        for cellKey in self._cellKeys(bbox):
+            nearBboxes.update(self._cells.get(cellKey, ()))
+        return nearBboxes
+
 class _Rgb888(ctypes.Structure):
     _fields_ = [("red", ctypes.c_uint8),
                 ("green", ctypes.c_uint8),
@@ -261,12 +366,40 @@ for _dirname in _libpath:
             ctypes.c_double,
             ctypes.c_void_p]
         eye4graphics.openImage.restype = ctypes.c_void_p
+        eye4graphics.openBlob.restype = ctypes.c_void_p
+        eye4graphics.openBlob.argtypes = [
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_int,
+            ctypes.c_int]
+        eye4graphics.openedImageTileHashes.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.POINTER(ctypes.c_uint32),
+            ctypes.c_int]
+        eye4graphics.scaleImage.restype = ctypes.c_void_p
+        eye4graphics.scaleImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_int]
+        eye4graphics.drawOnImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_char_p]
+        eye4graphics.writeImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_char_p]
         eye4graphics.closeImage.argtypes = [ctypes.c_void_p]
         break
     except: pass
 else:
     raise ImportError("%s cannot load eye4graphics%s" % (__file__, _suffix))
 
+# Bytes per pixel of opened images: red, green, blue and opacity
+# channels of quantum depth bits each.
+_g_e4gPixelBytes = 4 * eye4graphics.quantumDepth() / 8
+
 def _e4gOpenImage(filename):
     image = eye4graphics.openImage(filename)
     if not image:
@@ -274,6 +407,43 @@ def _e4gOpenImage(filename):
     else:
         return image
 
+def _e4gOpenRawImage((width, height, fmt, data)):
+    try:
+        pixelOrder = _g_rawPixelOrder[fmt.upper()]
+    except KeyError:
+        raise ValueError('Unsupported raw image format "%s"' % (fmt,))
+    image = eye4graphics.openBlob(data, pixelOrder, width, height)
+    if not image:
+        raise IOError('Cannot open %sx%s %s image data' % (width, height, fmt))
+    else:
+        return image
+
+def _e4gScaleImage(e4gImage, columns, rows):
+    scaled = eye4graphics.scaleImage(e4gImage, max(1, columns), max(1, rows))
+    if not scaled:
+        raise IOError('Cannot scale image to %sx%s' % (columns, rows))
+    else:
+        return scaled
+
+def _e4gImageTileHashes(e4gImage, tileSize):
+    width, height = _e4gImageDimensions(e4gImage)
+    hashCount = (((width + tileSize - 1) / tileSize) *
+                 ((height + tileSize - 1) / tileSize))
+    hashes = (ctypes.c_uint32 * hashCount)()
+    if eye4graphics.openedImageTileHashes(e4gImage, tileSize, hashes, hashCount) < 0:
+        raise IOError('Cannot read pixels of image')
+    return list(hashes)
+
+def _e4gDrawOnImage(e4gImage, stroke, fill, primitive):
+    if isinstance(primitive, unicode):
+        primitive = primitive.encode("utf-8")
+    if eye4graphics.drawOnImage(e4gImage, stroke, fill, primitive) < 0:
+        raise IOError('Cannot draw "%s"' % (primitive,))
+
+def _e4gWriteImage(e4gImage, filename):
+    if eye4graphics.writeImage(e4gImage, filename) < 0:
+        raise IOError('Cannot write image "%s"' % (filename,))
+
 def _e4gImageDimensions(e4gImage):
     struct_bbox = _Bbox(0, 0, 0, 0, 0)
     eye4graphics.openedImageDimensions(ctypes.byref(struct_bbox), e4gImage)
@@ -310,6 +480,26 @@ class GUITestConnection(object):
         raise NotImplementedError('sendTouchMove(%d, %d) needed but not implemented.' % (x, y))
     def sendTouchUp(self, x, y):
         raise NotImplementedError('sendTouchUp(%d, %d) needed but not implemented.' % (x, y))
+    def sendTouchEvents(self, events):
+        """
+        Sends a sequence of touch events. events is a list of
+        (eventType, x, y, delay) tuples, where eventType is "down",
+        "move" or "up", and delay is seconds to wait before sending
+        the event.
+
+        Connections that can send many events without waiting for
+        each of them to be acknowledged should override this. The
+        default implementation sends events one by one.
+        """
+        sendEvent = {"down": self.sendTouchDown,
+                     "move": self.sendTouchMove,
+                     "up": self.sendTouchUp}
+        for eventType, x, y, delay in events:
+            if delay > 0:
+                time.sleep(delay)
+            if not sendEvent[eventType](x, y):
+                return False
+        return True
     def sendType(self, text):
         raise NotImplementedError('sendType("%s") needed but not implemented.' % (text,))
     def recvScreenshot(self, filename):
@@ -317,6 +507,19 @@ class GUITestConnection(object):
         Saves screenshot from the GUI under test to given filename.
         """
         raise NotImplementedError('recvScreenshot("%s") needed but not implemented.' % (filename,))
+    def recvRawScreenshot(self):
+        """
+        Returns screenshot from the GUI under test as uncompressed
+        pixel data in tuple (width, height, format, data), where
+        format is one of "RGB", "RGBA", "RGB_", "BGR" and "BGR_" with
+        8 bits per channel ("_" is an ignored byte).
+
+        Implementing this method is optional. If not implemented,
+        the method returns None, and recvScreenshot is used
+        instead. Raw screenshots are used only if enabled with
+        GUITestInterface.setScreenshotInMemory.
+        """
+        return None
     def recvScreenUpdated(self, waitTime, pollDelay):
         """
         Wait until the screen has been updated, but no longer than the
@@ -336,6 +539,186 @@ class GUITestConnection(object):
         instance, Android device serial number.
         """
         return "GUITestConnectionTarget"
+    def callInBackground(self, methodName, *args, **kwargs):
+        """
+        Call a method of the connection in a background thread.
+        Background calls of a connection are run one at a time in
+        the order they were made.
+
+        Parameters:
+
+          methodName (string):
+                  name of the method, for instance "recvScreenshot".
+
+          other parameters are passed to the method.
+
+        Returns ConnectionCall. Its result() waits for the call to
+        finish and returns its return value.
+
+        Connections are not thread-safe: do not use the connection
+        directly while background calls are running, see
+        waitBackgroundCalls().
+
+        Example: transfer next screenshot while analysing the
+        previous one.
+
+          call = conn.callInBackground("recvScreenshot", "next.png")
+          ...analyse previous screenshot...
+          if call.result():
+              ...
+        """
+        method = getattr(self, methodName)
+        call = ConnectionCall(methodName)
+        _g_connectionCallsLock.acquire()
+        try:
+            if not "_backgroundCalls" in self.__dict__:
+                self._backgroundCalls = collections.deque()
+                self._backgroundThread = None
+            self._backgroundCalls.append((call, method, args, kwargs))
+            if self._backgroundThread == None:
+                self._backgroundThread = threading.Thread(
+                    target=self._runBackgroundCalls)
+                self._backgroundThread.daemon = True
+                self._backgroundThread.start()
+        finally:
+            _g_connectionCallsLock.release()
+        return call
+    def waitBackgroundCalls(self, timeout=None):
+        """
+        Wait until all background calls have finished. Returns True
+        on success, False on timeout.
+        """
+        _g_connectionCallsLock.acquire()
+        try:
+            calls = [c[0] for c in self.__dict__.get("_backgroundCalls", ())]
+        finally:
+            _g_connectionCallsLock.release()
+        if timeout != None:
+            endTime = time.time() + timeout
+        for call in calls:
+            if timeout == None:
+                call.wait()
+            elif not call.wait(max(0, endTime - time.time())):
+                return False
+        return True
+    def _runBackgroundCalls(self):
+        try:
+            while True:
+                _g_connectionCallsLock.acquire()
+                try:
+                    if not self._backgroundCalls:
+                        # The thread exits when there is nothing to do,
+                        # so that it will not keep the connection alive.
+                        self._backgroundThread = None
+                        return
+                    call, method, args, kwargs = self._backgroundCalls[0]
+                finally:
+                    _g_connectionCallsLock.release()
+                try:
+                    call._run(method, args, kwargs)
+                finally:
+                    _g_connectionCallsLock.acquire()
+                    try:
+                        self._backgroundCalls.popleft()
+                    finally:
+                        _g_connectionCallsLock.release()
+        finally:
+            # If the thread dies, the next call starts a new one.
+            _g_connectionCallsLock.acquire()
+            try:
+                if self._backgroundThread is threading.currentThread():
+                    self._backgroundThread = None
+            finally:
+                _g_connectionCallsLock.release()
+
+class ConnectionCall(object):
+    """
+    Result of a GUITestConnection method called in the background,
+    see GUITestConnection.callInBackground.
+    """
+    def __init__(self, methodName):
+        self._methodName = methodName
+        self._done = threading.Event()
+        self._callbacks = []
+        self._callbacksLock = threading.Lock()
+        self._result = None
+        self._excInfo = None
+    def _run(self, method, args, kwargs):
+        try:
+            self._result = method(*args, **kwargs)
+        except Exception:
+            self._excInfo = sys.exc_info()
+        self._callbacksLock.acquire()
+        try:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._callbacksLock.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                _fmbtLog("%s callback failed: %s" % (
+                    self._methodName, traceback.format_exc().strip()))
+    def addCallback(self, callback):
+        """
+        Call callback(ConnectionCall) when the call has finished. If
+        the call has already finished, callback is called immediately.
+        Callbacks are called in the thread that finishes the call.
+        """
+        self._callbacksLock.acquire()
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._callbacksLock.release()
+        callback(self)
+    def done(self):
+        """
+        Returns True if the call has finished, otherwise False.
+        """
+        return self._done.isSet()
+    def exception(self, timeout=None):
+        """
+        Wait for the call to finish and return the exception it
+        raised, or None.
+        """
+        self._waitOrRaise(timeout)
+        if self._excInfo:
+            return self._excInfo[1]
+        return None
+    def result(self, timeout=None):
+        """
+        Wait for the call to finish and return its return value. If
+        the call raised an exception, it is raised here.
+
+        Parameters:
+
+          timeout (float, optional):
+                  maximum time in seconds to wait. If the call has not
+                  finished in time, ConnectionError is raised. The
+                  default is None, wait without timeout.
+        """
+        self._waitOrRaise(timeout)
+        if self._excInfo:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+        return self._result
+    def _waitOrRaise(self, timeout):
+        if not self.wait(timeout):
+            raise ConnectionError('%s did not finish in %s seconds' % (
+                self._methodName, timeout))
+    def wait(self, timeout=None):
+        """
+        Wait for the call to finish. Returns True if the call has
+        finished, False on timeout.
+        """
+        if timeout == None:
+            # Event.wait without timeout cannot be interrupted.
+            while not self._done.wait(3600):
+                pass
+            return True
+        return self._done.wait(timeout)
 
 class SimulatedGUITestConnection(GUITestConnection):
     """
@@ -654,6 +1037,15 @@ class _EyenfingerOcrEngine(OcrEngine):
       configfile (string, optional):
               Tesseract configuration file.
 
+      tiles (integer, optional):
+              OCR the area in this many horizontal bands from top to
+              bottom, and stop at the first band where the text is
+              found. Results of bands that have not changed since
+              earlier screenshots are reused. Finding text that
+              appears in several bands returns only the matches in
+              the first band. The default is 1, that is, OCR the
+              whole area at once.
+
 
     Example: limit recognized characters to hexadecimals by creating file
     "hexchars" with content
@@ -667,12 +1059,19 @@ class _EyenfingerOcrEngine(OcrEngine):
     or to use it on every Ocr method, set it as a default:
 
         dut.ocrEngine().setFindTextDefaults(configfile="hexchars")
+
+    OCR results are reused if a screenshot has the same contents as
+    the previous screenshot of the same size, see setReuseResults().
+    Results can also be stored on disk and reused in later test runs
+    if the OCR'd area of the screenshot, OCR parameters and the OCR
+    engine are the same, see setCacheDir().
     """
     class _OcrResults(object):
-        __slots__ = ("filename", "screenSize", "pagesegmodes", "preprocess", "area", "words", "lang", "configfile")
+        __slots__ = ("filename", "screenSize", "pagesegmodes", "preprocess", "area", "words", "lang", "configfile", "tileWords")
         def __init__(self, filename, screenSize):
             self.filename = filename
             self.screenSize = screenSize
+            self.tileWords = {}
             self.pagesegmodes = None
             self.preprocess = None
             self.area = None
@@ -687,19 +1086,230 @@ class _EyenfingerOcrEngine(OcrEngine):
         engineDefaults["pagesegmodes"] = engineDefaults.get("pagesegmodes", _OCRPAGESEGMODES)
         engineDefaults["preprocess"] = engineDefaults.get("preprocess", _OCRPREPROCESS)
         engineDefaults["configfile"] = engineDefaults.get("configfile", None)
+        engineDefaults["tiles"] = engineDefaults.get("tiles", 1)
+        reuseResults = engineDefaults.pop("reuseResults", True)
+        cacheDir = engineDefaults.pop("cacheDir", _g_ocrCacheDir)
+        cacheLimit = engineDefaults.pop("cacheLimit", 64 * 1024 * 1024)
         super(_EyenfingerOcrEngine, self).__init__(*args, **engineDefaults)
         self._ss = {} # OCR results for screenshots
+        # latestOcr maps screenshot size to (tile hashes, OCR
+        # parameters, words) of the latest OCR'd screenshot.
+        self._latestOcr = {}
+        self._reuseResults = reuseResults
+        self._cacheDir = cacheDir
+        self._cacheLimit = cacheLimit
+        # cacheFiles maps names of files in cacheDir to their sizes,
+        # None if the directory has not been read yet.
+        self._cacheFiles = None
+        # recentWords maps cache keys of recently read areas to words.
+        self._recentWords = collections.OrderedDict()
+
+    def reuseResults(self):
+        """
+        Returns True if OCR results are reused from identical
+        screenshots.
+        """
+        return self._reuseResults
+
+    def setReuseResults(self, reuseResults):
+        """
+        Reuse OCR results of the previous screenshot.
+
+        Parameters:
+
+          reuseResults (boolean):
+                  if True, screenshots are compared to the previous
+                  OCR'd screenshot of the same size in 32x32 pixel
+                  tiles. If no tiles have changed, previous OCR
+                  results with the same parameters are used. The
+                  default is True.
+        """
+        self._reuseResults = reuseResults
+        if not reuseResults:
+            self._latestOcr = {}
+            self._recentWords.clear()
+
+    def cacheDir(self):
+        """
+        Returns the directory where OCR results are cached, or None if
+        on-disk cache is disabled.
+        """
+        return self._cacheDir
+
+    def setCacheDir(self, cacheDir):
+        """
+        Set the directory for caching OCR results.
+
+        Parameters:
+
+          cacheDir (string or None):
+                  OCR results are stored to and read from this
+                  directory. Results are identified by the contents
+                  of the OCR'd area of the screenshot, OCR
+                  parameters, Tesseract version and trained data, so
+                  the same directory can be shared by test runs.
+                  None disables the cache. The default is None.
+        """
+        self._cacheDir = cacheDir
+        self._cacheFiles = None
+
+    def cacheLimit(self):
+        """
+        Returns the maximum size of the OCR cache directory in bytes.
+        """
+        return self._cacheLimit
+
+    def setCacheLimit(self, cacheLimit):
+        """
+        Set the maximum size of the OCR cache directory.
+
+        Parameters:
+
+          cacheLimit (integer):
+                  maximum total size of cached OCR results in
+                  bytes. Least recently used results are removed
+                  when the limit is exceeded. The default is 64 MB.
+        """
+        self._cacheLimit = cacheLimit
+        self._shrinkCache()
+
+    def clearCache(self):
+        """
+        Remove all cached OCR results from the cache directory.
+        """
+        limit = self._cacheLimit
+        self._cacheLimit = 0
+        try:
+            self._shrinkCache()
+        finally:
+            self._cacheLimit = limit
+
+    def _cacheKey(self, screenshot, pp, area, pagesegmodes, lang, configfile):
+        """
+        Returns cache key for words read from the screenshot with
+        given parameters, or None if the screenshot cannot be
+        hashed.
+        """
+        try:
+            tileHashes = screenshot._tileHashes()
+        except (IOError, TypeError, AttributeError):
+            return None
+        width, height = screenshot.size()
+        x1, y1 = _intCoords(area[:2], (width, height))
+        x2, y2 = _intCoords(area[2:], (width, height))
+        x1, y1 = max(0, x1), max(0, y1)
+        x2, y2 = min(width, x2), min(height, y2)
+        tileColumns = (width + _g_changeTileSize - 1) / _g_changeTileSize
+        areaHashes = []
+        for row in xrange(y1 / _g_changeTileSize,
+                          (y2 + _g_changeTileSize - 1) / _g_changeTileSize):
+            areaHashes.extend(tileHashes[row * tileColumns + x1 / _g_changeTileSize:
+                                         row * tileColumns + (x2 + _g_changeTileSize - 1) / _g_changeTileSize])
+        if isinstance(configfile, basestring):
+            configfiles = [configfile]
+        else:
+            configfiles = configfile or []
+        configs = []
+        for filename in configfiles:
+            try:
+                configs.append(file(filename).read())
+            except IOError:
+                configs.append(None)
+        keyData = repr(((width, height), (x1, y1, x2, y2), areaHashes,
+                        pp, tuple(pagesegmodes), lang, configfile, configs,
+                        eyenfinger._ocrIdentity(lang)))
+        return hashlib.sha1(keyData).hexdigest()
+
+    def _readCacheFiles(self):
+        self._cacheFiles = {}
+        try:
+            filenames = os.listdir(self._cacheDir)
+        except OSError:
+            return
+        for filename in filenames:
+            if filename.endswith(".ocr"):
+                try:
+                    self._cacheFiles[filename] = os.stat(
+                        os.path.join(self._cacheDir, filename)).st_size
+                except OSError:
+                    pass
+
+    def _cachedWords(self, key):
+        """
+        Returns words cached with the key, or None if not found.
+        """
+        path = os.path.join(self._cacheDir, key + ".ocr")
+        try:
+            cachedWords = json.loads(file(path, "rb").read())
+            words = {}
+            for word, appearances in cachedWords.iteritems():
+                words[word.encode("utf-8")] = [
+                    (wordId.encode("utf-8"), tuple(middle), tuple(bbox))
+                    for wordId, middle, bbox in appearances]
+            os.utime(path, None) # keep recently used results
+        except Exception:
+            return None
+        return words
+
+    def _cacheWords(self, key, words):
+        if self._cacheFiles == None:
+            self._readCacheFiles()
+        filename = key + ".ocr"
+        path = os.path.join(self._cacheDir, filename)
+        tmpPath = "%s.%s.tmp" % (path, os.getpid())
+        try:
+            if not os.path.isdir(self._cacheDir):
+                os.makedirs(self._cacheDir)
+            file(tmpPath, "wb").write(json.dumps(words))
+            os.rename(tmpPath, path)
+            self._cacheFiles[filename] = os.stat(path).st_size
+        except (IOError, OSError, ValueError), e:
+            _fmbtLog('Caching OCR results to "%s" failed: %s' % (path, e))
+            try: os.remove(tmpPath)
+            except OSError: pass
+            return
+        if sum(self._cacheFiles.itervalues()) > self._cacheLimit:
+            self._shrinkCache()
+
+    def _shrinkCache(self):
+        """
+        Remove least recently used results from the cache directory
+        until it fits in cacheLimit.
+        """
+        if self._cacheDir == None:
+            return
+        # Other test runs may share the directory, read it again.
+        self._readCacheFiles()
+        cacheSize = sum(self._cacheFiles.itervalues())
+        if cacheSize <= self._cacheLimit:
+            return
+        def _mtime(filename):
+            try:
+                return os.stat(os.path.join(self._cacheDir, filename)).st_mtime
+            except OSError:
+                return 0
+        for filename in sorted(self._cacheFiles, key=_mtime):
+            if cacheSize <= self._cacheLimit:
+                break
+            try:
+                os.remove(os.path.join(self._cacheDir, filename))
+            except OSError:
+                pass
+            cacheSize -= self._cacheFiles.pop(filename)
 
     def _addScreenshot(self, screenshot, **findTextDefaults):
         ssId = id(screenshot)
-        self._ss[ssId] = _EyenfingerOcrEngine._OcrResults(screenshot.filename(), screenshot.size())
+        self._ss[ssId] = _EyenfingerOcrEngine._OcrResults(
+            screenshot.filename(allowWritingFile=False), screenshot.size())
 
     def _removeScreenshot(self, screenshot):
         ssId = id(screenshot)
         if ssId in self._ss:
             del self._ss[ssId]
 
-    def _findText(self, screenshot, text, match=None, preprocess=None, area=None, pagesegmodes=None, lang=None, configfile=None):
+    def _findText(self, screenshot, text, match=None, preprocess=None, area=None, pagesegmodes=None, lang=None, configfile=None, tiles=None):
+        if tiles > 1:
+            return self._findTextInTiles(screenshot, text, match, preprocess, area, pagesegmodes, lang, configfile, tiles)
         ssId = id(screenshot)
         self._assumeOcrResults(screenshot, preprocess, area, pagesegmodes, lang, configfile)
 
@@ -721,7 +1331,7 @@ class _EyenfingerOcrEngine(OcrEngine):
                   for score, matching_text, bbox in score_text_bbox_list]
         return retval
 
-    def _dumpOcr(self, screenshot, match=None, preprocess=None, area=None, pagesegmodes=None, lang=None, configfile=None):
+    def _dumpOcr(self, screenshot, match=None, preprocess=None, area=None, pagesegmodes=None, lang=None, configfile=None, tiles=None):
         ssId = id(screenshot)
         self._assumeOcrResults(screenshot, preprocess, area, pagesegmodes, lang, configfile)
         w = []
@@ -732,6 +1342,77 @@ class _EyenfingerOcrEngine(OcrEngine):
                     w.append((word, (x1, y1, x2, y2)))
         return sorted(set(w), key=lambda i:(i[1][1]/8, i[1][0]))
 
+    def _findTextInTiles(self, screenshot, text, match, preprocess, area, pagesegmodes, lang, configfile, tiles):
+        ssId = id(screenshot)
+        if not type(preprocess) in (list, tuple):
+            preprocess = [preprocess]
+        width, height = self._ss[ssId].screenSize
+        x1, y1 = _intCoords(area[:2], (width, height))
+        x2, y2 = _intCoords(area[2:], (width, height))
+        bandHeight = max(1, (y2 - y1 + tiles - 1) / tiles)
+        for top in xrange(y1, y2, bandHeight):
+            bandArea = (x1, top, x2, min(y2, top + bandHeight + _g_ocrTileOverlap))
+            for ppfilter in preprocess:
+                key = (ppfilter, bandArea, tuple(pagesegmodes), lang, configfile)
+                if not key in self._ss[ssId].tileWords:
+                    pp = ppfilter % { "zoom": "-resize %sx" % (width * 2) }
+                    self._ss[ssId].tileWords[key] = self._readWords(
+                        screenshot, pp, bandArea, pagesegmodes, lang, configfile)
+                try:
+                    score_text_bbox_list = eyenfinger.findText(
+                        text, self._ss[ssId].tileWords[key], match=match)
+                except eyenfinger.BadMatch:
+                    continue
+                if score_text_bbox_list:
+                    return [GUIItem("OCR text (match %.2f)" % (score,),
+                                    bbox, self._ss[ssId].filename,
+                                    ocrFind=text, ocrFound=matching_text)
+                            for score, matching_text, bbox in score_text_bbox_list]
+        return []
+
+    def _readWords(self, screenshot, pp, area, pagesegmodes, lang, configfile):
+        """
+        Returns words read from the area of the screenshot. Reuses
+        results of earlier screenshots whose area had the same
+        contents.
+        """
+        # eyenfinger keeps results of the latest iRead in globals,
+        # and the engine may be shared by devices in many threads.
+        _g_ocrLock.acquire()
+        try:
+            return self._readWordsUnlocked(screenshot, pp, area, pagesegmodes, lang, configfile)
+        finally:
+            _g_ocrLock.release()
+
+    def _readWordsUnlocked(self, screenshot, pp, area, pagesegmodes, lang, configfile):
+        cacheKey = None
+        if self._reuseResults or self._cacheDir != None:
+            cacheKey = self._cacheKey(screenshot, pp, area, pagesegmodes, lang, configfile)
+        if cacheKey != None:
+            if cacheKey in self._recentWords:
+                words = self._recentWords.pop(cacheKey)
+                self._recentWords[cacheKey] = words
+                return words
+            if self._cacheDir != None:
+                words = self._cachedWords(cacheKey)
+                if words != None:
+                    self._rememberWords(cacheKey, words)
+                    return words
+        eyenfinger.iRead(source=screenshot.filename(), ocr=True, preprocess=pp, ocrArea=area, ocrPageSegModes=pagesegmodes, lang=lang, configfile=configfile)
+        words = eyenfinger._g_words
+        if cacheKey != None:
+            self._rememberWords(cacheKey, words)
+            if self._cacheDir != None:
+                self._cacheWords(cacheKey, words)
+        return words
+
+    def _rememberWords(self, cacheKey, words):
+        if not self._reuseResults:
+            return
+        self._recentWords[cacheKey] = words
+        while len(self._recentWords) > _g_ocrRecentAreas:
+            self._recentWords.popitem(last=False)
+
     def _assumeOcrResults(self, screenshot, preprocess, area, pagesegmodes, lang, configfile):
         ssId = id(screenshot)
         if not type(preprocess) in (list, tuple):
@@ -747,14 +1428,24 @@ class _EyenfingerOcrEngine(OcrEngine):
             self._ss[ssId].area = area
             self._ss[ssId].lang = lang
             self._ss[ssId].configfile = configfile
+            ocrParams = (preprocess, area, pagesegmodes, lang, configfile)
+            if self._reuseResults:
+                tileHashes = screenshot._tileHashes()
+                latest = self._latestOcr.get(screenshot.size(), None)
+                if latest and latest[0] == tileHashes and latest[1] == ocrParams:
+                    self._ss[ssId].words = latest[2]
+                    return
             for ppfilter in preprocess:
                 pp = ppfilter % { "zoom": "-resize %sx" % (self._ss[ssId].screenSize[0] * 2) }
                 try:
-                    eyenfinger.iRead(source=self._ss[ssId].filename, ocr=True, preprocess=pp, ocrArea=area, ocrPageSegModes=pagesegmodes, lang=lang, configfile=configfile)
+                    self._ss[ssId].words[ppfilter] = self._readWords(
+                        screenshot, pp, area, pagesegmodes, lang, configfile)
                 except Exception:
                     self._ss[ssId].words = None
                     raise
-                self._ss[ssId].words[ppfilter] = eyenfinger._g_words
+            if self._reuseResults:
+                self._latestOcr[screenshot.size()] = (
+                    tileHashes, ocrParams, self._ss[ssId].words)
 
 def _defaultOcrEngine():
     if _g_defaultOcrEngine:
@@ -904,6 +1595,48 @@ class OirEngine(OrEngine):
         Return list of fmbtgti.GUIItems that match to bitmap.
         """
         oirArgs = self.__oirArgs(screenshot, bitmap, **kwargs)
+        foundItems = self._findBitmapLocs(screenshot, bitmap)
+        if foundItems != None:
+            return foundItems
+        return self._findBitmap(screenshot, bitmap, **oirArgs)
+
+    def findBitmaps(self, screenshot, bitmapsAndArgs):
+        """
+        Search for many bitmaps in the screenshot at once.
+
+        Parameters:
+
+          screenshot (fmbtgti.Screenshot)
+                  screenshot to be searched from.
+
+          bitmapsAndArgs (list of pairs (bitmap, dict))
+                  bitmaps and their findBitmap keyword arguments.
+
+        Returns list of lists of fmbtgti.GUIItems, one list for each
+        bitmap in bitmapsAndArgs.
+        """
+        results = [None] * len(bitmapsAndArgs)
+        searchIndexes = []
+        searchBitmapsAndArgs = []
+        for index, (bitmap, kwargs) in enumerate(bitmapsAndArgs):
+            foundItems = self._findBitmapLocs(screenshot, bitmap)
+            if foundItems != None:
+                results[index] = foundItems
+            else:
+                searchIndexes.append(index)
+                searchBitmapsAndArgs.append(
+                    (bitmap, self.__oirArgs(screenshot, bitmap, **kwargs)))
+        if searchBitmapsAndArgs:
+            for index, foundItems in zip(searchIndexes, self._findBitmaps(
+                    screenshot, searchBitmapsAndArgs)):
+                results[index] = foundItems
+        return results
+
+    def _findBitmapLocs(self, screenshot, bitmap):
+        """
+        Returns list of GUIItems read from the hardcoded locations
+        file of the bitmap, or None if there is no such file.
+        """
         bitmapLocsFilename = bitmap + _g_forcedLocExt
         if os.access(bitmapLocsFilename, os.R_OK):
             # Use hardcoded bitmap locations file instead of real OIR
@@ -917,12 +1650,13 @@ class OirEngine(OrEngine):
                     x2, y2 = _intCoords((right, bottom), screenshot.size())
                     foundItems.append(
                         GUIItem("bitmap location", (x1, y1, x2, y2),
-                                screenshot.filename(), bitmap=bitmapLocsFilename))
+                                screenshot.filename(allowWritingFile=False),
+                                bitmap=bitmapLocsFilename))
                 return foundItems
             except Exception, e:
                 raise ValueError('Error reading bounding box list from %s: %s' %
                                  repr(bitmapLocsFilename), e)
-        return self._findBitmap(screenshot, bitmap, **oirArgs)
+        return None
 
     def _findBitmap(self, screenshot, bitmap, **kwargs):
         """
@@ -953,6 +1687,28 @@ class OirEngine(OrEngine):
         """
         raise NotImplementedError("_findBitmap needed but not implemented.")
 
+    def _findBitmaps(self, screenshot, bitmapsAndArgs):
+        """
+        Find appearances of many bitmaps from the screenshot.
+
+        Parameters:
+
+          screenshot (fmbtgti.Screenshot)
+                  Screenshot from which bitmaps are to be searched
+                  for.
+
+          bitmapsAndArgs (list of pairs (bitmap, dict))
+                  bitmaps and their complete _findBitmap keyword
+                  arguments.
+
+        Implementing this method is optional. The default
+        implementation calls _findBitmap for every bitmap.
+
+        Returns list of lists of fmbtgti.GUIItems.
+        """
+        return [self._findBitmap(screenshot, bitmap, **oirArgs)
+                for bitmap, oirArgs in bitmapsAndArgs]
+
 
 class _Eye4GraphicsOirEngine(OirEngine):
     """OIR engine parameters that can be used in all
@@ -1018,9 +1774,26 @@ class _Eye4GraphicsOirEngine(OirEngine):
               and then search for ref-pp.png in screenshot-pp.png. This results
               in black-and-white comparison (immune to slight color changes).
 
+      pyramid (integer, optional):
+              number of times the screenshot and the bitmap are halved
+              in size for a coarse search. Only areas where the bitmap
+              is found in the coarse search are searched at full
+              resolution. The coarse search uses colorMatch lowered by
+              0.1 on every level. This speeds up searching on large
+              screenshots, especially with colorMatch < 1.0, but may
+              miss matches that the full search would find. Levels on
+              which the bitmap would be smaller than 8x8 pixels are
+              skipped. The default is 0 (no pyramid search).
+
     If unsure about parameters, but you have a bitmap that should be
     detected in a screenshot, try obj.oirEngine().adjustParameters().
 
+    Decoded (and preprocessed) bitmaps are cached in the engine. The
+    memory used by the cache is limited by bitmapCacheLimit given to
+    the constructor, see setBitmapCacheLimit(). findBitmaps searches
+    many bitmaps in parallel, see setSearchThreads(). A single search
+    can be split to parallel tiles, see setSearchTiles().
+
     Example:
 
     d.enableVisualLog("params.html")
@@ -1045,17 +1818,234 @@ class _Eye4GraphicsOirEngine(OirEngine):
         engineDefaults["bitmapPixelSize"] = engineDefaults.get("bitmapPixelSize", 0)
         engineDefaults["screenshotPixelSize"] = engineDefaults.get("screenshotPixelSize", 0)
         engineDefaults["preprocess"] = engineDefaults.get("preprocess", "")
+        engineDefaults["pyramid"] = engineDefaults.get("pyramid", 0)
+        bitmapCacheLimit = engineDefaults.pop("bitmapCacheLimit", 64 * 1024 * 1024)
+        searchThreads = engineDefaults.pop("searchThreads", None)
+        searchTiles = engineDefaults.pop("searchTiles", 1)
+        reuseResults = engineDefaults.pop("reuseResults", True)
         OirEngine.__init__(self, *args, **engineDefaults)
         self._openedImages = {}
+        # openedImageUsers maps a screenshot filename to the number of
+        # added screenshot objects using the opened image.
+        self._openedImageUsers = {}
         # openedRelatedScreenshots maps a screenshot filename to
         # a list of preprocessed screenshot objects. All those objects
         # must be closed when the screenshot is removed.
         self._openedRelatedScreenshots = {}
+        # openedPyramids maps a screenshot filename to a dictionary of
+        # downscaled images of the screenshot, keyed by pyramid level.
+        self._openedPyramids = {}
         self._findBitmapCache = {}
+        # bitmapCache maps (bitmap, mtime, preprocess, pyramid) to
+        # (opened bitmap, size in bytes) in least recently used order.
+        self._bitmapCache = collections.OrderedDict()
+        self._bitmapCacheBytes = 0
+        self._bitmapCacheHits = 0
+        self._bitmapCacheMisses = 0
+        self._bitmapCacheLimit = bitmapCacheLimit
+        # Engine state is shared by devices tested in different
+        # threads. The lock protects caches and opened images,
+        # searches run without holding it.
+        self._lock = threading.RLock()
+        # Bitmaps dropped from the cache while searches are running
+        # are closed when no search is running.
+        self._runningSearches = 0
+        self._bitmapCacheDeferClose = []
+        self.setSearchThreads(searchThreads)
+        self._searchTiles = searchTiles
+        # latestTileStates maps screenshot size to the tile state
+        # (see _tileState) of the latest screenshot of that size.
+        self._latestTileStates = {}
+        self._reuseResults = reuseResults
+
+    def searchThreads(self):
+        """
+        Returns the number of threads used in bitmap searches.
+        """
+        return self._searchThreads
+
+    def setSearchThreads(self, searchThreads):
+        """
+        Set the number of threads used for searching many bitmaps in
+        findBitmaps, or tiles of a screenshot (see setSearchTiles).
+
+        Parameters:
+
+          searchThreads (integer or None):
+                  number of parallel searches. None uses the number of
+                  CPUs. 1 disables parallel searching.
+        """
+        if searchThreads == None:
+            try:
+                searchThreads = multiprocessing.cpu_count()
+            except NotImplementedError:
+                searchThreads = 1
+        self._searchThreads = searchThreads
+
+    def searchTiles(self):
+        """
+        Returns the number of tiles the search area is split into.
+        """
+        return self._searchTiles
+
+    def setSearchTiles(self, searchTiles):
+        """
+        Split search area into tiles that are searched in parallel.
+
+        Parameters:
+
+          searchTiles (integer):
+                  number of horizontal tiles. Tiles are searched in
+                  searchThreads threads. The default is 1 (no
+                  tiling). Tiling is not used in pyramid search.
+        """
+        self._searchTiles = searchTiles
+
+    def reuseResults(self):
+        """
+        Returns True if results are reused from unchanged screenshot
+        areas.
+        """
+        return self._reuseResults
+
+    def setReuseResults(self, reuseResults):
+        """
+        Reuse search results of the previous screenshot.
+
+        Parameters:
+
+          reuseResults (boolean):
+                  if True, screenshots are compared to the previous
+                  screenshot of the same size in 32x32 pixel
+                  tiles. If the same search was done on the previous
+                  screenshot and none of its matches are on changed
+                  tiles, only changed tiles are searched. Searches
+                  with preprocess are always done in full. The
+                  default is True.
+        """
+        self._lock.acquire()
+        try:
+            self._reuseResults = reuseResults
+            if not reuseResults:
+                self._latestTileStates = {}
+        finally:
+            self._lock.release()
+
+    def bitmapCacheLimit(self):
+        """
+        Returns the memory limit of the decoded bitmap cache in bytes.
+        """
+        return self._bitmapCacheLimit
+
+    def setBitmapCacheLimit(self, bitmapCacheLimit):
+        """
+        Set memory limit of the decoded bitmap cache.
+
+        Parameters:
+
+          bitmapCacheLimit (integer):
+                  maximum number of bytes used by decoded bitmaps
+                  kept in memory between searches. Least recently
+                  used bitmaps are dropped first. 0 disables caching.
+                  The default is 64 MB.
+        """
+        self._lock.acquire()
+        try:
+            self._bitmapCacheLimit = bitmapCacheLimit
+            self._shrinkBitmapCache(bitmapCacheLimit)
+        finally:
+            self._lock.release()
+
+    def bitmapCacheStats(self):
+        """
+        Returns dictionary with keys "hits", "misses", "bitmaps" and
+        "bytes" describing the state of the decoded bitmap cache.
+        """
+        self._lock.acquire()
+        try:
+            return {"hits": self._bitmapCacheHits,
+                    "misses": self._bitmapCacheMisses,
+                    "bitmaps": len(self._bitmapCache),
+                    "bytes": self._bitmapCacheBytes}
+        finally:
+            self._lock.release()
+
+    def clearBitmapCache(self):
+        """
+        Close all cached bitmaps and reset cache statistics.
+        """
+        self._lock.acquire()
+        try:
+            self._shrinkBitmapCache(0)
+            self._bitmapCacheHits = 0
+            self._bitmapCacheMisses = 0
+        finally:
+            self._lock.release()
+
+    def _shrinkBitmapCache(self, maxBytes):
+        # Called with self._lock held.
+        while self._bitmapCacheBytes > maxBytes and self._bitmapCache:
+            _, (e4gImage, imageBytes) = self._bitmapCache.popitem(last=False)
+            if self._runningSearches > 0:
+                self._bitmapCacheDeferClose.append(e4gImage)
+            else:
+                eye4graphics.closeImage(e4gImage)
+            self._bitmapCacheBytes -= imageBytes
+
+    def _openBitmap(self, bitmap, preprocess, pyramid=0):
+        """
+        Returns pair (opened bitmap, cached). If cached is False, the
+        caller must close the bitmap. If pyramid > 0, the bitmap is
+        downscaled by 2**pyramid.
+        """
+        try:
+            mtime = os.stat(bitmap).st_mtime
+        except OSError:
+            raise IOError('Cannot open bitmap "%s"' % (bitmap,))
+        cacheKey = (bitmap, mtime, preprocess, pyramid)
+        if cacheKey in self._bitmapCache:
+            self._bitmapCacheHits += 1
+            entry = self._bitmapCache.pop(cacheKey)
+            self._bitmapCache[cacheKey] = entry # most recently used
+            return entry[0], True
+        self._bitmapCacheMisses += 1
+        if pyramid > 0:
+            fullImage, fullImageCached = self._openBitmap(bitmap, preprocess)
+            width, height = _e4gImageDimensions(fullImage)
+            e4gImage = _e4gScaleImage(fullImage, width >> pyramid, height >> pyramid)
+            if not fullImageCached:
+                eye4graphics.closeImage(fullImage)
+        elif preprocess:
+            bitmapPP = _ppFilename(bitmap, preprocess)
+            _convert(bitmap, preprocess, bitmapPP)
+            e4gImage = _e4gOpenImage(bitmapPP)
+        else:
+            e4gImage = _e4gOpenImage(bitmap)
+        width, height = _e4gImageDimensions(e4gImage)
+        imageBytes = width * height * _g_e4gPixelBytes
+        if imageBytes > self._bitmapCacheLimit:
+            return e4gImage, False
+        self._shrinkBitmapCache(self._bitmapCacheLimit - imageBytes)
+        self._bitmapCache[cacheKey] = (e4gImage, imageBytes)
+        self._bitmapCacheBytes += imageBytes
+        return e4gImage, True
 
     def _addScreenshot(self, screenshot, **findBitmapDefaults):
-        filename = screenshot.filename()
-        self._openedImages[filename] = _e4gOpenImage(filename)
+        self._lock.acquire()
+        try:
+            self._addScreenshotLocked(screenshot)
+        finally:
+            self._lock.release()
+
+    def _addScreenshotLocked(self, screenshot):
+        filename = screenshot.filename(allowWritingFile=False)
+        if filename in self._openedImages:
+            # Another screenshot object of the same file, share images.
+            self._openedImageUsers[filename] += 1
+            return
+        self._openedImages[filename] = screenshot._openE4gImage()
+        self._openedImageUsers[filename] = 1
+        self._openedPyramids[filename] = {}
         # make sure size() is available, this can save an extra
         # opening of the screenshot file.
         if screenshot.size(allowReadingFile=False) == None:
@@ -1063,15 +2053,39 @@ class _Eye4GraphicsOirEngine(OirEngine):
         self._findBitmapCache[filename] = {}
 
     def _removeScreenshot(self, screenshot):
-        filename = screenshot.filename()
+        self._lock.acquire()
+        try:
+            self._removeScreenshotLocked(screenshot)
+        finally:
+            self._lock.release()
+
+    def _removeScreenshotLocked(self, screenshot):
+        filename = screenshot.filename(allowWritingFile=False)
+        self._openedImageUsers[filename] -= 1
+        if self._openedImageUsers[filename] > 0:
+            return
+        del self._openedImageUsers[filename]
         if filename in self._openedRelatedScreenshots:
             for screenshotPP in self._openedRelatedScreenshots[filename]:
                 self._removeScreenshot(screenshotPP)
             del self._openedRelatedScreenshots[filename]
+        for e4gImage in self._openedPyramids.pop(filename).itervalues():
+            eye4graphics.closeImage(e4gImage)
         eye4graphics.closeImage(self._openedImages[filename])
         del self._openedImages[filename]
         del self._findBitmapCache[filename]
 
+    def _pyramidImage(self, filename, pyramid):
+        """
+        Returns screenshot image downscaled by 2**pyramid.
+        """
+        if not pyramid in self._openedPyramids[filename]:
+            e4gImage = self._openedImages[filename]
+            width, height = _e4gImageDimensions(e4gImage)
+            self._openedPyramids[filename][pyramid] = _e4gScaleImage(
+                e4gImage, width >> pyramid, height >> pyramid)
+        return self._openedPyramids[filename][pyramid]
+
     def adjustParameters(self, screenshot, bitmap,
                          scaleRange = [p/100.0 for p in range(110,210,10)],
                          colorMatchRange = [p/100.0 for p in range(100,60,-10)],
@@ -1112,7 +2126,7 @@ class _Eye4GraphicsOirEngine(OirEngine):
         GUIItem is the detected item (GUIItem.bbox() is the box around it),
         and findParams is a dictionary containing the parameters.
         """
-        if not screenshot.filename() in self._findBitmapCache:
+        if not screenshot.filename(allowWritingFile=False) in self._findBitmapCache:
             self.addScreenshot(screenshot)
             ssAdded = True
         else:
@@ -1141,80 +2155,369 @@ class _Eye4GraphicsOirEngine(OirEngine):
                     opacityLimit=None, area=None, limit=None,
                     allowOverlap=None, scale=None,
                     bitmapPixelSize=None, screenshotPixelSize=None,
-                    preprocess=None):
+                    preprocess=None, pyramid=None):
         """
         Find items on the screenshot that match to bitmap.
         """
-        ssFilename = screenshot.filename()
+        return self._findBitmaps(screenshot, [(bitmap, {
+            "colorMatch": colorMatch, "opacityLimit": opacityLimit,
+            "area": area, "limit": limit, "allowOverlap": allowOverlap,
+            "scale": scale, "bitmapPixelSize": bitmapPixelSize,
+            "screenshotPixelSize": screenshotPixelSize,
+            "preprocess": preprocess, "pyramid": pyramid})])[0]
+
+    def _findBitmaps(self, screenshot, bitmapsAndArgs):
+        """
+        Find items matching to many bitmaps on the screenshot. Bitmaps
+        are searched in parallel in searchThreads threads.
+        """
+        results = [None] * len(bitmapsAndArgs)
+        jobs = []
+        self._lock.acquire()
+        try:
+            self._runningSearches += 1
+        finally:
+            self._lock.release()
+        try:
+            self._lock.acquire()
+            try:
+                for index, (bitmap, oirArgs) in enumerate(bitmapsAndArgs):
+                    job = self._prepareFindBitmap(screenshot, bitmap, **oirArgs)
+                    if isinstance(job, list):
+                        results[index] = job
+                    else:
+                        jobs.append((index, job))
+            finally:
+                self._lock.release()
+            self._runFindBitmapJobs([indexedJob[1] for indexedJob in jobs])
+            self._lock.acquire()
+            try:
+                for index, job in jobs:
+                    results[index] = self._finishFindBitmap(job)
+            finally:
+                self._lock.release()
+        finally:
+            self._lock.acquire()
+            try:
+                self._runningSearches -= 1
+                if self._runningSearches == 0:
+                    for e4gImage in self._bitmapCacheDeferClose:
+                        eye4graphics.closeImage(e4gImage)
+                    self._bitmapCacheDeferClose = []
+            finally:
+                self._lock.release()
+        return results
+
+    def _prepareFindBitmap(self, screenshot, bitmap, colorMatch=None,
+                           opacityLimit=None, area=None, limit=None,
+                           allowOverlap=None, scale=None,
+                           bitmapPixelSize=None, screenshotPixelSize=None,
+                           preprocess=None, pyramid=None):
+        """
+        Returns cached list of GUIItems, or a search job that is to be
+        run with _runFindBitmapJob and finished with _finishFindBitmap.
+        """
+        ssFilename = screenshot.filename(allowWritingFile=False)
         ssSize = screenshot.size()
         cacheKey = (bitmap, colorMatch, opacityLimit, area, limit,
-                    scale, bitmapPixelSize, screenshotPixelSize, preprocess)
+                    allowOverlap, scale, bitmapPixelSize, screenshotPixelSize,
+                    preprocess, pyramid)
         if cacheKey in self._findBitmapCache[ssFilename]:
             return self._findBitmapCache[ssFilename][cacheKey]
-        self._findBitmapCache[ssFilename][cacheKey] = []
 
+        e4gIcon, e4gIconCached = self._openBitmap(bitmap, preprocess)
+
+        cacheFilenames = [ssFilename]
         if preprocess:
             ssFilenamePP = _ppFilename(ssFilename, preprocess)
-            bitmapPP = _ppFilename(bitmap, preprocess)
             if not ssFilenamePP in self._openedImages:
-                _convert(ssFilename, preprocess, ssFilenamePP)
+                _convert(screenshot.filename(), preprocess, ssFilenamePP)
                 screenshotPP = Screenshot(ssFilenamePP)
                 self.addScreenshot(screenshotPP)
                 if not ssFilename in self._openedRelatedScreenshots:
                     self._openedRelatedScreenshots[ssFilename] = []
                 self._openedRelatedScreenshots[ssFilename].append(screenshotPP)
-            _convert(bitmap, preprocess, bitmapPP)
             ssFilename = ssFilenamePP
-            bitmap = bitmapPP
-            self._findBitmapCache[ssFilename][cacheKey] = []
+            cacheFilenames.append(ssFilename)
 
-        e4gIcon = _e4gOpenImage(bitmap)
-        matchCount = 0
-        leftTopRightBottomZero = (_intCoords((area[0], area[1]), ssSize) +
-                                  _intCoords((area[2], area[3]), ssSize) +
-                                  (0,))
-        struct_area_bbox = _Bbox(*leftTopRightBottomZero)
-        struct_bbox = _Bbox(0, 0, 0, 0, 0)
-        contOpts = 0 # search for the first hit
+        leftTopRightBottom = (_intCoords((area[0], area[1]), ssSize) +
+                              _intCoords((area[2], area[3]), ssSize))
         try:
             xscale, yscale = scale
         except TypeError:
             xscale = yscale = float(scale)
+        job = {"cacheKey": cacheKey,
+               "cacheFilenames": cacheFilenames,
+               "ssFilename": ssFilename,
+               "ssImage": self._openedImages[ssFilename],
+               "bitmap": _ppFilename(bitmap, preprocess) if preprocess else bitmap,
+               "e4gIcon": e4gIcon,
+               "e4gIconCached": e4gIconCached,
+               "areaBbox": leftTopRightBottom,
+               "colorMatch": colorMatch,
+               "opacityLimit": opacityLimit,
+               "limit": limit,
+               "allowOverlap": allowOverlap,
+               "xscale": xscale,
+               "yscale": yscale,
+               "bitmapPixelSize": bitmapPixelSize,
+               "screenshotPixelSize": screenshotPixelSize,
+               "pyramid": 0,
+               "found": {"bboxes": [], "index": _BboxIndex()}}
+
+        # Use only pyramid levels where the bitmap is still
+        # recognizable.
+        bitmapSize = _e4gImageDimensions(e4gIcon)
+        job["bitmapSize"] = bitmapSize
+
+        if self._reuseResults and not preprocess:
+            self._reuseUnchangedResults(screenshot, job)
+            if job["areaBbox"] == None:
+                return job # nothing changed, no need to search
+
+        while pyramid > 0 and min(bitmapSize) < _g_pyramidMinBitmapSize * 2**pyramid:
+            pyramid -= 1
+        if pyramid > 0:
+            factor = 2**pyramid
+            job["pyramid"] = pyramid
+            job["ssImageCoarse"] = self._pyramidImage(ssFilename, pyramid)
+            job["e4gIconCoarse"], job["e4gIconCoarseCached"] = self._openBitmap(
+                bitmap, preprocess, pyramid)
+            job["areaBboxCoarse"] = tuple([c / factor for c in job["areaBbox"]])
+            job["colorMatchCoarse"] = max(0.0, colorMatch - 0.1 * pyramid)
+            job["bitmapPixelSizeCoarse"] = bitmapPixelSize and max(1, bitmapPixelSize / factor)
+            job["screenshotPixelSizeCoarse"] = max(2, int(math.ceil(screenshotPixelSize / float(factor))))
+        return job
+
+    def _tileState(self, screenshot):
+        """
+        Returns state of screenshot contents: tile hashes, bounding
+        boxes found from it for each search, and the state of the
+        previous different screenshot of the same size.
+        """
+        ssSize = screenshot.size()
+        hashes = screenshot._tileHashes()
+        latest = self._latestTileStates.get(ssSize, None)
+        if latest != None and latest["hashes"] == hashes:
+            return latest
+        state = {"hashes": hashes, "bboxes": {}, "prev": latest}
+        if latest != None:
+            latest["prev"] = None
+        self._latestTileStates[ssSize] = state
+        return state
+
+    def _reuseUnchangedResults(self, screenshot, job):
+        """
+        Reuse results of the same search on a previous screenshot if
+        possible. Sets job["reusedBboxes"] to the reused bounding
+        boxes and limits job["areaBbox"] to the changed area where
+        new matches may appear. areaBbox is None if there is nothing
+        to search.
+        """
+        state = self._tileState(screenshot)
+        job["tileState"] = state
+        cacheKey = job["cacheKey"]
+        if cacheKey in state["bboxes"]:
+            job["reusedBboxes"] = state["bboxes"][cacheKey]
+            job["areaBbox"] = None
+            return
+        prev = state["prev"]
+        if prev == None or not cacheKey in prev["bboxes"]:
+            return
+        tileSize = _g_changeTileSize
+        tileColumns = (screenshot.size()[0] + tileSize - 1) / tileSize
+        dirtyTiles = set([i for i, h in enumerate(state["hashes"])
+                          if h != prev["hashes"][i]])
+        prevBboxes = prev["bboxes"][cacheKey]
+        for left, top, right, bottom in prevBboxes:
+            for tileY in xrange(top / tileSize, max(top, bottom - 1) / tileSize + 1):
+                for tileX in xrange(left / tileSize, max(left, right - 1) / tileSize + 1):
+                    if tileY * tileColumns + tileX in dirtyTiles:
+                        return # a match may have changed, search everything
+        job["reusedBboxes"] = prevBboxes
+        # New matches must overlap changed tiles.
+        dirtyXs = [i % tileColumns for i in dirtyTiles]
+        dirtyYs = [i / tileColumns for i in dirtyTiles]
+        margin = max(2, job["screenshotPixelSize"])
+        areaLeft, areaTop, areaRight, areaBottom = job["areaBbox"]
+        searchLeft = max(areaLeft, min(dirtyXs) * tileSize -
+                         int(job["bitmapSize"][0] * job["xscale"]) - margin)
+        searchTop = max(areaTop, min(dirtyYs) * tileSize -
+                        int(job["bitmapSize"][1] * job["yscale"]) - margin)
+        searchRight = min(areaRight, (max(dirtyXs) + 1) * tileSize + margin)
+        searchBottom = min(areaBottom, (max(dirtyYs) + 1) * tileSize + margin)
+        if searchLeft >= searchRight or searchTop >= searchBottom:
+            job["areaBbox"] = None
+        else:
+            job["areaBbox"] = (searchLeft, searchTop, searchRight, searchBottom)
+
+    def _searchBitmap(self, job, ssImage, e4gIcon, areaBbox,
+                      colorMatch, bitmapPixelSize, screenshotPixelSize):
+        """
+        Generate bounding boxes of matches of e4gIcon in ssImage.
+        """
+        struct_area_bbox = _Bbox(*(areaBbox + (0,)))
+        struct_bbox = _Bbox(0, 0, 0, 0, 0)
+        contOpts = 0 # search for the first hit
         while True:
-            if matchCount == limit: break
             result = eye4graphics.findNextIcon(
                 ctypes.byref(struct_bbox),
-                ctypes.c_void_p(self._openedImages[ssFilename]),
+                ctypes.c_void_p(ssImage),
                 ctypes.c_void_p(e4gIcon),
                 0, # no fuzzy matching
                 ctypes.c_double(colorMatch),
-                ctypes.c_double(opacityLimit),
+                ctypes.c_double(job["opacityLimit"]),
                 ctypes.byref(struct_area_bbox),
                 ctypes.c_int(contOpts),
-                ctypes.c_float(xscale),
-                ctypes.c_float(yscale),
+                ctypes.c_float(job["xscale"]),
+                ctypes.c_float(job["yscale"]),
                 ctypes.c_int(bitmapPixelSize),
                 ctypes.c_int(screenshotPixelSize))
             contOpts = 1 # search for the next hit
             if result < 0: break
-            bbox = (int(struct_bbox.left), int(struct_bbox.top),
-                    int(struct_bbox.right), int(struct_bbox.bottom))
-            addToFoundItems = True
-            if allowOverlap == False:
-                for guiItem in self._findBitmapCache[ssFilename][cacheKey]:
-                    itemLeft, itemTop, itemRight, itemBottom = guiItem.bbox()
-                    if ((itemLeft <= bbox[0] <= itemRight or itemLeft <= bbox[2] <= itemRight) and
-                        (itemTop <= bbox[1] <= itemBottom or itemTop <= bbox[3] <= itemBottom)):
-                        if ((itemLeft < bbox[0] < itemRight or itemLeft < bbox[2] < itemRight) or
-                            (itemTop < bbox[1] < itemBottom or itemTop < bbox[3] < itemBottom)):
-                            addToFoundItems = False
-                            break
-            if addToFoundItems:
-                self._findBitmapCache[ssFilename][cacheKey].append(
-                    GUIItem("bitmap", bbox, ssFilename, bitmap=bitmap))
-                matchCount += 1
-        eye4graphics.closeImage(e4gIcon)
-        return self._findBitmapCache[ssFilename][cacheKey]
+            yield (int(struct_bbox.left), int(struct_bbox.top),
+                   int(struct_bbox.right), int(struct_bbox.bottom))
+
+    def _runFindBitmapJob(self, job, found, areaBbox):
+        """
+        Search bitmap of the job from areaBbox of the screenshot, add
+        matches to found. Does not touch engine state, can be run in
+        parallel with other jobs.
+        """
+        limit = job["limit"]
+        if len(found["bboxes"]) == limit:
+            return
+        if job["pyramid"] > 0:
+            # Find candidates from downscaled images, then search the
+            # bitmap around every candidate at full resolution.
+            factor = 2**job["pyramid"]
+            margin = 2 * factor
+            areaLeft, areaTop, areaRight, areaBottom = areaBbox
+            seenBboxes = set()
+            for coarseBbox in self._searchBitmap(
+                    job, job["ssImageCoarse"], job["e4gIconCoarse"],
+                    job["areaBboxCoarse"], job["colorMatchCoarse"],
+                    job["bitmapPixelSizeCoarse"],
+                    job["screenshotPixelSizeCoarse"]):
+                refineArea = (max(areaLeft, coarseBbox[0] * factor - margin),
+                              max(areaTop, coarseBbox[1] * factor - margin),
+                              min(areaRight, coarseBbox[2] * factor + margin),
+                              min(areaBottom, coarseBbox[3] * factor + margin))
+                for bbox in self._searchBitmap(
+                        job, job["ssImage"], job["e4gIcon"], refineArea,
+                        job["colorMatch"], job["bitmapPixelSize"],
+                        job["screenshotPixelSize"]):
+                    if not bbox in seenBboxes:
+                        seenBboxes.add(bbox)
+                        self._addFoundBitmap(job, found, bbox)
+                        if len(found["bboxes"]) == limit:
+                            return
+        else:
+            for bbox in self._searchBitmap(
+                    job, job["ssImage"], job["e4gIcon"], areaBbox,
+                    job["colorMatch"], job["bitmapPixelSize"],
+                    job["screenshotPixelSize"]):
+                self._addFoundBitmap(job, found, bbox)
+                if len(found["bboxes"]) == limit:
+                    return
+
+    def _addFoundBitmap(self, job, found, bbox):
+        if job["allowOverlap"] == False:
+            for itemLeft, itemTop, itemRight, itemBottom in found["index"].near(bbox):
+                if ((itemLeft <= bbox[0] <= itemRight or itemLeft <= bbox[2] <= itemRight) and
+                    (itemTop <= bbox[1] <= itemBottom or itemTop <= bbox[3] <= itemBottom)):
+                    if ((itemLeft < bbox[0] < itemRight or itemLeft < bbox[2] < itemRight) or
+                        (itemTop < bbox[1] < itemBottom or itemTop < bbox[3] < itemBottom)):
+                        return
+            found["index"].add(bbox)
+        found["bboxes"].append(bbox)
+
+    def _searchTileAreas(self, job, tileCount):
+        """
+        Returns search area of the job split to horizontal tiles. Tiles
+        overlap so that every match is inside at least one tile.
+        """
+        left, top, right, bottom = job["areaBbox"]
+        tileHeight = (bottom - top + tileCount - 1) / tileCount
+        bitmapHeight = (int(job["bitmapSize"][1] * job["yscale"]) +
+                        max(2, job["screenshotPixelSize"]))
+        if tileHeight < bitmapHeight:
+            return [job["areaBbox"]]
+        return [(left, tileTop, right, min(bottom, tileTop + tileHeight + bitmapHeight))
+                for tileTop in xrange(top, bottom, tileHeight)]
+
+    def _runFindBitmapJobs(self, jobs):
+        """
+        Run jobs in parallel. eye4graphics releases the GIL while
+        searching.
+        """
+        tasks = []
+        for job in jobs:
+            if job["areaBbox"] == None:
+                job["tiles"] = []
+            elif job["pyramid"] == 0 and self._searchTiles > 1 and self._searchThreads > 1:
+                job["tiles"] = []
+                for tileArea in self._searchTileAreas(job, self._searchTiles):
+                    tileFound = {"bboxes": [], "index": _BboxIndex()}
+                    job["tiles"].append(tileFound)
+                    tasks.append((job, tileFound, tileArea))
+            elif "reusedBboxes" in job:
+                tileFound = {"bboxes": [], "index": _BboxIndex()}
+                job["tiles"] = [tileFound]
+                tasks.append((job, tileFound, job["areaBbox"]))
+            else:
+                tasks.append((job, job["found"], job["areaBbox"]))
+        threadCount = min(self._searchThreads, len(tasks))
+        if threadCount < 2:
+            for task in tasks:
+                self._runFindBitmapJob(*task)
+        else:
+            taskQueue = Queue.Queue()
+            for task in tasks:
+                taskQueue.put(task)
+            errors = []
+            def worker():
+                while True:
+                    try:
+                        task = taskQueue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        self._runFindBitmapJob(*task)
+                    except Exception, e:
+                        errors.append(e)
+            threads = [threading.Thread(target=worker) for _ in xrange(threadCount)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if errors:
+                raise errors[0]
+        # Merge matches found in tiles and reused matches in the
+        # order of full search.
+        for job in jobs:
+            if not "tiles" in job:
+                continue
+            tileBboxes = set(job.get("reusedBboxes", ()))
+            for tileFound in job["tiles"]:
+                tileBboxes.update(tileFound["bboxes"])
+            for bbox in sorted(tileBboxes, key=lambda b: (b[1], b[0])):
+                if len(job["found"]["bboxes"]) == job["limit"]:
+                    break
+                self._addFoundBitmap(job, job["found"], bbox)
+
+    def _finishFindBitmap(self, job):
+        if not job["e4gIconCached"]:
+            eye4graphics.closeImage(job["e4gIcon"])
+        if job["pyramid"] > 0 and not job["e4gIconCoarseCached"]:
+            eye4graphics.closeImage(job["e4gIconCoarse"])
+        if "tileState" in job:
+            job["tileState"]["bboxes"][job["cacheKey"]] = job["found"]["bboxes"]
+        foundItems = [GUIItem("bitmap", bbox, job["ssFilename"], bitmap=job["bitmap"])
+                      for bbox in job["found"]["bboxes"]]
+        for ssFilename in job["cacheFilenames"]:
+            self._findBitmapCache[ssFilename][job["cacheKey"]] = foundItems
+        return foundItems
 
 def _defaultOirEngine():
     if _g_defaultOirEngine:
@@ -1326,31 +2629,251 @@ class _Paths(object):
                             self._oirAL[bitmap] = self._oirAL[candidate]
                             break
 
-        if checkReadable and not os.access(candidate, os.R_OK):
-            raise ValueError('Bitmap "%s" not readable in bitmapPath %s' % (bitmap, ':'.join(path)))
-        self._abspaths[bitmap] = [candidate]
-        # check for alternative bitmaps
+        if checkReadable and not os.access(candidate, os.R_OK):
+            raise ValueError('Bitmap "%s" not readable in bitmapPath %s' % (bitmap, ':'.join(path)))
+        self._abspaths[bitmap] = [candidate]
+        # check for alternative bitmaps
+        try:
+            candidate_ext = "." + candidate.rsplit(".", 1)[1]
+        except IndexError:
+            candidate_ext = ""
+        alt_candidates = glob.glob(candidate + ".alt*" + candidate_ext)
+        self._abspaths[bitmap].extend(alt_candidates)
+        return self._abspaths[bitmap]
+
+    def oirArgsList(self, bitmap):
+        """Returns list of alternative OIR parameters associated to the bitmap
+        by appropriate .fmbtoirrc file
+        """
+        if bitmap in self._oirAL:
+            return self._oirAL[bitmap]
+        else:
+            absBitmap = self.abspaths(bitmap)[0]
+            if absBitmap in self._oirAL:
+                return self._oirAL[absBitmap]
+            else:
+                return None
+
+
+class _ScreenshotPrefetcher(object):
+    """
+    Captures screenshots in a background thread, keeps the latest
+    frames.
+    """
+    def __init__(self, capture, frames, interval):
+        self._capture = capture
+        self._interval = interval
+        self._frames = collections.deque(maxlen=frames)
+        self._lastTaken = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                if self._stopped:
+                    return
+            finally:
+                self._cond.release()
+            startTime = time.time()
+            try:
+                frame = (startTime, self._capture(), None)
+            except Exception:
+                frame = (startTime, None, sys.exc_info())
+            self._cond.acquire()
+            try:
+                self._frames.append(frame)
+                self._cond.notifyAll()
+                if frame[2] != None:
+                    return
+                # Capture at most one screenshot per interval.
+                self._cond.wait(max(0, startTime + self._interval - time.time()))
+            finally:
+                self._cond.release()
+
+    def next(self):
+        """
+        Returns the latest screenshot that was taken after the
+        previously returned one.
+        """
+        self._cond.acquire()
+        try:
+            while not self._frames or self._frames[-1][0] == self._lastTaken:
+                self._cond.wait(1.0)
+            startTime, screenshot, excInfo = self._frames[-1]
+            self._lastTaken = startTime
+        finally:
+            self._cond.release()
+        if excInfo:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        return screenshot
+
+    def stop(self):
+        """
+        Stop capturing, returns when the thread has finished.
+        """
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            self._frames.clear()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._thread.join()
+
+class _ScreenshotStore(object):
+    """
+    Keeps track of screenshot files by content. Identical screenshots
+    are hard-linked to the same file, and screenshots are archived in
+    a background thread.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {} # content hash -> filepath
+        self._contents = {} # filepath -> (content hash, size)
+        self._archiveQueue = None
+        self._archiveThread = None
+        self._archiveAtExit = False
+
+    def _link(self, contentHash, filepath):
+        """
+        Replaces filepath with a hard link to an existing file with
+        the same content. Returns True on success.
+        """
+        existing = self._files.get(contentHash, None)
+        if existing == None or existing == filepath or not hasattr(os, "link"):
+            return False
+        # Link to a temporary name first, filepath is replaced only
+        # if linking succeeds.
+        linkFilepath = filepath + ".link"
+        try:
+            os.link(existing, linkFilepath)
+        except OSError:
+            # the file has been removed or the filesystem does not
+            # support hard links
+            del self._files[contentHash]
+            return False
+        try:
+            os.rename(linkFilepath, filepath)
+        except OSError:
+            _removeScreenshotFile(linkFilepath)
+            return False
+        self._contents[filepath] = self._contents[existing]
+        return True
+
+    def addFile(self, filepath):
+        """
+        Adds new screenshot file to the store. If an identical file
+        is already in the store, filepath is replaced with a hard
+        link to it.
+        """
+        try:
+            data = file(filepath, "rb").read()
+        except IOError:
+            return
+        contentHash = hashlib.sha1(data).digest()
+        self._lock.acquire()
+        try:
+            if not self._link(contentHash, filepath):
+                self._files[contentHash] = filepath
+                self._contents[filepath] = (contentHash, len(data))
+        finally:
+            self._lock.release()
+
+    def linkRaw(self, rawHash, filepath):
+        """
+        Creates filepath as a hard link to a file written from
+        identical raw data. Returns True on success.
+        """
+        self._lock.acquire()
+        try:
+            return self._link(rawHash, filepath)
+        finally:
+            self._lock.release()
+
+    def addRawFile(self, rawHash, filepath):
+        """
+        Adds a file written from raw data with given hash.
+        """
         try:
-            candidate_ext = "." + candidate.rsplit(".", 1)[1]
-        except IndexError:
-            candidate_ext = ""
-        alt_candidates = glob.glob(candidate + ".alt*" + candidate_ext)
-        self._abspaths[bitmap].extend(alt_candidates)
-        return self._abspaths[bitmap]
+            size = os.path.getsize(filepath)
+        except OSError:
+            return
+        self._lock.acquire()
+        try:
+            self._files[rawHash] = filepath
+            self._contents[filepath] = (rawHash, size)
+        finally:
+            self._lock.release()
 
-    def oirArgsList(self, bitmap):
-        """Returns list of alternative OIR parameters associated to the bitmap
-        by appropriate .fmbtoirrc file
+    def content(self, filepath):
         """
-        if bitmap in self._oirAL:
-            return self._oirAL[bitmap]
-        else:
-            absBitmap = self.abspaths(bitmap)[0]
-            if absBitmap in self._oirAL:
-                return self._oirAL[absBitmap]
-            else:
-                return None
+        Returns pair (content key, size in bytes) of a file.
+        Hard-linked files have the same content key. Size of a
+        missing file is 0.
+        """
+        self._lock.acquire()
+        try:
+            if filepath in self._contents:
+                return self._contents[filepath]
+        finally:
+            self._lock.release()
+        try:
+            return filepath, os.path.getsize(filepath)
+        except OSError:
+            return filepath, 0
+
+    def forget(self, filepath):
+        """
+        Stops linking new screenshots to filepath.
+        """
+        self._lock.acquire()
+        try:
+            contentHash = self._contents.pop(filepath, (None,))[0]
+            if self._files.get(contentHash, None) == filepath:
+                del self._files[contentHash]
+        finally:
+            self._lock.release()
+
+    def archiveInBackground(self, archiveFunc, filepath):
+        """
+        Calls archiveFunc(filepath) in the archiving thread.
+        """
+        self.forget(filepath)
+        if self._archiveThread == None or not self._archiveThread.isAlive():
+            self._archiveQueue = Queue.Queue()
+            self._archiveThread = threading.Thread(
+                target=self._runArchiving, args=(self._archiveQueue,))
+            self._archiveThread.daemon = True
+            self._archiveThread.start()
+            if not self._archiveAtExit:
+                atexit.register(_waitArchived, weakref.ref(self))
+                self._archiveAtExit = True
+        self._archiveQueue.put((archiveFunc, filepath))
+
+    def _runArchiving(self, archiveQueue):
+        while True:
+            item = archiveQueue.get()
+            if item == None:
+                break
+            archiveFunc, filepath = item
+            try:
+                archiveFunc(filepath)
+            except Exception, e:
+                _fmbtLog('archiving screenshot "%s" failed: %s' % (filepath, e))
 
+    def waitArchived(self):
+        """
+        Returns when all scheduled archiving has finished.
+        """
+        if self._archiveThread != None:
+            self._archiveQueue.put(None)
+            self._archiveThread.join()
+            self._archiveThread = None
 
 class GUITestInterface(object):
     def __init__(self, ocrEngine=None, oirEngine=None, rotateScreenshot=None):
@@ -1364,7 +2887,15 @@ class GUITestInterface(object):
         self._rotateScreenshot = rotateScreenshot
         self._screenshotLimit = None
         self._screenshotRefCount = {} # filename -> Screenshot object ref count
+        self._screenshotStore = _ScreenshotStore()
+        self._screenshotLimitBytes = None
         self._screenshotArchiveMethod = "resize"
+        self._screenshotInMemory = False
+        self._screenshotPrefetch = 0
+        self._screenshotPrefetcher = None
+        self._waitPolling = "fixed"
+        self._lastWaitStats = None
+        self._lastInputTime = 0.0
 
         if ocrEngine == None:
             self.setOcrEngine(_defaultOcrEngine())
@@ -1407,6 +2938,7 @@ class GUITestInterface(object):
 
     def close(self):
         self._lastScreenshot = None
+        self._screenshotStore.waitArchived()
         if self._visualLog:
             if (hasattr(self._visualLog._outFileObj, "name") and
                 self._visualLog._outFileObj.name in self._visualLogFilenames):
@@ -1455,33 +2987,37 @@ class GUITestInterface(object):
         """
         x1, y1 = self.intCoords((x1, y1))
         x2, y2 = self.intCoords((x2, y2))
+        # The whole gesture is given to the connection at once, delay
+        # of each event is the time to wait before sending it.
+        events = []
         if delayBeforeMoves >= 0:
-            if not self.existingConnection().sendTouchDown(x1, y1):
-                return False
+            events.append(("down", x1, y1, 0))
         if delayBeforeMoves > 0:
-            time.sleep(delayBeforeMoves)
+            delay = delayBeforeMoves
         else:
-            time.sleep(delayBetweenMoves)
+            delay = delayBetweenMoves
         for i in xrange(0, movePoints):
             nx = x1 + int(round(((x2 - x1) / float(movePoints+1)) * (i+1)))
             ny = y1 + int(round(((y2 - y1) / float(movePoints+1)) * (i+1)))
-            if not self.existingConnection().sendTouchMove(nx, ny): return False
-            time.sleep(delayBetweenMoves)
+            events.append(("move", nx, ny, delay))
+            delay = delayBetweenMoves
         if delayAfterMoves > 0:
-            self.existingConnection().sendTouchMove(x2, y2)
-            time.sleep(delayAfterMoves)
+            events.append(("move", x2, y2, delay))
+            delay = delayAfterMoves
         if delayAfterMoves >= 0:
-            if self.existingConnection().sendTouchUp(x2, y2):
-                return True
-            else:
-                return False
-        else:
-            return True
+            events.append(("up", x2, y2, delay))
+        self._lastInputTime = time.time()
+        if not self.existingConnection().sendTouchEvents(events):
+            return False
+        if delayAfterMoves < 0:
+            time.sleep(delay)
+        return True
 
     def enableVisualLog(self, filenameOrObj,
                         screenshotWidth="240", thumbnailWidth="",
                         timeFormat="%s.%f", delayedDrawing=False,
-                        copyBitmapsToScreenshotDir=False):
+                        copyBitmapsToScreenshotDir=False, writeQueueSize=0,
+                        logFormat="html"):
         """
         Start writing visual HTML log on this device object.
 
@@ -1518,7 +3054,41 @@ class GUITestInterface(object):
                   If True, every logged bitmap file will be copied to
                   bitmaps directory in screenshotDir. The default is
                   False.
-        """
+
+          writeQueueSize (integer, optional)
+                  If greater than zero, highlighted screenshots are
+                  drawn and the log is written in a background
+                  thread. Logged calls wait only if writeQueueSize
+                  log writes are already waiting in the queue. The
+                  log is flushed when the device is closed and at
+                  exit. The default is 0, that is, the log is
+                  written before logged calls return.
+
+          logFormat (string, optional)
+                  "html" or "records". The records format stores
+                  log events and images in one append-only file
+                  with an index (see fmbtvlog), identical images are
+                  stored only once. Use fmbt-vlog to view it. Log
+                  in records format must be given as a filename,
+                  and delayedDrawing is not supported. The default
+                  is "html".
+        """
+        if logFormat == "records":
+            if type(filenameOrObj) != str:
+                raise ValueError('Visual log in records format requires a filename')
+            if delayedDrawing:
+                raise ValueError('Visual log in records format does not support delayedDrawing')
+            if filenameOrObj in self._visualLogFilenames:
+                raise ValueError('Visual logging on file "%s" is already enabled' % (filenameOrObj,))
+            self._visualLogFilenames.add(filenameOrObj)
+            self._visualLogFileObj = None
+            self._visualLog = _RecordsVisualLog(
+                self, filenameOrObj, screenshotWidth, thumbnailWidth,
+                timeFormat, delayedDrawing, copyBitmapsToScreenshotDir,
+                writeQueueSize)
+            return
+        elif logFormat != "html":
+            raise ValueError('Invalid logFormat "%s", "html" or "records" expected' % (logFormat,))
         if type(filenameOrObj) == str:
             try:
                 outFileObj = file(filenameOrObj, "w")
@@ -1537,7 +3107,7 @@ class GUITestInterface(object):
                 self._visualLogFilenames.add(outFileObj.name)
         self._visualLog = _VisualLog(self, outFileObj, screenshotWidth,
                                      thumbnailWidth, timeFormat, delayedDrawing,
-                                     copyBitmapsToScreenshotDir)
+                                     copyBitmapsToScreenshotDir, writeQueueSize)
 
     def existingConnection(self):
         """
@@ -1572,6 +3142,21 @@ class GUITestInterface(object):
         maxX, maxY = self.screenSize()
         return _boxOnRegion(guiItem.bbox(), (0, 0, maxX, maxY))
 
+    def lastWaitStats(self):
+        """
+        Returns statistics of the latest wait as a dictionary:
+          "polling": polling strategy, see setWaitPolling
+          "found": True if waited condition was met
+          "polls": number of refreshs
+          "screenChanges": number of refreshed screenshots that
+                  differed from the previous (adaptive polling only)
+          "elapsed", "sleepTime", "refreshTime", "evaluateTime":
+                  seconds spent in the wait in total, sleeping,
+                  refreshing and evaluating the condition.
+        Returns None if wait has not been called.
+        """
+        return self._lastWaitStats
+
     def ocrEngine(self):
         """
         Returns the OCR engine that is used by default for new
@@ -1610,6 +3195,7 @@ class GUITestInterface(object):
             extraParams['modifiers'] = modifiers
         if long and hold == 0.0:
             hold = self._longPressHoldTime
+        self._lastInputTime = time.time()
         if hold > 0.0:
             try:
                 assert self.existingConnection().sendKeyDown(keyName, **extraParams)
@@ -1649,11 +3235,10 @@ class GUITestInterface(object):
         return filepath
 
     def _archiveScreenshot(self, filepath):
+        if not os.access(filepath, os.R_OK):
+            return # in-memory screenshot was never written to a file
         if self._screenshotArchiveMethod == "remove":
-            try:
-                os.remove(filepath)
-            except IOError:
-                pass
+            self._screenshotStore.archiveInBackground(_removeScreenshotFile, filepath)
         elif self._screenshotArchiveMethod.startswith("resize"):
             if self._screenshotArchiveMethod == "resize":
                 convertArgs = ["-resize",
@@ -1661,7 +3246,9 @@ class GUITestInterface(object):
             else:
                 widthHeight = self._screenshotArchiveMethod.split()[1]
                 convertArgs = ["-resize", widthHeight]
-            subprocess.call([fmbt_config.imagemagick_convert, filepath] + convertArgs + [filepath])
+            self._screenshotStore.archiveInBackground(
+                lambda filepath: _resizeScreenshotFile(filepath, convertArgs),
+                filepath)
 
     def _archiveScreenshots(self):
         """
@@ -1670,17 +3257,33 @@ class GUITestInterface(object):
         freeScreenshots = [filename
                            for (filename, refCount) in self._screenshotRefCount.iteritems()
                            if refCount == 0]
-        archiveCount = len(freeScreenshots) - self._screenshotLimit
-        if archiveCount > 0:
-            freeScreenshots.sort(reverse=True) # archive oldest
-            while archiveCount > 0:
-                toBeArchived = freeScreenshots.pop()
-                try:
-                    self._archiveScreenshot(toBeArchived)
-                except IOError:
-                    pass
-                del self._screenshotRefCount[toBeArchived]
-                archiveCount -= 1
+        freeScreenshots.sort(reverse=True) # archive oldest
+        if self._screenshotLimitBytes != None:
+            # Files of identical screenshots are hard links to the
+            # same file, count their size only once.
+            contents = [self._screenshotStore.content(filename)
+                        for filename in freeScreenshots]
+            contentFiles = {}
+            for contentKey, size in contents:
+                contentFiles[contentKey] = contentFiles.get(contentKey, 0) + 1
+            freeBytes = sum(size for contentKey, size in set(contents))
+            archiveCount = 0
+            while freeBytes > self._screenshotLimitBytes:
+                contentKey, size = contents.pop()
+                contentFiles[contentKey] -= 1
+                if contentFiles[contentKey] == 0:
+                    freeBytes -= size
+                archiveCount += 1
+        else:
+            archiveCount = len(freeScreenshots) - self._screenshotLimit
+        while archiveCount > 0:
+            toBeArchived = freeScreenshots.pop()
+            try:
+                self._archiveScreenshot(toBeArchived)
+            except IOError:
+                pass
+            del self._screenshotRefCount[toBeArchived]
+            archiveCount -= 1
 
     def refreshScreenshot(self, forcedScreenshot=None, rotate=None):
         """
@@ -1712,48 +3315,63 @@ class GUITestInterface(object):
             else:
                 self._lastScreenshot = forcedScreenshot
         elif self._conn: # There is a connection, get new screenshot
-            if self.screenshotDir() == None:
-                self.setScreenshotDir(self._screenshotDirDefault)
-            if self.screenshotSubdir() == None:
-                self.setScreenshotSubdir(self._screenshotSubdirDefault)
-            screenshotFile = self._newScreenshotFilepath()
-            if self.existingConnection().recvScreenshot(screenshotFile):
-                # New screenshot successfully received from device
-                if rotate == None:
-                    rotate = self._rotateScreenshot
-                if rotate != None and rotate != 0:
-                    subprocess.call([fmbt_config.imagemagick_convert, screenshotFile, "-rotate", str(rotate), screenshotFile])
-                self._lastScreenshot = Screenshot(
-                    screenshotFile=screenshotFile,
-                    paths = self._paths,
-                    ocrEngine=self._ocrEngine,
-                    oirEngine=self._oirEngine,
-                    screenshotRefCount=self._screenshotRefCount)
+            if self._screenshotPrefetcher != None and rotate == None:
+                # Inside wait, take the latest screenshot captured in
+                # the background.
+                self._lastScreenshot = self._screenshotPrefetcher.next()
             else:
-                self._lastScreenshot = None
+                self._lastScreenshot = self._captureScreenshot(rotate)
         else: # No connection, cannot get a screenshot
             self._lastScreenshot = None
-        # Make sure unreachable Screenshot instances are released from
-        # memory.
-        gc.collect()
-        for obj in gc.garbage:
-            if isinstance(obj, Screenshot):
-                if hasattr(obj, "_logCallReturnValue"):
-                    # Some methods have been wrapped by visual
-                    # log. Break reference cycles to let gc collect
-                    # them.
-                    del obj.findItemsByBitmap
-                    del obj.findItemsByOcr
-        del gc.garbage[:]
-        gc.collect()
 
         # If screenshotLimit has been set, archive old screenshot
         # stored on the disk.
-        if self._screenshotLimit != None and self._screenshotLimit >= 0:
+        if (self._screenshotLimitBytes != None or
+            (self._screenshotLimit != None and self._screenshotLimit >= 0)):
             self._archiveScreenshots()
 
         return self._lastScreenshot
 
+    def _captureScreenshot(self, rotate=None):
+        """
+        Returns new Screenshot from the connection, or None if
+        screenshot cannot be taken.
+        """
+        if self.screenshotDir() == None:
+            self.setScreenshotDir(self._screenshotDirDefault)
+        if self.screenshotSubdir() == None:
+            self.setScreenshotSubdir(self._screenshotSubdirDefault)
+        screenshotFile = self._newScreenshotFilepath()
+        if rotate == None:
+            rotate = self._rotateScreenshot
+        rawScreenshot = None
+        if self._screenshotInMemory and not rotate:
+            rawScreenshot = self.existingConnection().recvRawScreenshot()
+        if rawScreenshot != None:
+            # New screenshot received as raw pixel data, PNG
+            # file will be written only if needed.
+            return Screenshot(
+                screenshotFile=screenshotFile,
+                paths = self._paths,
+                ocrEngine=self._ocrEngine,
+                oirEngine=self._oirEngine,
+                screenshotRefCount=self._screenshotRefCount,
+                screenshotData=rawScreenshot,
+                screenshotStore=self._screenshotStore)
+        elif self.existingConnection().recvScreenshot(screenshotFile):
+            # New screenshot successfully received from device
+            if rotate != None and rotate != 0:
+                subprocess.call([fmbt_config.imagemagick_convert, screenshotFile, "-rotate", str(rotate), screenshotFile])
+            self._screenshotStore.addFile(screenshotFile)
+            return Screenshot(
+                screenshotFile=screenshotFile,
+                paths = self._paths,
+                ocrEngine=self._ocrEngine,
+                oirEngine=self._oirEngine,
+                screenshotRefCount=self._screenshotRefCount)
+        else:
+            return None
+
     def screenshot(self):
         """
         Returns the latest Screenshot object.
@@ -1774,12 +3392,30 @@ class GUITestInterface(object):
         """
         return self._screenshotDir
 
+    def screenshotInMemory(self):
+        """
+        Returns True if new screenshots are kept in memory as raw
+        pixel data when the connection supports it.
+
+        See also setScreenshotInMemory().
+        """
+        return self._screenshotInMemory
+
     def screenshotLimit(self):
         """
         Returns the limit after which unused screenshots are archived.
         """
         return self._screenshotLimit
 
+    def screenshotPrefetch(self):
+        """
+        Returns the number of screenshots captured in the background
+        during wait, 0 if prefetching is disabled.
+
+        See also setScreenshotPrefetch().
+        """
+        return self._screenshotPrefetch
+
     def screenshotSubdir(self):
         """
         Returns the subdirectory in screenshotDir under which new
@@ -1895,22 +3531,77 @@ class GUITestInterface(object):
         self._screenshotDir = screenshotDir
         self._newScreenshotFilepath() # make directories
 
+    def setScreenshotInMemory(self, screenshotInMemory):
+        """
+        Keep new screenshots in memory instead of saving them to files.
+
+        Parameters:
+          screenshotInMemory (boolean)
+                  If True and the connection implements
+                  recvRawScreenshot, refreshScreenshot receives raw
+                  pixel data that is searched for bitmaps and colors
+                  without encoding and decoding PNG files. The PNG
+                  file is written to screenshotDir only when it is
+                  needed, for instance by the visual log, OCR or
+                  Screenshot.save(). The default is False.
+
+        Rotated screenshots (see refreshScreenshot) are always
+        saved to files.
+        """
+        self._screenshotInMemory = screenshotInMemory
+
     def setScreenshotLimit(self, screenshotLimit):
         """
-        Set maximum number for unarchived screenshots.
+        Set maximum number or total size for unarchived screenshots.
 
         Parameters:
-          screenshotLimit (integer)
+          screenshotLimit (integer or string)
                   Maximum number of unarchived screenshots that are
                   free for archiving (that is, not referenced by test code).
+                  A string with a unit suffix, for instance "200M",
+                  sets maximum total size of files of those
+                  screenshots instead. Supported suffixes are "k",
+                  "M" and "G". Identical screenshots are hard links
+                  to the same file and their size is counted once.
                   The default is None, that is, there is no limit and
                   screenshots are never archived.
 
+        Screenshots are archived in a background thread.
+
         See also:
           setScreenshotArchiveMethod()
         """
+        if isinstance(screenshotLimit, basestring):
+            try:
+                limitBytes = int(screenshotLimit[:-1]) * {
+                    "k": 1024, "M": 1024**2, "G": 1024**3}[screenshotLimit[-1]]
+            except (ValueError, KeyError):
+                raise ValueError('Invalid screenshotLimit "%s", expected integer or size like "200M"' % (screenshotLimit,))
+            self._screenshotLimitBytes = limitBytes
+        else:
+            self._screenshotLimitBytes = None
         self._screenshotLimit = screenshotLimit
 
+    def setScreenshotPrefetch(self, frames):
+        """
+        Capture screenshots in the background while waiting.
+
+        Parameters:
+          frames (integer)
+                  If greater than 0, wait methods that refresh
+                  screenshots (waitBitmap, waitOcrText, etc.) capture
+                  the next screenshot in a background thread while
+                  the previous one is being searched. At most frames
+                  latest screenshots are kept, and each refresh takes
+                  the latest one. The default is 0, screenshots are
+                  captured only when refreshed.
+
+        While waiting, the connection is used by the background
+        thread. beforeRefresh and afterRefresh functions given to wait
+        should not use the connection.
+        """
+        self._screenshotPrefetch = frames
+
     def setScreenshotSubdir(self, screenshotSubdir):
         """
         Define a subdirectory under screenshotDir() for screenshot files.
@@ -1951,6 +3642,26 @@ class GUITestInterface(object):
         """
         self._tapDefaults.update(tapDefaults)
 
+    def setWaitPolling(self, polling):
+        """
+        Set how wait methods poll the screen.
+
+        Parameters:
+          polling (string)
+                  "fixed": sleep pollDelay between refreshs.
+                  "adaptive": refresh frequently right after tap,
+                  type and other input events and while screenshots
+                  keep changing, and back off towards pollDelay when
+                  the screen stays the same. Time spent in refreshing
+                  and evaluating is subtracted from sleeping.
+                  The default is "fixed".
+
+        See also lastWaitStats().
+        """
+        if not polling in ("fixed", "adaptive"):
+            raise ValueError('invalid polling "%s", expected "fixed" or "adaptive"' % (polling,))
+        self._waitPolling = polling
+
     def swipe(self, (x, y), direction, distance=1.0, **dragArgs):
         """
         swipe starting from coordinates (x, y) to given direction.
@@ -2183,6 +3894,7 @@ class GUITestInterface(object):
         extraParams = {}
         if button != None:
             extraParams['button'] = button
+        self._lastInputTime = time.time()
         if count == 0:
             self.existingConnection().sendTouchMove(x, y)
         while count > 0:
@@ -2328,6 +4040,7 @@ class GUITestInterface(object):
         """
         Type text.
         """
+        self._lastInputTime = time.time()
         return self.existingConnection().sendType(text)
 
     def verifyOcrText(self, text, **ocrArgs):
@@ -2388,7 +4101,8 @@ class GUITestInterface(object):
 
           pollDelay (float, optional):
                   time in seconds to sleep between refreshs. The
-                  default is 1.0.
+                  default is 1.0. With adaptive polling this is the
+                  maximum time between refreshs, see setWaitPolling.
 
           beforeRefresh (function, optional):
                   this function will be called before every refreshFunc call.
@@ -2403,21 +4117,101 @@ class GUITestInterface(object):
 
         refreshFunc will not be called if waitFunc returns immediately
         True.
+
+        Statistics of the wait are available from lastWaitStats().
         """
-        if waitFunc(*waitFuncArgs, **waitFuncKwargs):
-            return True
+        adaptive = (self._waitPolling == "adaptive")
+        refreshesScreenshot = (refreshFunc == self.refreshScreenshot)
+        stats = {"polling": self._waitPolling, "found": False, "polls": 0,
+                 "screenChanges": 0, "elapsed": 0.0, "sleepTime": 0.0,
+                 "refreshTime": 0.0, "evaluateTime": 0.0}
+        self._lastWaitStats = stats
+        def evaluate():
+            evaluateStartTime = time.time()
+            try:
+                stats["found"] = bool(waitFunc(*waitFuncArgs, **waitFuncKwargs))
+                return stats["found"]
+            finally:
+                stats["evaluateTime"] += time.time() - evaluateStartTime
         startTime = time.time()
-        endTime = startTime + waitTime
-        now = startTime
-        while now < endTime:
-            time.sleep(min(pollDelay, (endTime - now)))
-            now = time.time()
-            beforeRefresh()
-            refreshFunc()
-            afterRefresh()
-            if waitFunc(*waitFuncArgs, **waitFuncKwargs):
+        try:
+            if evaluate():
                 return True
-        return False
+            endTime = startTime + waitTime
+            now = startTime
+            minPollDelay = min(pollDelay, _g_waitMinPollDelay)
+            if adaptive:
+                delay = minPollDelay
+            else:
+                delay = pollDelay
+            pollCost = 0.0
+            if adaptive and refreshesScreenshot:
+                tileHashes = self._screenshotTileHashes()
+            prefetcher = None
+            if (self._screenshotPrefetch > 0 and
+                self._screenshotPrefetcher == None and
+                self._conn and
+                waitTime > 0 and
+                refreshesScreenshot):
+                prefetcher = _ScreenshotPrefetcher(
+                    self._captureScreenshot, self._screenshotPrefetch,
+                    minPollDelay if adaptive else pollDelay)
+                self._screenshotPrefetcher = prefetcher
+            try:
+                while now < endTime:
+                    if adaptive:
+                        if now - self._lastInputTime < _g_waitInputWindow:
+                            # The screen is likely to change soon after input.
+                            delay = minPollDelay
+                        # Time spent in refreshing and evaluating
+                        # counts as a part of the delay.
+                        sleepTime = max(0.0, delay - pollCost)
+                    else:
+                        sleepTime = delay
+                    sleepTime = min(sleepTime, (endTime - now))
+                    time.sleep(sleepTime)
+                    stats["sleepTime"] += sleepTime
+                    pollStartTime = time.time()
+                    beforeRefresh()
+                    refreshFunc()
+                    afterRefresh()
+                    stats["polls"] += 1
+                    stats["refreshTime"] += time.time() - pollStartTime
+                    if evaluate():
+                        return True
+                    now = time.time()
+                    if adaptive:
+                        pollCost = now - pollStartTime
+                        screenChanged = False
+                        if refreshesScreenshot:
+                            newTileHashes = self._screenshotTileHashes()
+                            screenChanged = (newTileHashes != tileHashes)
+                            tileHashes = newTileHashes
+                        if screenChanged:
+                            stats["screenChanges"] += 1
+                            delay = minPollDelay
+                        else:
+                            # Back off on static screen.
+                            delay = min(pollDelay, delay * _g_waitPollBackoff)
+                return False
+            finally:
+                if prefetcher != None:
+                    self._screenshotPrefetcher = None
+                    prefetcher.stop()
+        finally:
+            stats["elapsed"] = time.time() - startTime
+
+    def _screenshotTileHashes(self):
+        """
+        Returns tile hashes of the latest screenshot, None if not
+        available.
+        """
+        if self._lastScreenshot == None:
+            return None
+        try:
+            return self._lastScreenshot._tileHashes()
+        except Exception:
+            return None
 
     def waitAnyBitmap(self, listOfBitmaps, **waitAndOirArgs):
         """
@@ -2447,8 +4241,10 @@ class GUITestInterface(object):
         oirArgs, _ = _takeOirArgs(self._lastScreenshot, rest, thatsAll=True)
         foundBitmaps = []
         def observe():
-            for bitmap in listOfBitmaps:
-                if self._lastScreenshot.findItemsByBitmap(bitmap, **oirArgs):
+            foundItemLists = self._lastScreenshot.findItemsByBitmaps(
+                listOfBitmaps, **oirArgs)
+            for bitmap, foundItems in zip(listOfBitmaps, foundItemLists):
+                if foundItems:
                     foundBitmaps.append(bitmap)
             return foundBitmaps != []
         self.wait(self.refreshScreenshot, observe, **waitArgs)
@@ -2535,6 +4331,12 @@ class GUITestInterface(object):
         """
         return self.waitAnyOcrText([text], **waitAndOcrArgs) != []
 
+    def waitPolling(self):
+        """
+        Returns wait polling strategy, see setWaitPolling().
+        """
+        return self._waitPolling
+
     def waitScreenUpdated(self, **waitArgs):
         """
         Wait until screenshot has been updated or waitTime expired.
@@ -2586,8 +4388,18 @@ class Screenshot(object):
     display, or a forced bitmap file if device connection is not given.
     """
     def __init__(self, screenshotFile=None, paths=None,
-                 ocrEngine=None, oirEngine=None, screenshotRefCount=None):
+                 ocrEngine=None, oirEngine=None, screenshotRefCount=None,
+                 screenshotData=None, screenshotStore=None):
         self._filename = screenshotFile
+        # screenshotData (width, height, format, data) is written to
+        # screenshotFile only when the file is needed.
+        self._screenshotData = screenshotData
+        self._screenshotDataWritten = False
+        # The file may be needed in the test thread and in the
+        # visual log writer thread at the same time.
+        self._screenshotDataLock = threading.Lock()
+        self._screenshotStore = screenshotStore
+        self._tileHashList = None
         self._ocrEngine = ocrEngine
         self._ocrEngineNotified = False
         self._oirEngine = oirEngine
@@ -2596,7 +4408,10 @@ class Screenshot(object):
         if (type(self._screenshotRefCount) == dict and self._filename):
             self._screenshotRefCount[self._filename] = (1 +
                 self._screenshotRefCount.get(self._filename, 0))
-        self._screenSize = None
+        if screenshotData != None:
+            self._screenSize = tuple(screenshotData[:2])
+        else:
+            self._screenSize = None
         self._paths = paths
 
     def __del__(self):
@@ -2613,7 +4428,70 @@ class Screenshot(object):
         """
         Returns True if screenshot is blank, otherwise False.
         """
-        return _e4gImageIsBlank(self._filename)
+        e4gImage = self._openE4gImage()
+        try:
+            return eye4graphics.openedImageIsBlank(e4gImage) == 1
+        finally:
+            eye4graphics.closeImage(e4gImage)
+
+    def _tileHashes(self):
+        """
+        Returns list of hashes of 32x32 pixel tiles of the screenshot,
+        row by row.
+        """
+        if self._tileHashList == None:
+            if self._filename in getattr(self._oirEngine, "_openedImages", {}):
+                self._tileHashList = _e4gImageTileHashes(
+                    self._oirEngine._openedImages[self._filename], _g_changeTileSize)
+            else:
+                e4gImage = self._openE4gImage()
+                try:
+                    self._tileHashList = _e4gImageTileHashes(e4gImage, _g_changeTileSize)
+                finally:
+                    eye4graphics.closeImage(e4gImage)
+        return self._tileHashList
+
+    def _openE4gImage(self):
+        """
+        Returns new eye4graphics image of the screenshot. The caller
+        must close it.
+        """
+        if self._screenshotData != None:
+            return _e4gOpenRawImage(self._screenshotData)
+        else:
+            return _e4gOpenImage(self._filename)
+
+    def _writeScreenshotData(self):
+        width, height, fmt, data = self._screenshotData
+        if self._screenshotStore != None:
+            rawHash = hashlib.sha1("%sx%s %s\n" % (width, height, fmt))
+            rawHash.update(data)
+            rawHash = rawHash.digest()
+            if self._screenshotStore.linkRaw(rawHash, self._filename):
+                self._screenshotDataWritten = True
+                return
+        try:
+            import fmbtpng
+        except ImportError:
+            fmbtpng = None
+        if fmbtpng != None:
+            file(self._filename, "wb").write(
+                fmbtpng.raw2png(data, width, height, 8, fmt))
+        else:
+            fmt = fmt.upper()
+            convertArgs = ["-size", "%sx%s" % (width, height), "-depth", "8",
+                           fmt.replace("_", "A").lower() + ":-"]
+            if fmt.endswith("_"):
+                convertArgs.extend(["-alpha", "off"])
+            p = subprocess.Popen([fmbt_config.imagemagick_convert] +
+                                 convertArgs + [self._filename],
+                                 stdin=subprocess.PIPE)
+            p.communicate(data)
+            if p.returncode != 0:
+                raise IOError('Writing screenshot "%s" failed' % (self._filename,))
+        if self._screenshotStore != None:
+            self._screenshotStore.addRawFile(rawHash, self._filename)
+        self._screenshotDataWritten = True
 
     def setSize(self, screenSize):
         self._screenSize = screenSize
@@ -2623,7 +4501,7 @@ class Screenshot(object):
         Returns screenshot size in pixels, as pair (width, height).
         """
         if self._screenSize == None and allowReadingFile:
-            e4gImage = _e4gOpenImage(self._filename)
+            e4gImage = self._openE4gImage()
             self._screenSize = _e4gImageDimensions(e4gImage)
             eye4graphics.closeImage(e4gImage)
         return self._screenSize
@@ -2666,7 +4544,22 @@ class Screenshot(object):
         """
         return self.dumpOcr(**kwargs)
 
-    def filename(self):
+    def filename(self, allowWritingFile=True):
+        """
+        Returns the name of the screenshot file.
+
+        If the screenshot is kept in memory (see
+        GUITestInterface.setScreenshotInMemory), the file is written
+        first, unless allowWritingFile is False.
+        """
+        if (allowWritingFile and self._screenshotData != None and
+            not self._screenshotDataWritten):
+            self._screenshotDataLock.acquire()
+            try:
+                if not self._screenshotDataWritten:
+                    self._writeScreenshotData()
+            finally:
+                self._screenshotDataLock.release()
         return self._filename
 
     def _findFirstMatchingBitmapCandidate(self, bitmap, **oirArgs):
@@ -2695,7 +4588,58 @@ class Screenshot(object):
             return results
 
         else:
-            raise RuntimeError('Trying to use OIR on "%s" without OIR engine.' % (self.filename(),))
+            raise RuntimeError('Trying to use OIR on "%s" without OIR engine.' % (self._filename,))
+
+    def findItemsByBitmaps(self, listOfBitmaps, **oirFindArgs):
+        """
+        Find items matching to any of given bitmaps.
+
+        Parameters:
+
+          listOfBitmaps (list of strings):
+                  bitmaps to be searched for.
+
+          optical image recognition arguments (optional)
+                  refer to help(obj.oirEngine()).
+
+        Returns list of lists of GUIItems, one list for each
+        bitmap. Results are equal to calling findItemsByBitmap for
+        each bitmap, but the OIR engine may search bitmaps in
+        parallel.
+        """
+        if self._oirEngine == None:
+            raise RuntimeError('Trying to use OIR on "%s" without OIR engine.' % (self._filename,))
+        self._notifyOirEngine()
+        # Every bitmap has a list of (candidate file, oirArgs) to be
+        # tried in order, like in findItemsByBitmap. On each round
+        # the next alternative of all unfound bitmaps is searched for.
+        alternatives = []
+        for bitmap in listOfBitmaps:
+            oirArgsList = self._paths.oirArgsList(bitmap)
+            if oirArgsList:
+                bitmapOirArgsList = []
+                for oirArgs in oirArgsList:
+                    bitmapOirArgs, _ = _takeOirArgs(self._oirEngine, oirArgs.copy())
+                    bitmapOirArgs.update(oirFindArgs)
+                    bitmapOirArgsList.append(bitmapOirArgs)
+            else:
+                bitmapOirArgsList = [oirFindArgs]
+            alternatives.append([(candidate, candidateOirArgs)
+                                 for candidateOirArgs in bitmapOirArgsList
+                                 for candidate in self._paths.abspaths(bitmap)])
+        results = [[] for bitmapIndex in xrange(len(listOfBitmaps))]
+        altIndex = 0
+        while True:
+            searchIndexes = [i for i, alts in enumerate(alternatives)
+                             if not results[i] and altIndex < len(alts)]
+            if not searchIndexes:
+                break
+            foundItemLists = self._oirEngine.findBitmaps(
+                self, [alternatives[i][altIndex] for i in searchIndexes])
+            for index, foundItems in zip(searchIndexes, foundItemLists):
+                results[index] = foundItems
+            altIndex += 1
+        return results
 
     def findItemsByColor(self, rgb888, colorMatch=1.0, limit=1, area=None, invertMatch=False):
         """
@@ -2724,12 +4668,12 @@ class Screenshot(object):
                   The default is False.
         """
         self._notifyOirEngine()
-        if (self.filename() in getattr(self._oirEngine, "_openedImages", {})):
+        if (self._filename in getattr(self._oirEngine, "_openedImages", {})):
             # if possible, use already opened image object
-            image = self._oirEngine._openedImages[self.filename()]
+            image = self._oirEngine._openedImages[self._filename]
             closeImage = False
         else:
-            image = _e4gOpenImage(self.filename())
+            image = self._openE4gImage()
             closeImage = True
         bbox = _Bbox(-1, 0, 0, 0, 0)
         color = _Rgb888(*rgb888)
@@ -2777,7 +4721,7 @@ class Screenshot(object):
             self._notifyOcrEngine()
             return self._ocrEngine.findText(self, text, **ocrEngineArgs)
         else:
-            raise RuntimeError('Trying to use OCR on "%s" without OCR engine.' % (self.filename(),))
+            raise RuntimeError('Trying to use OCR on "%s" without OCR engine.' % (self._filename,))
 
     def findItemsByHcr(self, xRes=24, yRes=24, threshold=0.1):
         """
@@ -2821,12 +4765,12 @@ class Screenshot(object):
         x, y = _intCoords((x, y), (xsize, ysize))
         if not (0 <= x < xsize and 0 <= y < ysize):
             raise ValueError("invalid coordinates (%s, %s)" % (x, y))
-        if (self.filename() in getattr(self._oirEngine, "_openedImages", {})):
+        if (self._filename in getattr(self._oirEngine, "_openedImages", {})):
             # if possible, use already opened image object
-            image = self._oirEngine._openedImages[self.filename()]
+            image = self._oirEngine._openedImages[self._filename]
             closeImage = False
         else:
-            image = _e4gOpenImage(self.filename())
+            image = self._openE4gImage()
             closeImage = True
         try:
             color = _Rgb888(0, 0, 0)
@@ -2860,7 +4804,7 @@ class Screenshot(object):
         return foundItems
 
     def save(self, fileOrDirName):
-        shutil.copy(self._filename, fileOrDirName)
+        shutil.copy(self.filename(), fileOrDirName)
 
     def ocrEngine(self):
         return self._ocrEngine
@@ -2875,6 +4819,8 @@ class GUIItem(object):
     """
     GUIItem holds the information of a single GUI item.
     """
+    __slots__ = ("_name", "_bbox", "_bitmap", "_screenshot", "_ocrFind",
+                 "_ocrFound", "__dict__")
     def __init__(self, name, bbox, screenshot, bitmap=None, ocrFind=None, ocrFound=None):
         self._name = name
         if screenshot and hasattr(screenshot, "size"):
@@ -2887,6 +4833,16 @@ class GUIItem(object):
         self._screenshot = screenshot
         self._ocrFind = ocrFind
         self._ocrFound = ocrFound
+    def __getstate__(self):
+        state = dict(getattr(self, "__dict__", {}))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if name != "__dict__" and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
     def bbox(self): return self._bbox
     def name(self): return self._name
     def coords(self):
@@ -2906,11 +4862,66 @@ class GUIItem(object):
         return ('GUIItem("%s", bbox=%s%s)'  % (
                 self.name(), self.bbox(), extras))
 
+class _Highlight(object):
+    """
+    Highlights on a screenshot in the visual log.
+
+    Highlights are drawn on a copy of the screenshot in memory and
+    the image is encoded once. If eyenfinger delayed drawing is
+    enabled, draw commands are given to eyenfinger in one call
+    instead.
+    """
+    def __init__(self):
+        self._draws = [] # list of (stroke, fill, primitive)
+
+    def bbox(self, bbox, caption=None, color="green"):
+        left, top, right, bottom = bbox[0], bbox[1], bbox[2], bbox[3]
+        self._draws.append((color, "blue", "fill-opacity 0.2 rectangle %s,%s %s,%s" % (
+            left, top, right, bottom)))
+        if caption != None:
+            self._draws.append(("none", color, "text %s,%s '%s'" % (
+                left, top, eyenfinger._safeForShell(caption))))
+
+    def clickedPoint(self, (x, y)):
+        self._draws.append(("red", "blue", "fill-opacity 0.2 circle %s,%s %s,%s" % (
+            x, y, x + 20, y)))
+        self._draws.append(("none", "red", "point %s,%s" % (x, y)))
+
+    def lines(self, coordinates):
+        for (x, y), (nextX, nextY) in zip(coordinates, coordinates[1:]):
+            self._draws.append(("red", "white", "fill-opacity 0.2 circle %d,%d %d,%d" % (
+                x, y, x - 5, y - 5)))
+            self._draws.append(("red", "none", "line %d,%d %d,%d" % (
+                x, y, nextX, nextY)))
+            self._draws.append(("black", "none", "line %d,%d %d,%d" % (
+                x + 1, y + 1, nextX + 1, nextY + 1)))
+        if coordinates:
+            x, y = coordinates[-1]
+            self._draws.append(("red", "blue", "fill-opacity 0.2 circle %d,%d %d,%d" % (
+                x, y, x - 5, y - 5)))
+
+    def save(self, screenshotObj, highlightFilename):
+        if eyenfinger._g_defaultDelayedDrawing:
+            drawCommands = []
+            for stroke, fill, primitive in self._draws:
+                drawCommands.extend(["-stroke", stroke, "-fill", fill,
+                                     "-draw", primitive])
+            eyenfinger._runDrawCmd(screenshotObj.filename(), drawCommands,
+                                   highlightFilename)
+            return
+        e4gImage = screenshotObj._openE4gImage()
+        try:
+            for stroke, fill, primitive in self._draws:
+                _e4gDrawOnImage(e4gImage, stroke, fill, primitive)
+            _e4gWriteImage(e4gImage, highlightFilename)
+        finally:
+            eye4graphics.closeImage(e4gImage)
+
 class _VisualLog:
     def __init__(self, device, outFileObj,
                  screenshotWidth, thumbnailWidth,
                  timeFormat, delayedDrawing,
-                 copyBitmapsToScreenshotDir):
+                 copyBitmapsToScreenshotDir, writeQueueSize=0):
         self._device = device
         self._outFileObj = outFileObj
         if hasattr(self._outFileObj, "name"):
@@ -2930,6 +4941,15 @@ class _VisualLog:
         self._userFrameId = 0
         self._userFunction = ""
         self._userCallCount = 0
+        if writeQueueSize > 0:
+            self._writeQueue = Queue.Queue(writeQueueSize)
+            self._writer = threading.Thread(target=self._runWriter)
+            self._writer.daemon = True
+            self._writer.start()
+            atexit.register(_flushVisualLog, weakref.ref(self))
+        else:
+            self._writeQueue = None
+            self._writer = None
         eyenfinger.iSetDefaultDelayedDrawing(delayedDrawing)
         device.refreshScreenshot = self.refreshScreenshotLogger(device.refreshScreenshot)
         device.tap = self.tapLogger(device.tap)
@@ -2958,6 +4978,13 @@ class _VisualLog:
         self._blockId = 0
 
     def close(self):
+        self.closeFile()
+        if self._writer != None:
+            self._writeQueue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def closeFile(self):
         if self._outFileObj != None:
             html = []
             if self._bytesToFile > 0:
@@ -2971,13 +4998,17 @@ class _VisualLog:
                 # Files with strftime-formatted names are opened and
                 # closed by this class. Other file-like objects are
                 # own by someone else.
-                if hasattr(self._outFileObj, "close"):
-                    self._outFileObj.close()
-                if os.stat(self._formattedOutFilename).st_size == 0:
-                    os.remove(self._formattedOutFilename)
+                self.background(self._closeFormattedFile,
+                                self._outFileObj, self._formattedOutFilename)
             # File instance should be closed by the opener
             self._outFileObj = None
 
+    def _closeFormattedFile(self, outFileObj, formattedOutFilename):
+        if hasattr(outFileObj, "close"):
+            outFileObj.close()
+        if os.stat(formattedOutFilename).st_size == 0:
+            os.remove(formattedOutFilename)
+
     def open(self, newFormattedFilename):
         self._bytesToFile = 0
         self._formattedOutFilename = newFormattedFilename
@@ -2986,8 +5017,44 @@ class _VisualLog:
     def write(self, s):
         self._bytesToFile += len(s)
         if self._outFileObj != None:
-            self._outFileObj.write(s)
-            self._outFileObj.flush()
+            self.background(self._writeToFile, self._outFileObj, s)
+
+    def _writeToFile(self, outFileObj, s):
+        outFileObj.write(s)
+        if self._writeQueue == None or self._writeQueue.empty():
+            outFileObj.flush()
+
+    def background(self, func, *args):
+        """
+        Calls func(*args) in the writer thread, after everything
+        logged before it. Without the writer thread the call is made
+        immediately.
+        """
+        if self._writeQueue == None:
+            func(*args)
+        else:
+            self._writeQueue.put((func, args))
+
+    def flush(self, timeout=None):
+        """
+        Waits until everything logged so far has been written.
+        """
+        if self._writer != None and self._writer.isAlive():
+            flushed = threading.Event()
+            self._writeQueue.put((flushed.set, ()))
+            flushed.wait(timeout)
+
+    def _runWriter(self):
+        while True:
+            item = self._writeQueue.get()
+            if item == None:
+                break
+            func, args = item
+            try:
+                func(*args)
+            except Exception:
+                _fmbtLog("visual log writer: %s" % (
+                    traceback.format_exc().strip(),))
 
     def timestamp(self, t=None):
         return fmbt.formatTime(self._timeFormat, t)
@@ -3008,7 +5075,7 @@ class _VisualLog:
             # log filename is strftime formatted
             newOutFilename = fmbt.formatTime(self._outFilename)
             if newOutFilename != self._formattedOutFilename:
-                self.close()
+                self.closeFile()
                 # prepare new log file
                 self.open(newOutFilename)
                 self.logHeader()
@@ -3028,9 +5095,7 @@ class _VisualLog:
                 # if log splitting is in use, this is a good place to
                 # start logging into next file
                 self.logFileSplit()
-            actionHtml = '''\n\n<ul><li><table><tr><td>%s</td><td><div class="step"><a id="blockId%s" href="javascript:showHide('S%s')">%s. %s</a></div><div class="funccalls" id="S%s"><table>\n''' % (
-                self.htmlTimestamp(), self._blockId, self._blockId, ts, cgi.escape(an), self._blockId)
-            self.write(actionHtml)
+            self.writeBlock(datetime.datetime.now(), ts, an)
             self._testStep = ts
             self._actionName = an
             self._blockId += 1
@@ -3051,43 +5116,61 @@ class _VisualLog:
             self._userCallCount += 1
             self._userFrameId = (id(callerFrame), getattr(callerFrame.f_back, "f_lasti", None))
         self.logBlock()
-        imgHtml = self.imgToHtml(img, width, imgTip, "call:%s" % (callee,))
         t = datetime.datetime.now()
+        self.writeCall(t, callerFilename, callerLineno, callee, calleeArgs, img, width, imgTip)
+        self._callStack.append(callee)
+        return (self.timestamp(t), callerFilename, callerLineno)
+
+    def logReturn(self, retval, img=None, width="", imgTip="", tip=""):
+        callee = self._callStack.pop()
+        self.writeReturn(datetime.datetime.now(), callee, str(retval), img, width, imgTip, tip)
+
+    def logException(self):
+        einfo = sys.exc_info()
+        callee = self._callStack.pop()
+        self.writeException(datetime.datetime.now(), callee,
+                            traceback.format_exception(*einfo)[-2].replace('"','').strip(),
+                            str(traceback.format_exception_only(einfo[0], einfo[1])[0]))
+
+    def logMessage(self, msg):
+        callerFrame = inspect.currentframe().f_back.f_back
+        callerFilename = callerFrame.f_code.co_filename
+        callerLineno = callerFrame.f_lineno
+        self.logBlock()
+        self.writeMessage(datetime.datetime.now(), callerFilename, callerLineno, msg)
+
+    def writeBlock(self, t, testStep, actionName):
+        actionHtml = '''\n\n<ul><li><table><tr><td>%s</td><td><div class="step"><a id="blockId%s" href="javascript:showHide('S%s')">%s. %s</a></div><div class="funccalls" id="S%s"><table>\n''' % (
+            self.htmlTimestamp(t), self._blockId, self._blockId, testStep, cgi.escape(actionName), self._blockId)
+        self.write(actionHtml)
+
+    def writeCall(self, t, callerFilename, callerLineno, callee, calleeArgs, img, width, imgTip):
+        imgHtml = self.imgToHtml(img, width, imgTip, "call:%s" % (callee,))
         callHtml = '''
              <tr><td></td><td><table><tr>
                  <td>%s</td><td><a title="%s:%s"><div class="call">%s%s</div></a></td>
              </tr>
              %s''' % (self.htmlTimestamp(t), cgi.escape(callerFilename), callerLineno, cgi.escape(callee), cgi.escape(str(calleeArgs)), imgHtml)
         self.write(callHtml)
-        self._callStack.append(callee)
-        return (self.timestamp(t), callerFilename, callerLineno)
 
-    def logReturn(self, retval, img=None, width="", imgTip="", tip=""):
-        imgHtml = self.imgToHtml(img, width, imgTip, "return:%s" % (self._callStack[-1],))
-        self._callStack.pop()
+    def writeReturn(self, t, callee, retval, img, width, imgTip, tip):
+        imgHtml = self.imgToHtml(img, width, imgTip, "return:%s" % (callee,))
         returnHtml = '''
              <tr>
                  <td>%s</td><td><div class="returnvalue"><a title="%s">== %s</a></div></td>
              </tr>%s
-             </table></tr>\n''' % (self.htmlTimestamp(), tip, cgi.escape(str(retval)), imgHtml)
+             </table></tr>\n''' % (self.htmlTimestamp(t), tip, cgi.escape(retval), imgHtml)
         self.write(returnHtml)
 
-    def logException(self):
-        einfo = sys.exc_info()
-        self._callStack.pop()
+    def writeException(self, t, callee, location, exception):
         excHtml = '''
              <tr>
                  <td>%s</td><td><div class="exception"><a title="%s">!! %s</a></div></td>
              </tr>
-             </table></tr>\n''' % (self.htmlTimestamp(), cgi.escape(traceback.format_exception(*einfo)[-2].replace('"','').strip()), cgi.escape(str(traceback.format_exception_only(einfo[0], einfo[1])[0])))
+             </table></tr>\n''' % (self.htmlTimestamp(t), cgi.escape(location), cgi.escape(exception))
         self.write(excHtml)
 
-    def logMessage(self, msg):
-        callerFrame = inspect.currentframe().f_back.f_back
-        callerFilename = callerFrame.f_code.co_filename
-        callerLineno = callerFrame.f_lineno
-        self.logBlock()
-        t = datetime.datetime.now()
+    def writeMessage(self, t, callerFilename, callerLineno, msg):
         msgHtml = '''
             <tr><td></td><td><table>
                 <tr><td>%s</td><td><a title="%s:%s"><div class="message">%s</div></a></td></tr>
@@ -3144,10 +5227,12 @@ class _VisualLog:
             x2, y2 = args[1]
             retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
             try:
-                screenshotFilename = loggerSelf._device.screenshot().filename()
+                screenshotFilename = loggerSelf._device.screenshot().filename(allowWritingFile=False)
                 highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
                 iC = loggerSelf._device.intCoords
-                eyenfinger.drawLines(screenshotFilename, highlightFilename, [], [iC((x1, y1)), iC((x2, y2))])
+                highlight = _Highlight()
+                highlight.lines([iC((x1, y1)), iC((x2, y2))])
+                loggerSelf.background(highlight.save, loggerSelf._device.screenshot(), highlightFilename)
                 loggerSelf.logReturn(retval, img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name)
             except:
                 loggerSelf.logReturn(str(retval) + " (no screenshot available)", tip=origMethod.func_name)
@@ -3163,6 +5248,7 @@ class _VisualLog:
                 retval._logCallReturnValue = logCallReturnValue
                 loggerSelf.logReturn(retval, img=retval, tip=origMethod.func_name)
                 retval.findItemsByBitmap = loggerSelf.findItemsByBitmapLogger(retval.findItemsByBitmap, retval)
+                retval.findItemsByBitmaps = loggerSelf.findItemsByBitmapsLogger(retval.findItemsByBitmaps, retval)
                 retval.findItemsByOcr = loggerSelf.findItemsByOcrLogger(retval.findItemsByOcr, retval)
             else:
                 loggerSelf.logReturn(retval, tip=origMethod.func_name)
@@ -3174,9 +5260,11 @@ class _VisualLog:
             loggerSelf.logCall()
             retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
             try:
-                screenshotFilename = loggerSelf._device.screenshot().filename()
+                screenshotFilename = loggerSelf._device.screenshot().filename(allowWritingFile=False)
                 highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
-                eyenfinger.drawClickedPoint(screenshotFilename, highlightFilename, loggerSelf._device.intCoords(args[0]))
+                highlight = _Highlight()
+                highlight.clickedPoint(loggerSelf._device.intCoords(args[0]))
+                loggerSelf.background(highlight.save, loggerSelf._device.screenshot(), highlightFilename)
                 loggerSelf.logReturn(retval, img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name, imgTip=loggerSelf._device.screenshot()._logCallReturnValue)
             except:
                 loggerSelf.logReturn(str(retval) + " (no screenshot available)", tip=origMethod.func_name)
@@ -3184,46 +5272,68 @@ class _VisualLog:
         return tapWRAP
 
     def findItemsByBitmapLogger(loggerSelf, origMethod, screenshotObj):
+        # The wrapper is stored in the screenshot. Refer to the
+        # screenshot weakly to avoid a reference cycle that would keep
+        # the screenshot (with __del__) from being released.
+        origFunc = origMethod.im_func
+        screenshotRef = weakref.ref(screenshotObj)
         def findItemsByBitmapWRAP(*args, **kwargs):
+            screenshotObj = screenshotRef()
+            origMethod = types.MethodType(origFunc, screenshotObj)
             bitmap = args[0]
-            absPathBitmap = screenshotObj._paths.abspaths(bitmap)[0]
-            if loggerSelf._copyBitmapsToScreenshotDir:
-                screenshotDirBitmap = os.path.join(
-                    os.path.dirname(screenshotObj.filename()),
-                    "bitmaps",
-                    bitmap.lstrip(os.sep))
-                if not os.access(screenshotDirBitmap, os.R_OK):
-                    # bitmap is not yet copied under screenshotDir
-                    destDir = os.path.dirname(screenshotDirBitmap)
-                    if not os.access(destDir, os.W_OK):
-                        try:
-                            os.makedirs(destDir)
-                        except IOError:
-                            pass # cannot make dir / dir not writable
-                    try:
-                        shutil.copy(absPathBitmap, destDir)
-                        absPathBitmap = screenshotDirBitmap
-                    except IOError:
-                        pass # cannot copy bitmap
-
-                else:
-                    absPathBitmap = screenshotDirBitmap
-
+            absPathBitmap = loggerSelf._bitmapPath(screenshotObj, bitmap)
             loggerSelf.logCall(img=absPathBitmap)
             retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
             if len(retval) == 0:
                 loggerSelf.logReturn("not found in", img=screenshotObj, tip=origMethod.func_name)
             else:
                 foundItems = retval
-                screenshotFilename = screenshotObj.filename()
+                screenshotFilename = screenshotObj.filename(allowWritingFile=False)
                 highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
-                eyenfinger.drawIcon(screenshotFilename, highlightFilename, foundItems[0]._bitmap, [i.bbox() for i in foundItems])
+                highlight = _Highlight()
+                for index, foundItem in enumerate(foundItems):
+                    highlight.bbox(foundItem.bbox(), "%s %s" % (index + 1, foundItems[0]._bitmap))
+                loggerSelf.background(highlight.save, screenshotObj, highlightFilename)
                 loggerSelf.logReturn([str(quiItem) for quiItem in retval], img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name, imgTip=screenshotObj._logCallReturnValue)
             return retval
         return findItemsByBitmapWRAP
 
+    def findItemsByBitmapsLogger(loggerSelf, origMethod, screenshotObj):
+        # See findItemsByBitmapLogger.
+        origFunc = origMethod.im_func
+        screenshotRef = weakref.ref(screenshotObj)
+        def findItemsByBitmapsWRAP(*args, **kwargs):
+            screenshotObj = screenshotRef()
+            origMethod = types.MethodType(origFunc, screenshotObj)
+            bitmaps = args[0]
+            absPathBitmaps = [loggerSelf._bitmapPath(screenshotObj, bitmap)
+                              for bitmap in bitmaps]
+            if len(absPathBitmaps) == 1:
+                loggerSelf.logCall(img=absPathBitmaps[0])
+            else:
+                loggerSelf.logCall()
+            retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
+            if not [foundItems for foundItems in retval if foundItems]:
+                loggerSelf.logReturn("not found in", img=screenshotObj, tip=origMethod.func_name)
+            else:
+                screenshotFilename = screenshotObj.filename(allowWritingFile=False)
+                highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
+                highlight = _Highlight()
+                for bitmap, foundItems in zip(bitmaps, retval):
+                    for index, foundItem in enumerate(foundItems):
+                        highlight.bbox(foundItem.bbox(), "%s %s" % (index + 1, bitmap))
+                loggerSelf.background(highlight.save, screenshotObj, highlightFilename)
+                loggerSelf.logReturn([[str(quiItem) for quiItem in foundItems] for foundItems in retval], img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name, imgTip=screenshotObj._logCallReturnValue)
+            return retval
+        return findItemsByBitmapsWRAP
+
     def findItemsByOcrLogger(loggerSelf, origMethod, screenshotObj):
+        # See findItemsByBitmapLogger.
+        origFunc = origMethod.im_func
+        screenshotRef = weakref.ref(screenshotObj)
         def findItemsByOcrWRAP(*args, **kwargs):
+            screenshotObj = screenshotRef()
+            origMethod = types.MethodType(origFunc, screenshotObj)
             loggerSelf.logCall()
             retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
             if len(retval) == 0:
@@ -3231,15 +5341,53 @@ class _VisualLog:
                                      img=screenshotObj, tip=origMethod.func_name)
             else:
                 foundItem = retval[0]
-                screenshotFilename = screenshotObj.filename()
+                screenshotFilename = screenshotObj.filename(allowWritingFile=False)
                 highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
-                eyenfinger.drawIcon(screenshotFilename, highlightFilename, args[0], foundItem.bbox())
+                highlight = _Highlight()
+                highlight.bbox(foundItem.bbox(), args[0])
                 for appearance, foundItem in enumerate(retval[1:42]):
-                    eyenfinger.drawIcon(highlightFilename, highlightFilename, str(appearance+1) + ": " + args[0], foundItem.bbox())
+                    highlight.bbox(foundItem.bbox(), str(appearance+1) + ": " + args[0])
+                loggerSelf.background(highlight.save, screenshotObj, highlightFilename)
                 loggerSelf.logReturn([str(retval[0])], img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name, imgTip=screenshotObj._logCallReturnValue)
             return retval
         return findItemsByOcrWRAP
 
+    def _bitmapPath(self, screenshotObj, bitmap):
+        """
+        Returns path of bitmap to be shown in the log. Copies the
+        bitmap under screenshot directory if requested.
+        """
+        absPathBitmap = screenshotObj._paths.abspaths(bitmap)[0]
+        if self._copyBitmapsToScreenshotDir:
+            screenshotDirBitmap = os.path.join(
+                os.path.dirname(screenshotObj.filename(allowWritingFile=False)),
+                "bitmaps",
+                bitmap.lstrip(os.sep))
+            if not os.access(screenshotDirBitmap, os.R_OK):
+                # bitmap is not yet copied under screenshotDir
+                if self._writeQueue == None:
+                    if self._copyBitmap(absPathBitmap, screenshotDirBitmap):
+                        absPathBitmap = screenshotDirBitmap
+                else:
+                    self.background(self._copyBitmap, absPathBitmap, screenshotDirBitmap)
+                    absPathBitmap = screenshotDirBitmap
+            else:
+                absPathBitmap = screenshotDirBitmap
+        return absPathBitmap
+
+    def _copyBitmap(self, absPathBitmap, screenshotDirBitmap):
+        destDir = os.path.dirname(screenshotDirBitmap)
+        if not os.access(destDir, os.W_OK):
+            try:
+                os.makedirs(destDir)
+            except (IOError, OSError):
+                pass # cannot make dir / dir not writable
+        try:
+            shutil.copy(absPathBitmap, destDir)
+            return True
+        except IOError:
+            return False # cannot copy bitmap
+
     def relFilePath(self, fileOrDirName, fileLikeObj):
         if hasattr(fileLikeObj, "name"):
             referenceDir = os.path.dirname(fileLikeObj.name)
@@ -3252,7 +5400,9 @@ class _VisualLog:
         else: imgClassAttr = ""
 
         if isinstance(img, Screenshot):
-            imgHtmlName = self.relFilePath(img.filename(), self._outFileObj)
+            # screenshot kept in memory is written to file by the writer
+            self.background(img.filename)
+            imgHtmlName = self.relFilePath(img.filename(allowWritingFile=False), self._outFileObj)
             imgHtml = '<tr><td></td><td><img %stitle="%s" src="%s" width="%s" alt="%s" /></td></tr>' % (
                 imgClassAttr,
                 "%s refreshScreenshot() at %s:%s" % img._logCallReturnValue,
@@ -3285,4 +5435,82 @@ class _VisualLog:
             c.co_code, c.co_consts, c.co_names, c.co_varnames,
             c.co_filename, newName, c.co_firstlineno, c.co_lnotab, c.co_freevars)
 
+class _RecordsVisualLog(_VisualLog):
+    """
+    Visual log in records format, see fmbtvlog. Images are stored in
+    the log file, highlight images are removed after storing them.
+    """
+    def __init__(self, device, filename, *args):
+        self._highlightFilenames = set()
+        self._lastScreenshot = None # (Screenshot weakref, writer, record number)
+        _VisualLog.__init__(self, device, fmbtvlog.Writer(filename), *args)
+
+    def closeFile(self):
+        if self._outFileObj != None:
+            self.background(self._outFileObj.close)
+            self._outFileObj = None
+
+    def open(self, newFormattedFilename):
+        self._formattedOutFilename = newFormattedFilename
+        self._outFileObj = fmbtvlog.Writer(newFormattedFilename)
+
+    def write(self, s):
+        pass # only records are written
+
+    def highlightFilename(self, screenshotFilename):
+        retval = _VisualLog.highlightFilename(self, screenshotFilename)
+        self._highlightFilenames.add(retval)
+        return retval
+
+    def _imageRecord(self, writer, img):
+        if isinstance(img, Screenshot):
+            if (self._lastScreenshot != None and
+                self._lastScreenshot[0]() is img and
+                self._lastScreenshot[1] is writer):
+                return self._lastScreenshot[2]
+            if img._screenshotData != None:
+                recordNo = writer.addRawImage(*img._screenshotData)
+            else:
+                recordNo = writer.addImageFile(img.filename())
+            self._lastScreenshot = (weakref.ref(img), writer, recordNo)
+            return recordNo
+        recordNo = writer.addImageFile(img)
+        if img in self._highlightFilenames:
+            self._highlightFilenames.discard(img)
+            os.remove(img)
+        return recordNo
+
+    def _addEvent(self, writer, recordType, fields, img):
+        if img:
+            try:
+                fields["image"] = self._imageRecord(writer, img)
+            except Exception:
+                fields["image"] = None
+        writer.addEvent(recordType, fields)
+        if self._writeQueue == None or self._writeQueue.empty():
+            writer.flush()
+
+    def addEvent(self, t, recordType, fields, img=None):
+        fields["time"] = float(self.epochTimestamp(t))
+        fields["depth"] = len(self._callStack)
+        self.background(self._addEvent, self._outFileObj, recordType, fields, img)
+
+    def writeBlock(self, t, testStep, actionName):
+        self.addEvent(t, "B", {"step": testStep, "action": actionName})
+
+    def writeCall(self, t, callerFilename, callerLineno, callee, calleeArgs, img, width, imgTip):
+        self.addEvent(t, "C", {"file": callerFilename, "line": callerLineno,
+                               "name": callee, "args": calleeArgs}, img)
+
+    def writeReturn(self, t, callee, retval, img, width, imgTip, tip):
+        self.addEvent(t, "R", {"name": callee, "value": retval}, img)
+
+    def writeException(self, t, callee, location, exception):
+        self.addEvent(t, "E", {"name": callee, "location": location,
+                               "exception": exception})
+
+    def writeMessage(self, t, callerFilename, callerLineno, msg):
+        self.addEvent(t, "M", {"file": callerFilename, "line": callerLineno,
+                               "message": msg})
+
 class ConnectionError(Exception): pass
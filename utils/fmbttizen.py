@@ -610,6 +610,7 @@ class TizenDeviceConnection(fmbtgti.GUITestConnection):
         self._touchDevice = touchDevice
         self._mouseDevice = mouseDevice
         self._pythonCommand = pythonCommand
+        self._agentScreenshotPng = False
         self.open()
 
     def __del__(self):
@@ -848,6 +849,34 @@ class TizenDeviceConnection(fmbtgti.GUITestConnection):
             raise FMBTTizenError("Error reading display status '%s'" % (status[2],))
         return status[1]
 
+    def recvRawScreenshot(self, blankFrameRetry=3):
+        if self._agentScreenshotPng:
+            return None
+        if blankFrameRetry > 2:
+            rv, img = self._agentCmd("ss")
+        else:
+            rv, img = self._agentCmd("ss R") # retry
+        if rv == False or img is None:
+            return None
+        if not img.startswith("FMBTRAWX11"):
+            # Agent sends encoded images, raw data is not available.
+            self._agentScreenshotPng = True
+            return None
+        try:
+            header, zdata = img.split('\n', 1)
+            width, height, depth, bpp = [int(n) for n in header.split()[1:]]
+            data = zlib.decompress(zdata)
+        except Exception, e:
+            raise TizenConnectionError("Corrupted screenshot data: %s" % (e,))
+
+        if len(data) != width * height * 4:
+            raise FMBTTizenError("Image data size mismatch.")
+
+        if fmbtgti.eye4graphics.bgrx2rgb(data, width, height) == 0 and blankFrameRetry > 0:
+            time.sleep(0.5)
+            return self.recvRawScreenshot(blankFrameRetry - 1)
+        return width, height, "RGB", data[:width*height*3]
+
     def recvScreenshot(self, filename, blankFrameRetry=3):
         if blankFrameRetry > 2:
             rv, img = self._agentCmd("ss")
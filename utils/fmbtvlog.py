@@ -0,0 +1,315 @@
+# fMBT, free Model Based Testing tool
+# Copyright (c) 2014, Intel Corporation.
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms and conditions of the GNU Lesser General Public License,
+# version 2.1, as published by the Free Software Foundation.
+#
+# This program is distributed in the hope it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St - Fifth Floor, Boston, MA
+# 02110-1301 USA.
+
+"""
+Visual log in records format
+
+A records log consists of two append-only files:
+
+  NAME         - records
+  NAME.index   - index of the records
+
+The record file starts with MAGIC. Each record is
+
+  type (1 byte), payload length (4 bytes), payload
+
+The index file has an entry for every record:
+
+  type (1 byte), offset in record file (8 bytes), payload length (4 bytes)
+
+All integers are big endian. Records are referred to by their
+number, that is, position in the index. A record is added to the
+index only after it has been written, so a log can be read while it
+is being written.
+
+Record types:
+
+  "B" - test step block, "C" - call, "R" - return, "E" - exception,
+  "M" - message. Payload is a JSON object, images are referred to by
+  record numbers.
+
+  "P" - PNG image file. Payload is the contents of the file.
+
+  "X" - raw image. Payload is a JSON object with "width", "height"
+        and "fmt" (see fmbtpng.raw2png), a new line, and zlib
+        compressed pixel data.
+
+  "D" - raw image as a delta to an earlier raw image. Like "X", the
+        JSON object has also "base" (record number of the earlier
+        image) and "rows" (list of [first row, row count] of changed
+        rows). Compressed data contains only changed rows.
+
+Images are stored only once: an image with the same content as an
+earlier image refers to the earlier record.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+MAGIC = "FMBTVLOG1\n"
+
+_INDEX_ENTRY = struct.Struct(">cQI")
+_RECORD_HEADER = struct.Struct(">cI")
+
+# Raw image deltas are stored only if they are smaller than this
+# share of the full image.
+_g_maxDeltaShare = 0.5
+
+# zlib compression level for raw images.
+_g_compressLevel = 1
+
+class VisualLogError(Exception): pass
+
+def _text(s):
+    if isinstance(s, str):
+        return s.decode("utf-8", "replace")
+    return s
+
+class Writer(object):
+    """
+    Appends records to a visual log. Files are created when the first
+    record is added.
+    """
+    def __init__(self, filename, rawDeltas=True, keyframeInterval=50):
+        """
+        Parameters:
+
+          filename (string)
+                  name of the record file. Index is written to
+                  filename + ".index".
+
+          rawDeltas (boolean, optional)
+                  If True, raw images are stored as deltas to the
+                  previous raw image when possible. The default is
+                  True.
+
+          keyframeInterval (integer, optional)
+                  maximum number of deltas in a row before a full raw
+                  image is stored. Limits work needed for reading an
+                  image. The default is 50.
+        """
+        self.name = filename
+        self._recordFile = None
+        self._indexFile = None
+        self._offset = 0
+        self._recordCount = 0
+        self._images = {} # content hash -> record number
+        self._rawDeltas = rawDeltas
+        self._keyframeInterval = keyframeInterval
+        # (recordNo, width, height, fmt, data, deltas in a row)
+        self._previousRaw = None
+
+    def _open(self):
+        self._recordFile = file(self.name, "wb")
+        self._indexFile = file(self.name + ".index", "wb")
+        self._recordFile.write(MAGIC)
+        self._offset = len(MAGIC)
+
+    def addRecord(self, recordType, payload):
+        """
+        Appends a record, returns its record number.
+        """
+        if self._recordFile == None:
+            self._open()
+        self._recordFile.write(_RECORD_HEADER.pack(recordType, len(payload)))
+        self._recordFile.write(payload)
+        self._indexFile.write(_INDEX_ENTRY.pack(
+            recordType, self._offset + _RECORD_HEADER.size, len(payload)))
+        self._offset += _RECORD_HEADER.size + len(payload)
+        self._recordCount += 1
+        return self._recordCount - 1
+
+    def addEvent(self, recordType, fields):
+        """
+        Appends an event record with fields (dictionary), returns its
+        record number.
+        """
+        fields = dict((k, _text(v)) for k, v in fields.iteritems())
+        return self.addRecord(recordType, json.dumps(fields))
+
+    def addImageFile(self, filename):
+        """
+        Appends contents of an image file unless already stored,
+        returns the record number of the image.
+        """
+        data = file(filename, "rb").read()
+        contentHash = hashlib.sha1(data).digest()
+        if not contentHash in self._images:
+            self._images[contentHash] = self.addRecord("P", data)
+        return self._images[contentHash]
+
+    def addRawImage(self, width, height, fmt, data):
+        """
+        Appends raw image unless already stored, returns the record
+        number of the image.
+        """
+        contentHash = hashlib.sha1("%sx%s %s\n" % (width, height, fmt))
+        contentHash.update(data)
+        contentHash = contentHash.digest()
+        if contentHash in self._images:
+            return self._images[contentHash]
+        header = {"width": width, "height": height, "fmt": fmt}
+        recordType, pixels, deltas = "X", data, 0
+        previous = self._previousRaw
+        if (self._rawDeltas and previous != None and
+            previous[1:4] == (width, height, fmt) and
+            previous[5] < self._keyframeInterval):
+            rows, changed = _changedRows(previous[4], data, width * len(fmt), height)
+            if len(changed) < len(data) * _g_maxDeltaShare:
+                header["base"] = previous[0]
+                header["rows"] = rows
+                recordType, pixels, deltas = "D", changed, previous[5] + 1
+        recordNo = self.addRecord(recordType, "%s\n%s" % (
+            json.dumps(header), zlib.compress(pixels, _g_compressLevel)))
+        self._images[contentHash] = recordNo
+        self._previousRaw = (recordNo, width, height, fmt, data, deltas)
+        return recordNo
+
+    def flush(self):
+        if self._recordFile != None:
+            self._recordFile.flush()
+            self._indexFile.flush()
+
+    def close(self):
+        if self._recordFile != None:
+            self._recordFile.close()
+            self._indexFile.close()
+            self._recordFile = None
+            self._indexFile = None
+        self._previousRaw = None
+
+def _changedRows(oldData, newData, rowLength, rowCount):
+    rows = []
+    changed = []
+    for row in xrange(rowCount):
+        start = row * rowLength
+        newRow = buffer(newData, start, rowLength)
+        if buffer(oldData, start, rowLength) != newRow:
+            if rows and rows[-1][0] + rows[-1][1] == row:
+                rows[-1][1] += 1
+            else:
+                rows.append([row, 1])
+            changed.append(str(newRow))
+    return rows, "".join(changed)
+
+class Reader(object):
+    """
+    Reads records from a visual log. Only requested records are read.
+    """
+    def __init__(self, filename):
+        self.name = filename
+        self._recordFile = file(filename, "rb")
+        if self._recordFile.read(len(MAGIC)) != MAGIC:
+            raise VisualLogError('"%s" is not a visual log in records format' % (filename,))
+        self._indexFile = file(filename + ".index", "rb")
+        self._rawCache = None # (recordNo, width, height, fmt, data)
+
+    def recordCount(self):
+        """
+        Returns number of records in the log.
+        """
+        return os.fstat(self._indexFile.fileno()).st_size / _INDEX_ENTRY.size
+
+    def index(self, first, count):
+        """
+        Returns list of (recordNo, recordType) of at most count records
+        starting from record first.
+        """
+        self._indexFile.seek(first * _INDEX_ENTRY.size)
+        data = self._indexFile.read(count * _INDEX_ENTRY.size)
+        return [(first + i, _INDEX_ENTRY.unpack_from(data, i * _INDEX_ENTRY.size)[0])
+                for i in xrange(len(data) / _INDEX_ENTRY.size)]
+
+    def record(self, recordNo):
+        """
+        Returns record as pair (recordType, payload).
+        """
+        if not 0 <= recordNo < self.recordCount():
+            raise VisualLogError("no record %s" % (recordNo,))
+        self._indexFile.seek(recordNo * _INDEX_ENTRY.size)
+        recordType, offset, length = _INDEX_ENTRY.unpack(
+            self._indexFile.read(_INDEX_ENTRY.size))
+        self._recordFile.seek(offset)
+        payload = self._recordFile.read(length)
+        if len(payload) < length:
+            raise VisualLogError("record %s is not completely written" % (recordNo,))
+        return recordType, payload
+
+    def event(self, recordNo):
+        """
+        Returns fields of an event record in a dictionary.
+        """
+        recordType, payload = self.record(recordNo)
+        if not recordType in "BCREM":
+            raise VisualLogError("record %s is not an event" % (recordNo,))
+        return json.loads(payload)
+
+    def png(self, recordNo):
+        """
+        Returns image record as PNG data.
+        """
+        recordType, payload = self.record(recordNo)
+        if recordType == "P":
+            return payload
+        elif recordType in "XD":
+            import fmbtpng
+            width, height, fmt, data = self.rawImage(recordNo)
+            return fmbtpng.raw2png(data, width, height, fmt=fmt)
+        raise VisualLogError("record %s is not an image" % (recordNo,))
+
+    def rawImage(self, recordNo):
+        """
+        Returns raw image record as tuple (width, height, fmt, data).
+        """
+        requestedRecordNo = recordNo
+        deltas = []
+        while True:
+            if self._rawCache != None and self._rawCache[0] == recordNo:
+                width, height, fmt, data = self._rawCache[1:]
+                break
+            recordType, payload = self.record(recordNo)
+            if not recordType in "XD":
+                raise VisualLogError("record %s is not a raw image" % (recordNo,))
+            headerJson, pixels = payload.split("\n", 1)
+            header = json.loads(headerJson)
+            if recordType == "X":
+                width, height, fmt = header["width"], header["height"], str(header["fmt"])
+                data = zlib.decompress(pixels)
+                break
+            deltas.append((header, pixels))
+            recordNo = header["base"]
+        if deltas:
+            image = bytearray(data)
+            rowLength = width * len(fmt)
+            for header, pixels in reversed(deltas):
+                changed = zlib.decompress(pixels)
+                pos = 0
+                for firstRow, rowCount in header["rows"]:
+                    start = firstRow * rowLength
+                    length = rowCount * rowLength
+                    image[start:start + length] = changed[pos:pos + length]
+                    pos += length
+            data = str(image)
+        self._rawCache = (requestedRecordNo, width, height, fmt, data)
+        return width, height, fmt, data
+
+    def close(self):
+        self._recordFile.close()
+        self._indexFile.close()
@@ -568,6 +568,18 @@ class WindowsConnection(fmbtgti.GUITestConnection):
         return self._agent.eval_in(self._agent_ns,
                                    "glob.glob(%s)" % (repr(pathnamePattern),))
 
+    def recvRawScreenshot(self, screenshotSize=(None, None)):
+        if screenshotSize == (None, None):
+            screenshotSize = self._screenshotSize
+
+        width, height, zdata = self._agent.eval_in(
+            self._agent_ns, "screenshotZYBGR(%s)" % (repr(screenshotSize),))
+
+        data = zlib.decompress(zdata)
+
+        fmbtgti.eye4graphics.wbgr2rgb(data, width, height)
+        return width, height, "RGB", data
+
     def recvScreenshot(self, filename, screenshotSize=(None, None)):
         ppmfilename = filename + ".ppm"
 
@@ -70,6 +70,22 @@ class X11Connection(fmbtx11_conn.Display):
     def target(self):
         return "X11"
 
+    def recvRawScreenshot(self):
+        data = fmbtx11_conn.Display.recvScreenshot(self, "FMBTRAWX11")
+        if not data:
+            return None
+        try:
+            header, zdata = data.split('\n', 1)
+            width, height, depth, bpp = [int(n) for n in header.split()[1:]]
+            data = zlib.decompress(zdata)
+        except Exception, e:
+            raise FMBTX11Error("Corrupted screenshot data: %s" % (e,))
+        if bpp != 32:
+            return None
+        if len(data) != width * height * 4:
+            raise FMBTX11Error("Image data size mismatch.")
+        return width, height, "BGR_", data
+
     def recvScreenshot(self, filename):
         # This is a hack to get this stack quickly testable,
         # let's replace this with Xlib/libMagick functions, too...